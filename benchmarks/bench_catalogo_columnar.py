@@ -0,0 +1,139 @@
+"""
+Benchmark del catálogo columnar (NumPy) frente a la consulta SQL de /productos.
+
+Mide, para varias combinaciones de filtros, el tiempo de resolver qué
+productos se devuelven y en qué orden: la consulta ORM de la vista contra
+CatalogoColumnar.filtrar. Después compara GET /productos completo con el
+motor apagado y encendido (incluye leer las filas elegidas y serializarlas).
+
+Uso:
+    python benchmarks/bench_catalogo_columnar.py [--productos 20000] [--repeticiones 50]
+
+Por defecto usa una base SQLite temporal; DATABASE_URL permite apuntar a PostgreSQL.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from flaskr import create_app
+from flaskr.modelos import db, Producto, Categoria, VersionRecurso
+from flaskr.utilidades import catalogo_columnar
+
+# (nombre, parámetros de la vista)
+CONSULTAS = [
+    ('sin filtros', {}),
+    ('rango de precio', {'precio_min': 200000, 'precio_max': 900000}),
+    ('categoría + stock', {'categoria': 3, 'solo_en_stock': True}),
+    ('búsqueda por nombre', {'q': 'galaxy'}),
+    ('populares', {'orden': 'populares'}),
+    ('todo junto', {'q': 'pro', 'precio_min': 100000, 'categoria': 2, 'solo_en_stock': True, 'orden': 'populares'}),
+]
+
+URLS = [
+    '/productos?category_id=3&in_stock=true',
+    '/productos?q=galaxy&max_price=900000',
+    '/productos?orden=populares&min_price=1500000',
+]
+
+MARCAS = ['Galaxy', 'iPhone', 'Redmi', 'Moto', 'Pixel', 'Xperia']
+
+
+def preparar_datos(app, productos):
+    with app.app_context():
+        db.create_all()
+        if Producto.query.count() >= productos:
+            return
+        db.session.add_all([Categoria(id_categoria=i, nombre=f'Categoría {i}') for i in range(1, 11)
+                            if not Categoria.query.get(i)])
+        db.session.flush()
+        db.session.bulk_insert_mappings(Producto, [{
+            'producto_nombre': f'{MARCAS[i % len(MARCAS)]} {"Pro" if i % 3 == 0 else "Lite"} {i}',
+            'producto_precio': 50000 + (i * 7919) % 3000000,
+            'producto_stock': i % 25,
+            'descripcion': 'Descripción',
+            'producto_foto': 'foto.jpg',
+            'categoria_id': i % 10 + 1,
+            'unidades_vendidas': (i * 31) % 500,
+            'umbral_reposicion': 10,
+        } for i in range(productos)])
+        db.session.commit()
+
+
+def filtrar_sql(q=None, precio_min=None, precio_max=None, categoria=None, solo_en_stock=False, orden=None):
+    """Los mismos filtros que VistaProductos._listar_productos, devolviendo solo los ids"""
+    query = db.session.query(Producto.id_producto)
+    if q:
+        query = query.filter(Producto.producto_nombre.ilike(f'%{q}%'))
+    if precio_min is not None:
+        query = query.filter(Producto.producto_precio >= float(precio_min))
+    if precio_max is not None:
+        query = query.filter(Producto.producto_precio <= float(precio_max))
+    if categoria is not None:
+        query = query.filter(Producto.categoria_id == categoria)
+    if solo_en_stock:
+        query = query.filter(Producto.producto_stock > 0)
+    if orden == 'populares':
+        query = query.order_by(Producto.unidades_vendidas.desc(), Producto.id_producto.desc())
+    return [fila.id_producto for fila in query]
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return statistics.median(tiempos), resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--productos', type=int, default=20000)
+    parser.add_argument('--repeticiones', type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.config['LIMITE_TASA_HABILITADO'] = False
+    app.config['CATALOGO_COLUMNAR'] = True
+    if not catalogo_columnar.activo:
+        sys.exit("El catálogo columnar necesita numpy instalado")
+    preparar_datos(app, args.productos)
+
+    with app.app_context():
+        version, _ = VersionRecurso.obtener_catalogo()
+        inicio = time.perf_counter()
+        catalogo_columnar.reiniciar()
+        catalogo_columnar.sincronizar(version)
+        print(f"Carga del catálogo ({args.productos} productos): {(time.perf_counter() - inicio) * 1000:.1f} ms\n")
+
+        print(f"  {'filtros':<22} {'filas':>7} {'SQL ms':>9} {'columnar ms':>12} {'x':>7}")
+        for nombre, parametros in CONSULTAS:
+            ms_sql, ids_sql = medir(lambda: filtrar_sql(**parametros), args.repeticiones)
+            ms_col, ids_col = medir(lambda: catalogo_columnar.filtrar(version, **parametros), args.repeticiones)
+            # Sin ORDER BY el orden de SQL no está definido; solo se compara el orden en 'populares'
+            if 'orden' not in parametros:
+                ids_sql, ids_col = sorted(ids_sql), sorted(ids_col)
+            assert ids_sql == ids_col, f"Resultados distintos en '{nombre}'"
+            print(f"  {nombre:<22} {len(ids_sql):>7} {ms_sql:>9.2f} {ms_col:>12.2f} {ms_sql / ms_col:>7.1f}")
+
+    cliente = app.test_client()
+    print(f"\n  {'GET':<46} {'SQL ms':>9} {'columnar ms':>12}")
+    for url in URLS:
+        tiempos = {}
+        for activo in (False, True):
+            app.config['CATALOGO_COLUMNAR'] = activo
+            tiempos[activo], _ = medir(lambda: cliente.get(url), max(1, args.repeticiones // 10))
+        print(f"  {url:<46} {tiempos[False]:>9.1f} {tiempos[True]:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
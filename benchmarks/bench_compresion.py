@@ -0,0 +1,130 @@
+"""
+Benchmark de compresión: CPU gastada frente a bytes ahorrados para las
+formas de payload que devuelven las vistas (catálogo, historial de pedidos
+y listado de envíos del admin).
+
+Uso:
+    python benchmarks/bench_compresion.py [--filas 500] [--repeticiones 20]
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from flaskr.modelos import Producto, ProductoSchema
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def payload_catalogo(filas):
+    productos = [
+        Producto(
+            id_producto=i,
+            producto_nombre=f"SAMSUNG Galaxy A{i % 60} {random.choice(['128GB', '256GB'])}",
+            producto_precio=random.randint(300, 5000) * 1000,
+            producto_stock=random.randint(0, 80),
+            descripcion="Pantalla AMOLED de 6.5 pulgadas, cámara triple de 50MP y batería de 5000mAh",
+            producto_foto=f"https://res.cloudinary.com/phphone/image/upload/v1/productos/{i}.jpg",
+            categoria_id=random.randint(1, 6)
+        )
+        for i in range(1, filas + 1)
+    ]
+    return ProductoSchema(many=True).dump(productos)
+
+
+def payload_pedidos(filas):
+    inicio = datetime(2025, 1, 1)
+    return {"pedidos": [
+        {
+            "id_orden": i,
+            "fecha": (inicio + timedelta(hours=i)).strftime('%Y-%m-%d %H:%M:%S'),
+            "estado": "enviada",
+            "total": 2400000,
+            "metodo_pago": random.choice(['tarjeta', 'paypal', 'transferencia']),
+            "estado_pago": "completado",
+            "direccion_envio": {
+                "direccion": f"Calle {i % 200} # {i % 90}-{i % 70}",
+                "ciudad": random.choice(['Bogotá', 'Medellín', 'Cali']),
+                "estado_envio": "En Camino a Tu Hogar"
+            },
+            "productos": [
+                {
+                    "id_producto": j,
+                    "nombre": f"Producto {j}",
+                    "precio_unitario": 1200000,
+                    "cantidad": 1,
+                    "subtotal": 1200000,
+                    "imagen": f"https://res.cloudinary.com/phphone/image/upload/v1/productos/{j}.jpg"
+                } for j in range(1, 3)
+            ]
+        } for i in range(1, filas + 1)
+    ]}
+
+
+def payload_envios_admin(filas):
+    inicio = datetime(2025, 1, 1)
+    return {'envios': [
+        {
+            'id_envio': i,
+            'usuario_id': i % 300,
+            'nombre_usuario': f"Cliente {i % 300}",
+            'estado_actual': random.choice(['Empacando', 'Validando', 'En Camino a Tu Hogar']),
+            'fecha_creacion': (inicio + timedelta(minutes=7 * i)).isoformat(),
+            'id_factura': i
+        } for i in range(1, filas + 1)
+    ]}
+
+
+def compresores():
+    for nivel in (1, 6, 9):
+        yield f"gzip-{nivel}", lambda datos, nivel=nivel: _gzip(datos, nivel)
+    if brotli is not None:
+        for calidad in (1, 4, 6, 11):
+            yield f"br-{calidad}", lambda datos, calidad=calidad: brotli.compress(datos, quality=calidad)
+
+
+def _gzip(datos, nivel):
+    compresor = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+    return compresor.compress(datos) + compresor.flush()
+
+
+def medir(nombre, datos, repeticiones):
+    print(f"\n{nombre}: {len(datos):,} bytes sin comprimir")
+    print(f"  {'codificación':<12} {'bytes':>10} {'ratio':>7} {'ahorro':>10} {'ms/resp':>9} {'µs/KB ahorrado':>15}")
+    for etiqueta, comprimir in compresores():
+        inicio = time.perf_counter()
+        for _ in range(repeticiones):
+            comprimido = comprimir(datos)
+        ms = (time.perf_counter() - inicio) * 1000 / repeticiones
+        ahorro = len(datos) - len(comprimido)
+        coste = (ms * 1000) / (ahorro / 1024) if ahorro else float('inf')
+        print(f"  {etiqueta:<12} {len(comprimido):>10,} {len(datos) / len(comprimido):>6.1f}x {ahorro:>10,} {ms:>9.3f} {coste:>15.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filas', type=int, default=500)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(42)
+    payloads = {
+        'GET /productos': payload_catalogo(args.filas),
+        'GET /api/mis-pedidos': payload_pedidos(args.filas // 10 or 1),
+        'GET /api/admin/envios': payload_envios_admin(args.filas),
+    }
+    for nombre, payload in payloads.items():
+        medir(nombre, json.dumps(payload).encode('utf-8'), args.repeticiones)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+Comprobación de planes: ninguna vista debe recorrer entera una tabla grande.
+
+Ejecuta las peticiones habituales (cliente y admin) contra una base con
+datos, captura los SELECT que lanza cada vista y pide su plan con EXPLAIN.
+Falla (código de salida 1) si aparece un recorrido secuencial sobre alguna
+de TABLAS_GRANDES que la vista no tenga permitido (p. ej. el catálogo
+completo recorre producto a propósito).
+
+En PostgreSQL se desactiva enable_seqscan para el EXPLAIN: así el planificador
+solo elige Seq Scan cuando no hay ningún índice que sirva, sin depender del
+tamaño de las tablas de prueba. En SQLite se buscan los pasos "SCAN tabla"
+sin índice de EXPLAIN QUERY PLAN.
+
+Uso:
+    python benchmarks/bench_explain.py [--usuarios 200] [--productos 500]
+
+Por defecto usa una base SQLite temporal; DATABASE_URL permite apuntar a PostgreSQL.
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+
+from flaskr import create_app
+from flaskr.modelos import (db, pool_hashing, Rol, Usuario, Producto, Categoria, Carrito, CarritoProducto, Pago, Factura,
+                            DetalleFactura, Orden, Envio, HistorialStock)
+
+TABLAS_GRANDES = {
+    'usuario', 'producto', 'carrito', 'carrito_producto', 'pago', 'factura', 'detalle_factura',
+    'orden', 'envio', 'historial_envio', 'historial_stock', 'historial_stock_archivo',
+}
+
+# (nombre, usuario, url, tablas que la vista puede recorrer enteras)
+PETICIONES = [
+    ('catálogo por categoría y precio', 'cliente', '/productos?category_id=2&min_price=1000&max_price=90000', set()),
+    ('catálogo completo', 'cliente', '/productos', {'producto'}),
+    ('carrito activo', 'cliente', '/carrito/activo', set()),
+    ('recomendados', 'cliente', '/productos/recomendados', {'producto'}),
+    ('última factura', 'cliente', '/factura/ultima', set()),
+    ('mis pedidos', 'cliente', '/api/mis-pedidos', set()),
+    ('estado de envío', 'cliente', '/api/envios/{id_orden}/estado', set()),
+    ('detalle de factura', 'cliente', '/detallefactura/{id_factura}', set()),
+    ('envíos admin por estado', 'admin', '/api/admin/envios?estado_envio=Empacando', set()),
+    ('productos bajo stock', 'admin', '/api/productos/bajo-stock', set()),
+    ('historial de un producto', 'admin', '/productos/{id_producto}/historial-stock', set()),
+    ('historial general', 'admin', '/historial-stock', set()),
+    ('stock en una fecha', 'admin', '/stock-productos?fecha={ayer}', {'producto'}),
+]
+
+
+def preparar_datos(app, usuarios, productos):
+    with app.app_context():
+        db.create_all()
+        if Usuario.query.filter_by(correo='admin@bench.com').first():
+            return
+        for rol_id, nombre_rol in ((1, 'ADMIN'), (2, 'CLIENTE')):
+            rol = Rol(nombre_rol=nombre_rol)
+            rol.rol_id = rol_id
+            db.session.add(rol)
+        db.session.add_all([Categoria(id_categoria=i, nombre=f'Categoría {i}') for i in range(1, 6)])
+        db.session.flush()
+        db.session.add(Usuario(nombre='Admin', numerodoc=1, correo='admin@bench.com', contrasena='x', rol_id=1))
+        db.session.add_all([
+            Producto(producto_nombre=f'Producto {i}', producto_precio=1000 * i, producto_stock=i % 30,
+                     descripcion='Descripción', producto_foto='foto.jpg', categoria_id=i % 5 + 1)
+            for i in range(1, productos + 1)
+        ])
+        db.session.flush()
+
+        ahora = datetime.utcnow()
+        for u in range(usuarios):
+            usuario = Usuario(nombre=f'Cliente {u}', numerodoc=1000 + u, correo=f'cliente{u}@bench.com',
+                              contrasena='x', rol_id=2)
+            db.session.add(usuario)
+            db.session.flush()
+            carrito = Carrito(id_usuario=usuario.id_usuario, total=3000, procesado=True)
+            db.session.add(carrito)
+            db.session.add(Carrito(id_usuario=usuario.id_usuario, total=0, procesado=False))
+            db.session.flush()
+            id_producto = u % productos + 1
+            db.session.add(CarritoProducto(id_carrito=carrito.id_carrito, id_producto=id_producto, cantidad=3))
+            pago = Pago(id_carrito=carrito.id_carrito, monto=3000, metodo_pago='paypal',
+                        fecha_pago=ahora - timedelta(days=u % 30))
+            db.session.add(pago)
+            db.session.flush()
+            factura = Factura(id_pago=pago.id_pago, total=3000, factura_fecha=pago.fecha_pago)
+            db.session.add(factura)
+            db.session.flush()
+            db.session.add(DetalleFactura(id_factura=factura.id_factura, id_producto=id_producto, cantidad=3,
+                                          precio_unitario=1000, monto_total=3000))
+            db.session.add(Orden(id_usuario=usuario.id_usuario, id_factura=factura.id_factura, monto_total=3000,
+                                 fecha_orden=pago.fecha_pago))
+            db.session.add(Envio(direccion='Calle 1', ciudad='Bogota', departamento='Cundinamarca',
+                                 codigo_postal='110111', pais='Colombia', usuario_id=usuario.id_usuario,
+                                 id_factura=factura.id_factura, fecha_creacion=pago.fecha_pago))
+            db.session.add(HistorialStock(id_producto=id_producto, stock_anterior=0, cantidad_ajuste=5,
+                                          nuevo_stock=5, fecha_ajuste=pago.fecha_pago, motivo='Bench'))
+        db.session.commit()
+
+
+def capturar_selects(app, cliente, url, headers):
+    """Ejecuta la petición y devuelve (status, [(sql, parámetros)]) de los SELECT que lanzó"""
+    capturadas = []
+
+    def antes(conexion, cursor, sentencia, parametros, contexto, executemany):
+        if sentencia.lstrip().upper().startswith(('SELECT', 'WITH')):
+            capturadas.append((sentencia, parametros))
+
+    with app.app_context():
+        motor = db.engine
+    event.listen(motor, 'before_cursor_execute', antes)
+    try:
+        respuesta = cliente.get(url, headers=headers)
+    finally:
+        event.remove(motor, 'before_cursor_execute', antes)
+    return respuesta.status_code, capturadas
+
+
+def recorridos_secuenciales(conexion, sentencia, parametros):
+    """Tablas que el plan de la sentencia recorre enteras"""
+    if conexion.dialect.name == 'postgresql':
+        with conexion.begin():
+            conexion.exec_driver_sql('SET LOCAL enable_seqscan = off')
+            plan = conexion.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + sentencia, parametros).scalar()
+        tablas = set()
+        pendientes = [plan[0]['Plan']]
+        while pendientes:
+            nodo = pendientes.pop()
+            if nodo['Node Type'] == 'Seq Scan':
+                tablas.add(nodo['Relation Name'])
+            pendientes.extend(nodo.get('Plans', []))
+        return tablas
+
+    tablas = set()
+    for fila in conexion.exec_driver_sql('EXPLAIN QUERY PLAN ' + sentencia, parametros):
+        detalle = fila[-1]
+        coincidencia = re.match(r'SCAN (?:TABLE )?(\w+)', detalle)
+        if coincidencia and 'USING' not in detalle:
+            # Los alias de SQLAlchemy son tabla_1, tabla_2...
+            tablas.add(re.sub(r'_\d+$', '', coincidencia.group(1)))
+    return tablas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--usuarios', type=int, default=200)
+    parser.add_argument('--productos', type=int, default=500)
+    args = parser.parse_args()
+
+    app = create_app()
+    app.config['LIMITE_TASA_HABILITADO'] = False
+    # Las contraseñas no importan aquí; un hash barato acelera la carga de datos
+    pool_hashing.configurar(metodo='pbkdf2:sha256:1', procesos=0)
+    preparar_datos(app, args.usuarios, args.productos)
+
+    with app.app_context():
+        admin = Usuario.query.filter_by(correo='admin@bench.com').first()
+        cliente = Usuario.query.filter_by(correo='cliente0@bench.com').first()
+        orden = Orden.query.filter_by(id_usuario=cliente.id_usuario).first()
+        tokens = {
+            'admin': create_access_token(identity=str(admin.id_usuario)),
+            'cliente': create_access_token(identity=str(cliente.id_usuario)),
+        }
+        valores = {
+            'id_orden': orden.id_orden,
+            'id_factura': orden.id_factura,
+            'id_producto': 1,
+            'ayer': (datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d'),
+        }
+
+    test_client = app.test_client()
+    fallos = 0
+    print(f"{'vista':<34} {'status':>6} {'selects':>8}  recorridos secuenciales")
+    for nombre, rol, url, permitidas in PETICIONES:
+        status, selects = capturar_selects(app, test_client, url.format(**valores),
+                                           {'Authorization': f'Bearer {tokens[rol]}'})
+        with app.app_context():
+            with db.engine.connect() as conexion:
+                tablas = set()
+                for sentencia, parametros in selects:
+                    tablas |= recorridos_secuenciales(conexion, sentencia, parametros)
+        # Fuera quedan las subconsultas (anon_1...), que no son tablas
+        tablas &= set(db.metadata.tables)
+        prohibidas = (tablas & TABLAS_GRANDES) - permitidas
+        fallos += bool(prohibidas) or status >= 400
+        marca = 'FALLO' if prohibidas or status >= 400 else 'ok'
+        print(f"{nombre:<34} {status:>6} {len(selects):>8}  {', '.join(sorted(tablas)) or '-'}  [{marca}]")
+
+    if fallos:
+        print(f"\n{fallos} vistas con recorridos secuenciales sobre tablas grandes o con error")
+        sys.exit(1)
+    print("\nNinguna vista recorre tablas grandes sin índice")
+
+
+if __name__ == '__main__':
+    main()
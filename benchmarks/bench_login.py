@@ -0,0 +1,119 @@
+"""
+Benchmark de latencia del login: camino rápido frente al login con carrito.
+
+Compara POST /login (solo token y rol) con POST /login?incluir_carrito=true,
+que es el comportamiento anterior: buscar el carrito abierto, crearlo y hacer
+commit si no existe, y serializarlo. El caso "carrito nuevo" borra el carrito
+antes de cada login, como ocurre en el primer login tras un pago.
+
+El PBKDF2 domina la latencia del login y es igual en los tres casos; con
+--iteraciones bajo se ve mejor la parte que cambia. También cuenta las
+sentencias SQL por petición.
+
+Uso:
+    python benchmarks/bench_login.py [--peticiones 200] [--iteraciones 1000]
+
+Por defecto usa una base SQLite temporal; DATABASE_URL permite apuntar a PostgreSQL.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from sqlalchemy import event
+
+from flaskr import create_app
+from flaskr.modelos import db, pool_hashing, Usuario, Rol, Carrito
+
+CORREO = 'bench-login@phphone.com'
+CONTRASENA = 'bench12345'
+
+
+def preparar_datos(app):
+    with app.app_context():
+        db.create_all()
+        usuario = Usuario.query.filter_by(correo=CORREO).first()
+        if not usuario:
+            rol = Rol.query.filter_by(nombre_rol='CLIENTE').first() or Rol(nombre_rol='CLIENTE')
+            db.session.add(rol)
+            db.session.flush()
+            usuario = Usuario(nombre='Bench', numerodoc=2, correo=CORREO, rol_id=rol.rol_id)
+            db.session.add(usuario)
+        # Con el método configurado, para que el login no haga rehash
+        usuario.contrasena = CONTRASENA
+        db.session.commit()
+        return usuario.id_usuario
+
+
+def medir(app, cliente, url, peticiones, antes=None):
+    sentencias = []
+    latencias = []
+    with app.app_context():
+        motor = db.engine
+    contador = [0]
+
+    def contar(*_):
+        contador[0] += 1
+
+    event.listen(motor, 'before_cursor_execute', contar)
+    try:
+        for _ in range(peticiones):
+            if antes:
+                antes()
+            contador[0] = 0
+            inicio = time.perf_counter()
+            respuesta = cliente.post(url, json={'correo': CORREO, 'contrasena': CONTRASENA})
+            latencias.append((time.perf_counter() - inicio) * 1000)
+            sentencias.append(contador[0])
+            assert respuesta.status_code == 200, respuesta.json
+    finally:
+        event.remove(motor, 'before_cursor_execute', contar)
+    return latencias, sentencias
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--peticiones', type=int, default=200)
+    parser.add_argument('--iteraciones', type=int, default=1000,
+                        help='iteraciones de PBKDF2 (0 = las de HASH_METODO)')
+    args = parser.parse_args()
+
+    app = create_app()
+    pool_hashing.configurar(procesos=0)
+    if args.iteraciones:
+        pool_hashing.configurar(metodo=f'pbkdf2:sha256:{args.iteraciones}')
+    id_usuario = preparar_datos(app)
+    cliente = app.test_client()
+
+    def borrar_carrito():
+        with app.app_context():
+            Carrito.query.filter_by(id_usuario=id_usuario, procesado=False).delete()
+            db.session.commit()
+
+    casos = [
+        ('login (token y rol)', '/login', None),
+        ('login + carrito existente', '/login?incluir_carrito=true', None),
+        ('login + carrito nuevo', '/login?incluir_carrito=true', borrar_carrito),
+    ]
+    # Calentar
+    medir(app, cliente, '/login', 10)
+
+    print(f"\n{args.peticiones} peticiones, {pool_hashing.metodo}")
+    print(f"  {'caso':<28} {'p50 ms':>9} {'p95 ms':>9} {'media ms':>9} {'SQL/pet':>8}")
+    for nombre, url, antes in casos:
+        latencias, sentencias = medir(app, cliente, url, args.peticiones, antes)
+        p95 = statistics.quantiles(latencias, n=100)[94]
+        print(f"  {nombre:<28} {statistics.median(latencias):>9.2f} {p95:>9.2f} "
+              f"{statistics.mean(latencias):>9.2f} {statistics.mean(sentencias):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
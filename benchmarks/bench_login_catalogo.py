@@ -0,0 +1,115 @@
+"""
+Benchmark de tráfico mixto login + catálogo en un mismo worker.
+
+Simula un worker de gunicorn con N hilos: unos hacen POST /login (PBKDF2) y
+otros GET /productos. Se ejecuta primero con el hash en el hilo de la
+petición (HASH_PROCESOS=0) y después con el pool de procesos, y compara la
+latencia del catálogo mientras hay ráfaga de logins.
+
+Uso:
+    python benchmarks/bench_login_catalogo.py [--segundos 10] [--hilos-login 2] [--hilos-catalogo 2] [--procesos 2]
+
+Por defecto usa una base SQLite temporal; DATABASE_URL permite apuntar a PostgreSQL.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+if not os.getenv('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from flaskr import create_app
+from flaskr.modelos import db, pool_hashing, Usuario, Producto, Rol
+
+CORREO = 'bench@phphone.com'
+CONTRASENA = 'bench12345'
+
+
+def preparar_datos(app):
+    with app.app_context():
+        db.create_all()
+        if not Usuario.query.filter_by(correo=CORREO).first():
+            rol = Rol.query.filter_by(nombre_rol='CLIENTE').first() or Rol(nombre_rol='CLIENTE')
+            db.session.add(rol)
+            db.session.flush()
+            db.session.add(Usuario(nombre='Bench', numerodoc=1, correo=CORREO, contrasena=CONTRASENA, rol_id=rol.rol_id))
+            db.session.add_all([
+                Producto(producto_nombre=f'Producto {i}', producto_precio=1000 * i, producto_stock=i % 30,
+                         descripcion='Descripción', producto_foto='foto.jpg', categoria_id=i % 5 + 1)
+                for i in range(1, 201)
+            ])
+            db.session.commit()
+
+
+def trabajador(app, peticion, latencias, errores, fin):
+    cliente = app.test_client()
+    while time.monotonic() < fin:
+        inicio = time.perf_counter()
+        respuesta = peticion(cliente)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        if respuesta.status_code >= 400:
+            errores.append(respuesta.status_code)
+
+
+def ejecutar(app, segundos, hilos_login, hilos_catalogo):
+    resultados = {'login': ([], []), 'catalogo': ([], [])}
+    fin = time.monotonic() + segundos
+    hilos = []
+    for _ in range(hilos_login):
+        hilos.append(threading.Thread(target=trabajador, args=(
+            app, lambda c: c.post('/login', json={'correo': CORREO, 'contrasena': CONTRASENA}),
+            *resultados['login'], fin)))
+    for _ in range(hilos_catalogo):
+        hilos.append(threading.Thread(target=trabajador, args=(
+            app, lambda c: c.get('/productos?in_stock=true'), *resultados['catalogo'], fin)))
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    return resultados
+
+
+def percentil(valores, p):
+    if not valores:
+        return float('nan')
+    return statistics.quantiles(valores, n=100)[p - 1] if len(valores) > 1 else valores[0]
+
+
+def imprimir(titulo, resultados, segundos):
+    print(f"\n{titulo}")
+    print(f"  {'tipo':<10} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errores':>8}")
+    for tipo, (latencias, errores) in resultados.items():
+        print(f"  {tipo:<10} {len(latencias) / segundos:>8.1f} {percentil(latencias, 50):>9.1f} "
+              f"{percentil(latencias, 95):>9.1f} {percentil(latencias, 99):>9.1f} {len(errores):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--segundos', type=float, default=10)
+    parser.add_argument('--hilos-login', type=int, default=2)
+    parser.add_argument('--hilos-catalogo', type=int, default=2)
+    parser.add_argument('--procesos', type=int, default=2)
+    args = parser.parse_args()
+
+    app = create_app()
+    preparar_datos(app)
+
+    for procesos in (0, args.procesos):
+        pool_hashing.configurar(procesos=procesos)
+        # Calentar (arranque del pool, caché de consultas)
+        ejecutar(app, 1, 1, 1)
+        resultados = ejecutar(app, args.segundos, args.hilos_login, args.hilos_catalogo)
+        modo = 'hash en el hilo de la petición' if procesos == 0 else f'pool de {procesos} procesos'
+        imprimir(f"{modo} ({args.hilos_login} hilos login + {args.hilos_catalogo} hilos catálogo)",
+                 resultados, args.segundos)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import os
+import click
 from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
 from flask_restful import Api, Resource
@@ -10,16 +11,21 @@ from datetime import datetime
 from werkzeug.security import generate_password_hash
 from dotenv import load_dotenv
 from .modelos.modelo import db
+from .modelos.hashing import pool_hashing
+from .modelos.tokenizacion import tokenizador_tarjetas
+from .utilidades import Compresion, difusor_envios, difusor_eventos_stock, cache_roles, limitador, despachador_correos, catalogo_columnar, archivar_historial_stock, tomar_foto_stock, reparar_contadores_ventas
 from .vistas.vistas import (
     VistaUsuario, VistaProductos, VistaProductosBajoStock, VistaActualizarEstadoAdmin, 
     VistaEnviosAdmin, VistaEstadoEnvio, VistaPedidosUsuario, VistaUltimaFactura, 
     VistaReportesProductos, VistaProducto, VistaTarjeta, VistaPaypal, VistaTransferencia, 
     VistaProductosRecomendados, VistaCategorias, VistaCategoria, VistaUsuarios, 
     VistaLogin, VistaSignIn, VistaCarrito, VistaCarritos, VistaCarritoActivo, 
-    VistaRolUsuario, VistaPago, VistaPerfilUsuario, VistaFacturas, VistaAjusteStock, 
+    VistaRolUsuario, VistaPago, VistaPerfilUsuario, VistaFacturas, VistaAjusteStock, VistaAjusteStockMasivo, 
     VistaHistorialStockGeneral, VistaHistorialStockProducto, VistaStockProductos,
     VistaFactura, VistaDetalleFactura, VistaEnvio, VistaCarritoProducto, VistaPagos, 
-    VistaPagoPaypal, VistaPagoTarjeta, VistaPagoTransferencia
+    VistaPagoPaypal, VistaPagoTarjeta, VistaPagoTransferencia, VistaStreamEstadoEnvio,
+    VistaActualizarEstadoMasivoAdmin, VistaCheckout, VistaEventosStock, VistaStreamEventosStock,
+    VistaBatch
 )
 
 # Cargar variables de entorno
@@ -27,12 +33,17 @@ load_dotenv()
 
 # Creamos mail a nivel global
 mail = Mail()
+compresion = Compresion()
 
 def create_app(config_name='default'):
     app = Flask(__name__)
 
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Segundos que un CDN o proxy puede servir el catálogo público sin revalidar
+    app.config['CATALOGO_CACHE_MAX_AGE'] = int(os.getenv('CATALOGO_CACHE_MAX_AGE', 60))
+    # Segundos que se agrupan los cambios de stock y ventas antes de invalidar el catálogo (0 = al confirmar)
+    app.config['CATALOGO_VENTANA_STOCK'] = float(os.getenv('CATALOGO_VENTANA_STOCK', 30))
     
     @app.template_filter('format_number')
     def format_number(value):
@@ -44,9 +55,28 @@ def create_app(config_name='default'):
     db.init_app(app)
     migrate = Migrate(app, db)
 
+    # Hash de contraseñas en un pool de procesos (HASH_PROCESOS=0 lo calcula en el hilo de la petición)
+    app.config['HASH_METODO'] = os.getenv('HASH_METODO', 'pbkdf2:sha256:260000')
+    app.config['HASH_PROCESOS'] = int(os.getenv('HASH_PROCESOS', 2))
+    app.config['HASH_MAXIMO_PENDIENTES'] = int(os.getenv('HASH_MAXIMO_PENDIENTES', 16))
+    app.config['HASH_TIMEOUT'] = float(os.getenv('HASH_TIMEOUT', 10))
+    pool_hashing.configurar(
+        metodo=app.config['HASH_METODO'],
+        procesos=app.config['HASH_PROCESOS'],
+        maximo_pendientes=app.config['HASH_MAXIMO_PENDIENTES'],
+        timeout=app.config['HASH_TIMEOUT']
+    )
+
+    # Tokenización de tarjetas: "version:secreto[,version:secreto]"; vacío = hash PBKDF2 de número y CVV
+    app.config['TARJETA_TOKEN_CLAVES'] = os.getenv('TARJETA_TOKEN_CLAVES', '')
+    tokenizador_tarjetas.configurar(app.config['TARJETA_TOKEN_CLAVES'])
+
     # Configuración de JWT
     app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'clave_secreta')
     jwt = JWTManager(app)
+    # Segundos que se confía en el rol cacheado antes de volver a leerlo (cambios de rol y usuarios borrados)
+    app.config['ROLES_CACHE_TTL'] = int(os.getenv('ROLES_CACHE_TTL', 60))
+    cache_roles.ttl = app.config['ROLES_CACHE_TTL']
 
     # Configuración de Flask-Mail
     app.config['MAIL_SERVER'] = 'smtp.gmail.com'
@@ -61,6 +91,46 @@ def create_app(config_name='default'):
     mail.init_app(app)
     CORS(app)
 
+    # Correos en bandeja de salida: plantillas compiladas una vez (bytecode en disco) y envío en lote
+    app.config['CORREO_DESPACHO_AUTOMATICO'] = os.getenv('CORREO_DESPACHO_AUTOMATICO', 'true').lower() == 'true'
+    app.config['CORREO_INTERVALO_DESPACHO'] = float(os.getenv('CORREO_INTERVALO_DESPACHO', 5.0))
+    app.config['CORREO_LOTE'] = int(os.getenv('CORREO_LOTE', 50))
+    app.config['CORREO_PLAZO_RECLAMO'] = float(os.getenv('CORREO_PLAZO_RECLAMO', 300))
+    app.config['CORREO_REINTENTO_BASE'] = float(os.getenv('CORREO_REINTENTO_BASE', 30))
+    app.config['CORREO_REINTENTO_MAXIMO'] = float(os.getenv('CORREO_REINTENTO_MAXIMO', 3600))
+    if os.getenv('JINJA_CACHE_DIR'):
+        app.config['JINJA_CACHE_DIR'] = os.getenv('JINJA_CACHE_DIR')
+    despachador_correos.init_app(app, mail)
+
+    # Límite de tasa por IP e identidad y descarte de carga por prioridad (global entre workers con --preload)
+    app.config['LIMITE_TASA_HABILITADO'] = os.getenv('LIMITE_TASA_HABILITADO', 'true').lower() == 'true'
+    app.config['LIMITE_CONCURRENCIA'] = int(os.getenv('LIMITE_CONCURRENCIA', 8))
+    app.config['LIMITE_CONCURRENCIA_BAJA'] = int(os.getenv('LIMITE_CONCURRENCIA_BAJA', 4))
+    app.config['LIMITE_PROXIES_CONFIABLES'] = int(os.getenv('LIMITE_PROXIES_CONFIABLES', 1))
+    limitador.init_app(app)
+
+    # Compresión de respuestas (brotli si está instalado, si no gzip)
+    app.config['COMPRESION_TAMANO_MINIMO'] = int(os.getenv('COMPRESION_TAMANO_MINIMO', 500))
+    app.config['COMPRESION_NIVEL_GZIP'] = int(os.getenv('COMPRESION_NIVEL_GZIP', 6))
+    app.config['COMPRESION_NIVEL_BROTLI'] = int(os.getenv('COMPRESION_NIVEL_BROTLI', 4))
+    compresion.init_app(app)
+
+    # Stream SSE de estados de envío
+    app.config['SSE_INTERVALO_SONDEO'] = float(os.getenv('SSE_INTERVALO_SONDEO', 1.0))
+    app.config['SSE_MAX_CONEXIONES'] = int(os.getenv('SSE_MAX_CONEXIONES', 2))
+    app.config['SSE_COLA_MAXIMA'] = int(os.getenv('SSE_COLA_MAXIMA', 10))
+    app.config['SSE_LATIDO'] = int(os.getenv('SSE_LATIDO', 15))
+    app.config['SSE_DURACION_MAXIMA'] = int(os.getenv('SSE_DURACION_MAXIMA', 300))
+    # Segundos que se espera una fila con id menor que aún no se ha confirmado
+    app.config['SSE_VENTANA_HUECOS'] = float(os.getenv('SSE_VENTANA_HUECOS', 30.0))
+    difusor_envios.init_app(app)
+    difusor_eventos_stock.init_app(app)
+
+    # POST /batch: máximo de subpeticiones por lote, hilos por lote en paralelo y tope de hilos de lote por worker
+    app.config['BATCH_MAX_PETICIONES'] = int(os.getenv('BATCH_MAX_PETICIONES', 20))
+    app.config['BATCH_HILOS'] = int(os.getenv('BATCH_HILOS', 4))
+    app.config['BATCH_HILOS_WORKER'] = int(os.getenv('BATCH_HILOS_WORKER', 8))
+
     # Rutas de la API
     api = Api(app)
     api.add_resource(VistaUsuario, '/usuario/<int:id_usuario>')
@@ -87,12 +157,14 @@ def create_app(config_name='default'):
     api.add_resource(VistaFactura, '/factura')
     api.add_resource(VistaDetalleFactura, '/detallefactura', '/detallefactura/<int:id_factura>')
     api.add_resource(VistaEnvio, '/envio')
+    api.add_resource(VistaCheckout, '/checkout')
     api.add_resource(VistaCarritoProducto, '/carrito_producto/<int:id_carrito>')
     api.add_resource(VistaPagoPaypal, '/pago/paypal/<int:id_pago>')
     api.add_resource(VistaPagoTransferencia, '/pago/transferencia/<int:id_pago>')
     api.add_resource(VistaPagoTarjeta, '/pago/tarjeta/<int:id_pago>')
     api.add_resource(VistaFacturas, '/facturas') 
     api.add_resource(VistaAjusteStock, '/productos/<int:id_producto>/ajuste-stock')
+    api.add_resource(VistaAjusteStockMasivo, '/productos/ajuste-stock')
     api.add_resource(VistaHistorialStockProducto, '/productos/<int:id_producto>/historial-stock')
     api.add_resource(VistaHistorialStockGeneral, '/historial-stock')
     api.add_resource(VistaStockProductos, '/stock-productos')
@@ -100,8 +172,42 @@ def create_app(config_name='default'):
     api.add_resource(VistaPedidosUsuario, '/api/mis-pedidos')
     api.add_resource(VistaUltimaFactura, '/factura/ultima')
     api.add_resource(VistaEstadoEnvio, '/api/envios/<int:id_orden>/estado')
+    api.add_resource(VistaStreamEstadoEnvio, '/api/envios/<int:id_orden>/estado/stream')
     api.add_resource(VistaEnviosAdmin, '/api/admin/envios')
     api.add_resource(VistaActualizarEstadoAdmin, '/api/admin/envios/<int:id_envio>/estado')
+    api.add_resource(VistaActualizarEstadoMasivoAdmin, '/api/admin/envios/estado')
     api.add_resource(VistaProductosBajoStock, '/api/productos/bajo-stock')
+    api.add_resource(VistaEventosStock, '/api/admin/eventos-stock')
+    api.add_resource(VistaStreamEventosStock, '/api/admin/eventos-stock/stream')
+    api.add_resource(VistaBatch, '/batch')
+
+    # Catálogo en memoria por columnas para los filtros de /productos (requiere numpy); se carga antes del fork
+    app.config['CATALOGO_COLUMNAR'] = os.getenv('CATALOGO_COLUMNAR', 'false').lower() == 'true'
+    if os.getenv('CATALOGO_MARGEN_CAMBIOS'):
+        app.config['CATALOGO_MARGEN_CAMBIOS'] = float(os.getenv('CATALOGO_MARGEN_CAMBIOS'))
+    if os.getenv('CATALOGO_RECARGA_COMPLETA'):
+        app.config['CATALOGO_RECARGA_COMPLETA'] = float(os.getenv('CATALOGO_RECARGA_COMPLETA'))
+    catalogo_columnar.init_app(app)
+
+    # Tareas programadas (cron): flask --app flaskr archivar-historial-stock
+    app.config['HISTORIAL_STOCK_RETENCION_DIAS'] = int(os.getenv('HISTORIAL_STOCK_RETENCION_DIAS', 90))
+
+    @app.cli.command('archivar-historial-stock')
+    @click.option('--dias', type=int, default=None, help='Días que se conservan en historial_stock')
+    def archivar_historial_stock_comando(dias):
+        """Mueve los ajustes de stock antiguos a historial_stock_archivo"""
+        movidas = archivar_historial_stock(dias if dias is not None else app.config['HISTORIAL_STOCK_RETENCION_DIAS'])
+        click.echo(f"{movidas} ajustes archivados")
+
+    @app.cli.command('foto-stock')
+    def foto_stock_comando():
+        """Guarda el stock actual de todos los productos (programar cada noche)"""
+        fecha = tomar_foto_stock()
+        click.echo(f"Foto de stock guardada: {fecha.isoformat()}")
+
+    @app.cli.command('reparar-contadores-ventas')
+    def reparar_contadores_ventas_comando():
+        """Recalcula unidades_vendidas y ultima_venta desde las facturas"""
+        click.echo(f"{reparar_contadores_ventas()} productos corregidos")
 
     return app
\ No newline at end of file
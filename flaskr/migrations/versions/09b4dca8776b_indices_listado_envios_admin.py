@@ -0,0 +1,30 @@
+"""indices listado envios admin
+
+Revision ID: 09b4dca8776b
+Revises: b27315106b16
+Create Date: 2026-10-19 11:02:17.584310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '09b4dca8776b'
+down_revision = 'b27315106b16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('idx_envio_estado_fecha', 'envio', ['estado_envio', 'fecha_creacion', 'id'], unique=False)
+    op.create_index('idx_envio_ciudad_fecha', 'envio', ['ciudad', 'fecha_creacion', 'id'], unique=False)
+    op.create_index('idx_envio_departamento_fecha', 'envio', ['departamento', 'fecha_creacion', 'id'], unique=False)
+    op.create_index('idx_envio_fecha', 'envio', ['fecha_creacion', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_envio_fecha', table_name='envio')
+    op.drop_index('idx_envio_departamento_fecha', table_name='envio')
+    op.drop_index('idx_envio_ciudad_fecha', table_name='envio')
+    op.drop_index('idx_envio_estado_fecha', table_name='envio')
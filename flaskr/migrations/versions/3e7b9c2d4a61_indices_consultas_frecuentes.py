@@ -0,0 +1,48 @@
+"""indices para las consultas frecuentes
+
+Revision ID: 3e7b9c2d4a61
+Revises: 9a4d2e6c1f58
+Create Date: 2026-10-19 19:40:27.118364
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e7b9c2d4a61'
+down_revision = '9a4d2e6c1f58'
+branch_labels = None
+depends_on = None
+
+
+# (nombre, tabla, columnas); 027249347f0e había eliminado los idx_* originales
+INDICES = [
+    ('idx_carrito_usuario_procesado', 'carrito', ['id_usuario', 'procesado']),
+    ('idx_carrito_producto_carrito_producto', 'carrito_producto', ['id_carrito', 'id_producto']),
+    ('idx_carrito_producto_producto', 'carrito_producto', ['id_producto']),
+    ('idx_producto_categoria_precio', 'producto', ['categoria_id', 'producto_precio']),
+    ('idx_pago_carrito', 'pago', ['id_carrito']),
+    ('idx_pago_fecha', 'pago', ['fecha_pago']),
+    ('idx_factura_pago_fecha', 'factura', ['id_pago', 'factura_fecha']),
+    ('idx_detalle_factura_factura', 'detalle_factura', ['id_factura']),
+    ('idx_detalle_factura_producto', 'detalle_factura', ['id_producto']),
+    ('idx_orden_usuario_fecha', 'orden', ['id_usuario', 'fecha_orden']),
+    ('idx_envio_factura', 'envio', ['id_factura']),
+    ('idx_envio_usuario', 'envio', ['usuario_id']),
+    ('idx_historial_stock_archivo_fecha', 'historial_stock_archivo', ['fecha_ajuste']),
+]
+
+
+def upgrade():
+    # CONCURRENTLY en PostgreSQL para no bloquear las escrituras de tablas en uso; necesita ir fuera de la transacción
+    with op.get_context().autocommit_block():
+        for nombre, tabla, columnas in INDICES:
+            op.create_index(nombre, tabla, columnas, unique=False,
+                            postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for nombre, tabla, _ in reversed(INDICES):
+            op.drop_index(nombre, table_name=tabla, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,41 @@
+"""tokenizacion tarjeta
+
+Revision ID: 4b469b7a4f0e
+Revises: 80e170bdeeb3
+Create Date: 2026-10-19 15:02:41.208733
+
+Las filas existentes conservan su hash PBKDF2 y se siguen verificando con él:
+un hash con sal no se puede convertir a token sin el número original. Las
+tarjetas nuevas se tokenizan en cuanto se configura TARJETA_TOKEN_CLAVES.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b469b7a4f0e'
+down_revision = '80e170bdeeb3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('tarjeta_detalle', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('numero_tarjeta_token', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('token_version', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('ultimos_cuatro', sa.String(length=4), nullable=True))
+        batch_op.alter_column('numero_tarjeta_hash', existing_type=sa.String(length=255), nullable=True)
+        batch_op.alter_column('cvv_hash', existing_type=sa.String(length=255), nullable=True)
+        batch_op.create_index('ix_tarjeta_detalle_numero_tarjeta_token', ['numero_tarjeta_token'], unique=False)
+
+
+def downgrade():
+    # Las filas tokenizadas no tienen hash: hay que borrarlas o migrarlas antes de bajar
+    with op.batch_alter_table('tarjeta_detalle', schema=None) as batch_op:
+        batch_op.drop_index('ix_tarjeta_detalle_numero_tarjeta_token')
+        batch_op.alter_column('cvv_hash', existing_type=sa.String(length=255), nullable=False)
+        batch_op.alter_column('numero_tarjeta_hash', existing_type=sa.String(length=255), nullable=False)
+        batch_op.drop_column('ultimos_cuatro')
+        batch_op.drop_column('token_version')
+        batch_op.drop_column('numero_tarjeta_token')
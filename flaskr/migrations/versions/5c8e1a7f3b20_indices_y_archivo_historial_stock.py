@@ -0,0 +1,51 @@
+"""indices y archivo del historial de stock
+
+Revision ID: 5c8e1a7f3b20
+Revises: fb2156353d53
+Create Date: 2026-10-19 18:12:40.517903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c8e1a7f3b20'
+down_revision = 'fb2156353d53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # La paginación por (fecha_ajuste, id) y el archivado no admiten fechas nulas: las filas
+    # antiguas sin fecha se toman como las más viejas del historial
+    op.execute(
+        "UPDATE historial_stock SET fecha_ajuste = COALESCE("
+        "(SELECT MIN(fecha_ajuste) FROM historial_stock), CURRENT_TIMESTAMP) "
+        "WHERE fecha_ajuste IS NULL"
+    )
+    with op.batch_alter_table('historial_stock') as batch_op:
+        batch_op.alter_column('fecha_ajuste', existing_type=sa.DateTime(), nullable=False)
+
+    op.create_index('idx_historial_stock_producto_fecha', 'historial_stock', ['id_producto', 'fecha_ajuste', 'id'], unique=False)
+    op.create_index('idx_historial_stock_fecha', 'historial_stock', ['fecha_ajuste', 'id'], unique=False)
+
+    op.create_table('historial_stock_archivo',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('id_producto', sa.Integer(), nullable=False),
+    sa.Column('cantidad_ajuste', sa.Integer(), nullable=False),
+    sa.Column('nuevo_stock', sa.Integer(), nullable=False),
+    sa.Column('fecha_ajuste', sa.DateTime(), nullable=False),
+    sa.Column('motivo', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('idx_historial_stock_archivo_producto_fecha', 'historial_stock_archivo', ['id_producto', 'fecha_ajuste', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_historial_stock_archivo_producto_fecha', table_name='historial_stock_archivo')
+    op.drop_table('historial_stock_archivo')
+    op.drop_index('idx_historial_stock_fecha', table_name='historial_stock')
+    op.drop_index('idx_historial_stock_producto_fecha', table_name='historial_stock')
+    with op.batch_alter_table('historial_stock') as batch_op:
+        batch_op.alter_column('fecha_ajuste', existing_type=sa.DateTime(), nullable=True)
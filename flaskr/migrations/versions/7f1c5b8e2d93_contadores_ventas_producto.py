@@ -0,0 +1,37 @@
+"""contadores de ventas por producto
+
+Revision ID: 7f1c5b8e2d93
+Revises: 3e7b9c2d4a61
+Create Date: 2026-10-19 20:14:51.630972
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f1c5b8e2d93'
+down_revision = '3e7b9c2d4a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('producto', sa.Column('unidades_vendidas', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('producto', sa.Column('ultima_venta', sa.DateTime(), nullable=True))
+    # Rellena los contadores con las ventas ya facturadas
+    op.execute("""
+        UPDATE producto SET
+            unidades_vendidas = COALESCE((SELECT SUM(d.cantidad) FROM detalle_factura d
+                                          WHERE d.id_producto = producto.id_producto), 0),
+            ultima_venta = (SELECT MAX(f.factura_fecha) FROM detalle_factura d
+                            JOIN factura f ON f.id_factura = d.id_factura
+                            WHERE d.id_producto = producto.id_producto)
+    """)
+    op.create_index('idx_producto_unidades_vendidas', 'producto', ['unidades_vendidas', 'id_producto'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_producto_unidades_vendidas', table_name='producto')
+    op.drop_column('producto', 'ultima_venta')
+    op.drop_column('producto', 'unidades_vendidas')
@@ -0,0 +1,36 @@
+"""historial envio
+
+Revision ID: 80e170bdeeb3
+Revises: 09b4dca8776b
+Create Date: 2026-10-19 13:26:05.917342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '80e170bdeeb3'
+down_revision = '09b4dca8776b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('historial_envio',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('id_envio', sa.Integer(), nullable=False),
+    sa.Column('estado_anterior', sa.String(length=100), nullable=True),
+    sa.Column('estado_nuevo', sa.String(length=100), nullable=False),
+    sa.Column('fecha_cambio', sa.DateTime(), nullable=False),
+    sa.Column('id_usuario', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['id_envio'], ['envio.id'], ),
+    sa.ForeignKeyConstraint(['id_usuario'], ['usuario.id_usuario'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('idx_historial_envio_envio', 'historial_envio', ['id_envio', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_historial_envio_envio', table_name='historial_envio')
+    op.drop_table('historial_envio')
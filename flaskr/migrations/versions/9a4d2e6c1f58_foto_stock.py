@@ -0,0 +1,29 @@
+"""foto de stock
+
+Revision ID: 9a4d2e6c1f58
+Revises: 5c8e1a7f3b20
+Create Date: 2026-10-19 19:05:12.204381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4d2e6c1f58'
+down_revision = '5c8e1a7f3b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('foto_stock',
+    sa.Column('fecha', sa.DateTime(), nullable=False),
+    sa.Column('id_producto', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('stock', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('fecha', 'id_producto')
+    )
+
+
+def downgrade():
+    op.drop_table('foto_stock')
@@ -0,0 +1,39 @@
+"""un solo carrito abierto por usuario
+
+Revision ID: a7d3f0b9c268
+Revises: f3c8a1d6b247
+Create Date: 2026-10-19 23:41:08.275316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3f0b9c268'
+down_revision = 'f3c8a1d6b247'
+branch_labels = None
+depends_on = None
+
+
+# El carrito abierto que se conserva por usuario (el más antiguo, el que devolvían las consultas)
+CONSERVADOS = "SELECT MIN(id_carrito) FROM carrito WHERE NOT procesado GROUP BY id_usuario"
+
+
+def upgrade():
+    # Duplicados creados por la carrera de obtener_carrito_activo: los vacíos se borran
+    # y los que tienen productos se cierran, para que el índice único se pueda crear
+    op.execute(
+        "DELETE FROM carrito WHERE NOT procesado "
+        f"AND id_carrito NOT IN ({CONSERVADOS}) "
+        "AND NOT EXISTS (SELECT 1 FROM carrito_producto cp WHERE cp.id_carrito = carrito.id_carrito) "
+        "AND NOT EXISTS (SELECT 1 FROM pago p WHERE p.id_carrito = carrito.id_carrito)"
+    )
+    op.execute(f"UPDATE carrito SET procesado = TRUE WHERE NOT procesado AND id_carrito NOT IN ({CONSERVADOS})")
+    op.create_index('uq_carrito_usuario_abierto', 'carrito', ['id_usuario'], unique=True,
+                    postgresql_where=sa.text('NOT procesado'),
+                    sqlite_where=sa.text('NOT procesado'))
+
+
+def downgrade():
+    op.drop_index('uq_carrito_usuario_abierto', table_name='carrito')
@@ -0,0 +1,33 @@
+"""version recurso para etags
+
+Revision ID: b27315106b16
+Revises: 027249347f0e
+Create Date: 2026-10-19 09:12:41.203518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b27315106b16'
+down_revision = '027249347f0e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('version_recurso',
+    sa.Column('nombre', sa.String(length=50), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('fecha_actualizacion', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('nombre')
+    )
+    op.execute(
+        "INSERT INTO version_recurso (nombre, version, fecha_actualizacion) "
+        "VALUES ('catalogo', 1, CURRENT_TIMESTAMP), ('categorias', 1, CURRENT_TIMESTAMP)"
+    )
+
+
+def downgrade():
+    op.drop_table('version_recurso')
@@ -0,0 +1,24 @@
+"""reclamo de correos pendientes
+
+Revision ID: b9e4c1a7d305
+Revises: a7d3f0b9c268
+Create Date: 2026-10-19 23:58:44.610927
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b9e4c1a7d305'
+down_revision = 'a7d3f0b9c268'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('correo_pendiente', sa.Column('fecha_reclamo', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('correo_pendiente', 'fecha_reclamo')
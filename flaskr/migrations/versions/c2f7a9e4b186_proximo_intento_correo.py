@@ -0,0 +1,24 @@
+"""proximo intento de correos pendientes
+
+Revision ID: c2f7a9e4b186
+Revises: b9e4c1a7d305
+Create Date: 2026-10-20 09:14:27.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2f7a9e4b186'
+down_revision = 'b9e4c1a7d305'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('correo_pendiente', sa.Column('proximo_intento', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('correo_pendiente', 'proximo_intento')
@@ -0,0 +1,36 @@
+"""clave foranea de producto a categoria
+
+Revision ID: c4a9e3f1b702
+Revises: 7f1c5b8e2d93
+Create Date: 2026-10-19 20:48:09.402115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a9e3f1b702'
+down_revision = '7f1c5b8e2d93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Los productos con una categoria_id que no existe reciben una categoría con ese id para poder crear la FK
+    op.execute("""
+        INSERT INTO categoria (id_categoria, nombre)
+        SELECT DISTINCT p.categoria_id, 'Categoría ' || p.categoria_id
+        FROM producto p
+        WHERE NOT EXISTS (SELECT 1 FROM categoria c WHERE c.id_categoria = p.categoria_id)
+    """)
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("SELECT setval(pg_get_serial_sequence('categoria', 'id_categoria'), "
+                   "COALESCE((SELECT MAX(id_categoria) FROM categoria), 1))")
+
+    # idx_producto_categoria_precio (categoria_id, producto_precio) ya indexa la FK
+    op.create_foreign_key('producto_categoria_id_fkey', 'producto', 'categoria', ['categoria_id'], ['id_categoria'])
+
+
+def downgrade():
+    op.drop_constraint('producto_categoria_id_fkey', 'producto', type_='foreignkey')
@@ -0,0 +1,36 @@
+"""correo pendiente
+
+Revision ID: d2ea4e7c9b31
+Revises: 4b469b7a4f0e
+Create Date: 2026-10-19 16:10:27.513904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2ea4e7c9b31'
+down_revision = '4b469b7a4f0e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('correo_pendiente',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('tipo', sa.String(length=50), nullable=False),
+    sa.Column('destinatario', sa.String(length=100), nullable=False),
+    sa.Column('datos', sa.JSON(), nullable=False),
+    sa.Column('fecha_creacion', sa.DateTime(), nullable=False),
+    sa.Column('fecha_envio', sa.DateTime(), nullable=True),
+    sa.Column('intentos', sa.Integer(), nullable=False),
+    sa.Column('ultimo_error', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('idx_correo_pendiente_envio', 'correo_pendiente', ['fecha_envio', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_correo_pendiente_envio', table_name='correo_pendiente')
+    op.drop_table('correo_pendiente')
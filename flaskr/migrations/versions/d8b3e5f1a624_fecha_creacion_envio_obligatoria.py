@@ -0,0 +1,33 @@
+"""fecha de creacion de envio obligatoria
+
+Revision ID: d8b3e5f1a624
+Revises: c2f7a9e4b186
+Create Date: 2026-10-20 10:02:51.338410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8b3e5f1a624'
+down_revision = 'c2f7a9e4b186'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # La paginación por (fecha_creacion, id) no admite fechas nulas: los envíos antiguos sin
+    # fecha toman la de su última actualización, o la más antigua de la tabla
+    op.execute(
+        "UPDATE envio SET fecha_creacion = COALESCE(fecha_actualizacion, "
+        "(SELECT MIN(fecha_creacion) FROM envio), CURRENT_TIMESTAMP) "
+        "WHERE fecha_creacion IS NULL"
+    )
+    with op.batch_alter_table('envio') as batch_op:
+        batch_op.alter_column('fecha_creacion', existing_type=sa.DateTime(), nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('envio') as batch_op:
+        batch_op.alter_column('fecha_creacion', existing_type=sa.DateTime(), nullable=True)
@@ -0,0 +1,27 @@
+"""fecha de actualizacion de producto
+
+Revision ID: e6b2d8a4c915
+Revises: c4a9e3f1b702
+Create Date: 2026-10-19 21:22:36.845120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6b2d8a4c915'
+down_revision = 'c4a9e3f1b702'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('producto', sa.Column('fecha_actualizacion', sa.DateTime(), nullable=True))
+    op.execute("UPDATE producto SET fecha_actualizacion = CURRENT_TIMESTAMP")
+    op.create_index('idx_producto_fecha_actualizacion', 'producto', ['fecha_actualizacion'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_producto_fecha_actualizacion', table_name='producto')
+    op.drop_column('producto', 'fecha_actualizacion')
@@ -0,0 +1,30 @@
+"""version de stock separada del catalogo
+
+Revision ID: f3c8a1d6b247
+Revises: e6b2d8a4c915
+Create Date: 2026-10-19 23:05:12.417903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c8a1d6b247'
+down_revision = 'e6b2d8a4c915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # VersionRecurso.incrementar ya no inserta la fila que falte: todas se crean aquí
+    for nombre in ('catalogo', 'categorias', 'stock'):
+        op.execute(
+            "INSERT INTO version_recurso (nombre, version, fecha_actualizacion) "
+            f"SELECT '{nombre}', 1, CURRENT_TIMESTAMP "
+            f"WHERE NOT EXISTS (SELECT 1 FROM version_recurso WHERE nombre = '{nombre}')"
+        )
+
+
+def downgrade():
+    op.execute("DELETE FROM version_recurso WHERE nombre = 'stock'")
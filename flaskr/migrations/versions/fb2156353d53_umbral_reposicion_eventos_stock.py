@@ -0,0 +1,45 @@
+"""umbral de reposicion y eventos de stock
+
+Revision ID: fb2156353d53
+Revises: d2ea4e7c9b31
+Create Date: 2026-10-19 16:48:03.331270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fb2156353d53'
+down_revision = 'd2ea4e7c9b31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('categoria', sa.Column('umbral_reposicion', sa.Integer(), nullable=True))
+    # Los productos existentes toman el umbral fijo que usaba el listado de bajo stock
+    op.add_column('producto', sa.Column('umbral_reposicion', sa.Integer(), nullable=False, server_default='10'))
+    op.create_index('idx_producto_bajo_stock', 'producto', ['producto_stock', 'id_producto'], unique=False,
+                    postgresql_where=sa.text('producto_stock < umbral_reposicion'),
+                    sqlite_where=sa.text('producto_stock < umbral_reposicion'))
+
+    op.create_table('evento_stock',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('id_producto', sa.Integer(), nullable=False),
+    sa.Column('tipo', sa.Enum('stock_bajo', 'stock_repuesto', name='tipo_evento_stock'), nullable=False),
+    sa.Column('stock_anterior', sa.Integer(), nullable=False),
+    sa.Column('stock_nuevo', sa.Integer(), nullable=False),
+    sa.Column('umbral', sa.Integer(), nullable=False),
+    sa.Column('fecha', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['id_producto'], ['producto.id_producto'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('evento_stock')
+    sa.Enum(name='tipo_evento_stock').drop(op.get_bind(), checkfirst=True)
+    op.drop_index('idx_producto_bajo_stock', table_name='producto')
+    op.drop_column('producto', 'umbral_reposicion')
+    op.drop_column('categoria', 'umbral_reposicion')
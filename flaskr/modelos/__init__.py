@@ -1,5 +1,7 @@
-from .modelo import db, Rol, Usuario, Carrito, Categoria, Factura, Orden, Pago, Producto, Envio, DetalleFactura, CarritoProducto, TarjetaDetalle, TransferenciaDetalle, PaypalDetalle, HistorialStock
+from .modelo import db, Rol, Usuario, Carrito, Categoria, Factura, Orden, Pago, Producto, Envio, DetalleFactura, CarritoProducto, TarjetaDetalle, TransferenciaDetalle, PaypalDetalle, HistorialStock, HistorialStockArchivo, FotoStock, VersionRecurso, HistorialEnvio, CorreoPendiente, EventoStock, UMBRAL_REPOSICION_DEFECTO
+from .hashing import pool_hashing, HashingSaturado
+from .tokenizacion import tokenizador_tarjetas
 from .esquemas import  RolSchema, UsuarioSchema, CarritoSchema, CategoriaSchema, CarritoProductoSchema,FacturaSchema, OrdenSchema, PagoSchema, ProductoSchema, EnvioSchema, DetalleFacturaSchema, TransferenciaDetalleSchema, TransferenciaDetalleSchema, PaypalDetalleSchema, HistorialStockSchema
 
-__all__ = ["Rol", "Usuario","Carrito", "HistorialStock", "HistorialStockSchema", "Categoria", "Factura", "Orden", "Pago", "Producto", "Envio", "DetalleFactura", "CarritoProducto","CarritoProductoSchema", "TransferenciaDetalleSchema", "TransferenciaDetalleSchema", "PaypalDetalleSchema",
+__all__ = ["pool_hashing", "HashingSaturado", "tokenizador_tarjetas", "Rol", "Usuario","Carrito", "HistorialStock", "HistorialStockArchivo", "FotoStock", "VersionRecurso", "HistorialEnvio", "CorreoPendiente", "EventoStock", "UMBRAL_REPOSICION_DEFECTO", "HistorialStockSchema", "Categoria", "Factura", "Orden", "Pago", "Producto", "Envio", "DetalleFactura", "CarritoProducto","CarritoProductoSchema", "TransferenciaDetalleSchema", "TransferenciaDetalleSchema", "PaypalDetalleSchema",
            "RolSchema", "UsuarioSchema", "CarritoSchema", "CategoriaSchema", "FacturaSchema", "OrdenSchema", "PagoSchema", "ProductoSchema", "EnvioSchema", "DetalleFacturaSchema"]
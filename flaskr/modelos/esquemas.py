@@ -54,6 +54,7 @@ class TarjetaDetalleSchema(SQLAlchemyAutoSchema):
         model = TarjetaDetalle
         include_fk = True
         load_instance = True
+        exclude = ("numero_tarjeta_token",)
 
     id_tarjeta = fields.Int(dump_only=True)
     id_pago = fields.Int(required=True)
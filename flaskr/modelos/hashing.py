@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturoTimeout
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingSaturado(ServiceUnavailable):
+    description = "El servidor está ocupado procesando contraseñas, intente de nuevo en unos segundos"
+
+
+def _generar(password, metodo):
+    return generate_password_hash(password, method=metodo)
+
+
+class PoolHashing:
+    """
+    Ejecuta el PBKDF2 de las contraseñas en un pool de procesos acotado.
+
+    PBKDF2 es CPU pura y retiene el GIL: hecho en el hilo de la petición, una
+    ráfaga de logins bloquea a los otros hilos del worker (catálogo, carrito).
+    En el pool, el hilo de la petición solo espera el resultado y el resto de
+    hilos sigue atendiendo.
+
+    Si hay más de maximo_pendientes operaciones en vuelo se rechaza al momento
+    con 503 en lugar de encolar sin límite. Una operación cuenta como
+    pendiente hasta que el proceso del pool termina, aunque la petición ya
+    haya respondido 503 por timeout (0 = esperar sin límite). Con procesos=0
+    se calcula en línea (scripts, consola, antes de create_app).
+    """
+
+    def __init__(self):
+        self.metodo = 'pbkdf2:sha256:260000'
+        self.procesos = 0
+        self.maximo_pendientes = 16
+        self.timeout = 10
+        self._lock = threading.Lock()
+        self._pendientes = 0
+        self._pool = None
+        self._pid = None
+
+    def configurar(self, metodo=None, procesos=None, maximo_pendientes=None, timeout=None):
+        with self._lock:
+            self.metodo = self.metodo if metodo is None else metodo
+            self.procesos = self.procesos if procesos is None else procesos
+            self.maximo_pendientes = self.maximo_pendientes if maximo_pendientes is None else maximo_pendientes
+            self.timeout = self.timeout if timeout is None else timeout
+            self._cerrar_pool()
+
+    def generar(self, password):
+        return self._ejecutar(_generar, password, self.metodo)
+
+    def verificar(self, password_hash, password):
+        if not password_hash or password is None:
+            return False
+        return self._ejecutar(check_password_hash, password_hash, password)
+
+    def necesita_rehash(self, password_hash):
+        """True si el hash se generó con otro método o número de iteraciones"""
+        return not password_hash or password_hash.split('$', 1)[0] != self.metodo
+
+    def _ejecutar(self, funcion, *args):
+        if not self.procesos:
+            return funcion(*args)
+
+        with self._lock:
+            if self._pendientes >= self.maximo_pendientes:
+                raise HashingSaturado(retry_after=2)
+            self._pendientes += 1
+            pool = self._obtener_pool()
+        try:
+            futuro = pool.submit(funcion, *args)
+        except Exception:
+            self._liberar()
+            raise
+        # La plaza se libera cuando el proceso termina, no cuando la petición deja de esperar
+        futuro.add_done_callback(self._liberar)
+        try:
+            return futuro.result(timeout=self.timeout or None)
+        except FuturoTimeout:
+            raise HashingSaturado(retry_after=5)
+
+    def _liberar(self, _futuro=None):
+        with self._lock:
+            self._pendientes -= 1
+
+    def _obtener_pool(self):
+        # Cada worker de gunicorn (fork tras --preload) necesita su propio pool
+        if self._pool is None or self._pid != os.getpid():
+            metodos = multiprocessing.get_all_start_methods()
+            contexto = multiprocessing.get_context('forkserver' if 'forkserver' in metodos else 'spawn')
+            self._pool = ProcessPoolExecutor(max_workers=self.procesos, mp_context=contexto)
+            self._pid = os.getpid()
+        return self._pool
+
+    def _cerrar_pool(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(wait=False)
+        self._pool = None
+
+
+pool_hashing = PoolHashing()
@@ -1,6 +1,12 @@
+import os
+import threading
 from datetime import datetime
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
 from werkzeug.security import generate_password_hash, check_password_hash
+from .hashing import pool_hashing
+from .tokenizacion import tokenizador_tarjetas
 
 db = SQLAlchemy()
 
@@ -28,10 +34,14 @@ class Usuario(db.Model):
     def contrasena(self, password):
         if not password.strip():
             raise ValueError("La contraseña no puede estar vacía.")
-        self.contrasena_hash = generate_password_hash(password)
+        self.contrasena_hash = pool_hashing.generar(password)
 
     def verificar_contrasena(self, password):
-        return check_password_hash(self.contrasena_hash, password)
+        return pool_hashing.verificar(self.contrasena_hash, password)
+
+    def necesita_rehash(self):
+        """True si la contraseña se guardó con parámetros de hash distintos a los actuales"""
+        return pool_hashing.necesita_rehash(self.contrasena_hash)
 
 
 class Rol(db.Model):
@@ -51,15 +61,32 @@ class Rol(db.Model):
         self.nombre_rol = nombre_rol
 
 
+# Umbral de reposición de los productos cuya categoría no define uno
+UMBRAL_REPOSICION_DEFECTO = 10
+
+
 class Categoria(db.Model):
     __tablename__ = 'categoria'
 
     id_categoria = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(50), nullable=False)
+    # Umbral que reciben los productos de la categoría (al crearse o al cambiarlo aquí)
+    umbral_reposicion = db.Column(db.Integer)
 
 
 class Producto(db.Model):
     __tablename__ = 'producto'
+    __table_args__ = (
+        # Índice parcial: solo contiene los productos bajo su umbral, que es lo que consulta el panel de admin
+        db.Index('idx_producto_bajo_stock', 'producto_stock', 'id_producto',
+                 postgresql_where=db.text('producto_stock < umbral_reposicion'),
+                 sqlite_where=db.text('producto_stock < umbral_reposicion')),
+        # Catálogo filtrado por categoría y rango/orden de precio; también sirve de índice de la FK categoria_id
+        db.Index('idx_producto_categoria_precio', 'categoria_id', 'producto_precio'),
+        # Catálogo ordenado por popularidad
+        db.Index('idx_producto_unidades_vendidas', 'unidades_vendidas', 'id_producto'),
+        db.Index('idx_producto_fecha_actualizacion', 'fecha_actualizacion'),
+    )
 
     id_producto = db.Column(db.Integer, primary_key=True)
     producto_nombre = db.Column(db.String(100), nullable=False)
@@ -67,7 +94,14 @@ class Producto(db.Model):
     producto_stock = db.Column(db.Integer, nullable=False)
     descripcion = db.Column(db.String(255), nullable=False)
     producto_foto = db.Column(db.String(255), nullable=False)  # Cambiamos a String(255) para URLs más largas
-    categoria_id = db.Column(db.Integer, nullable=False)
+    categoria_id = db.Column(db.Integer, db.ForeignKey('categoria.id_categoria'), nullable=False)
+    umbral_reposicion = db.Column(db.Integer, nullable=False, default=UMBRAL_REPOSICION_DEFECTO,
+                                  server_default=str(UMBRAL_REPOSICION_DEFECTO))
+    # Contadores de ventas desnormalizados: los actualiza cada factura y los repara `flask reparar-contadores-ventas`
+    unidades_vendidas = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    ultima_venta = db.Column(db.DateTime)
+    # También la actualizan los UPDATE masivos (onupdate); el catálogo columnar recarga solo lo cambiado desde aquí
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     carritos = db.relationship('CarritoProducto', back_populates='producto')
     
@@ -97,20 +131,91 @@ class Producto(db.Model):
 
 class HistorialStock(db.Model):
     __tablename__ = 'historial_stock'
+    __table_args__ = (
+        # Historial de un producto y listado general, ambos por (fecha_ajuste, id) DESC
+        db.Index('idx_historial_stock_producto_fecha', 'id_producto', 'fecha_ajuste', 'id'),
+        db.Index('idx_historial_stock_fecha', 'fecha_ajuste', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     id_producto = db.Column(db.Integer, db.ForeignKey('producto.id_producto'), nullable=False)
     stock_anterior = db.Column(db.Integer, nullable=False)
     cantidad_ajuste = db.Column(db.Integer, nullable=False)
     nuevo_stock = db.Column(db.Integer, nullable=False)
-    fecha_ajuste = db.Column(db.DateTime, default=db.func.now())
+    # NOT NULL: la paginación por keyset y el archivado comparan (fecha_ajuste, id).
+    # En UTC de la app, como fecha_pago y las fotos: stock_en_fecha compara las tres
+    fecha_ajuste = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     motivo = db.Column(db.String(255))
     
     producto = db.relationship('Producto', backref='historial_stocks')
 
 
+class HistorialStockArchivo(db.Model):
+    """
+    Ajustes de stock antiguos sacados de historial_stock por el archivado.
+    Conserva el id original y omite stock_anterior (es nuevo_stock - cantidad_ajuste).
+    """
+    __tablename__ = 'historial_stock_archivo'
+    __table_args__ = (
+        db.Index('idx_historial_stock_archivo_producto_fecha', 'id_producto', 'fecha_ajuste', 'id'),
+        db.Index('idx_historial_stock_archivo_fecha', 'fecha_ajuste'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    id_producto = db.Column(db.Integer, nullable=False)
+    cantidad_ajuste = db.Column(db.Integer, nullable=False)
+    nuevo_stock = db.Column(db.Integer, nullable=False)
+    fecha_ajuste = db.Column(db.DateTime, nullable=False)
+    motivo = db.Column(db.String(255))
+
+
+class FotoStock(db.Model):
+    """Stock de cada producto en el momento de la foto; punto de partida para consultar el stock en una fecha pasada"""
+    __tablename__ = 'foto_stock'
+
+    fecha = db.Column(db.DateTime, primary_key=True)
+    id_producto = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    stock = db.Column(db.Integer, nullable=False)
+
+
+class EventoStock(db.Model):
+    """Bandeja de salida de cruces de umbral de reposición, escrita en la misma transacción que el cambio de stock"""
+    __tablename__ = 'evento_stock'
+
+    id = db.Column(db.Integer, primary_key=True)
+    id_producto = db.Column(db.Integer, db.ForeignKey('producto.id_producto'), nullable=False)
+    tipo = db.Column(db.Enum('stock_bajo', 'stock_repuesto', name='tipo_evento_stock'), nullable=False)
+    stock_anterior = db.Column(db.Integer, nullable=False)
+    stock_nuevo = db.Column(db.Integer, nullable=False)
+    umbral = db.Column(db.Integer, nullable=False)
+    fecha = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @staticmethod
+    def tipo_cruce(stock_anterior, stock_nuevo, umbral, umbral_anterior=None):
+        """
+        'stock_bajo' o 'stock_repuesto' si el cambio cruza el umbral, None si no.
+        Con umbral_anterior el cruce también puede venir de cambiar el umbral.
+        """
+        if umbral_anterior is None:
+            umbral_anterior = umbral
+        bajo_antes, bajo_ahora = stock_anterior < umbral_anterior, stock_nuevo < umbral
+        if bajo_ahora and not bajo_antes:
+            return 'stock_bajo'
+        if bajo_antes and not bajo_ahora:
+            return 'stock_repuesto'
+        return None
+
+
 class Carrito(db.Model):
     __tablename__ = 'carrito'
+    __table_args__ = (
+        # Carrito abierto del usuario (filter_by(id_usuario=..., procesado=False))
+        db.Index('idx_carrito_usuario_procesado', 'id_usuario', 'procesado'),
+        # Un solo carrito abierto por usuario (obtener_carrito_activo se apoya en ello)
+        db.Index('uq_carrito_usuario_abierto', 'id_usuario', unique=True,
+                 postgresql_where=db.text('NOT procesado'),
+                 sqlite_where=db.text('NOT procesado')),
+    )
 
     id_carrito = db.Column(db.Integer, primary_key=True)
     id_usuario = db.Column(db.Integer, db.ForeignKey('usuario.id_usuario'), nullable=False)
@@ -124,6 +229,11 @@ class Carrito(db.Model):
 
 class CarritoProducto(db.Model):
     __tablename__ = 'carrito_producto'
+    __table_args__ = (
+        db.Index('idx_carrito_producto_carrito_producto', 'id_carrito', 'id_producto'),
+        # Recomendaciones y reportes que parten del producto
+        db.Index('idx_carrito_producto_producto', 'id_producto'),
+    )
 
     id_carrito_producto = db.Column(db.Integer, primary_key=True)
     id_carrito = db.Column(db.Integer, db.ForeignKey('carrito.id_carrito'), nullable=False)
@@ -136,11 +246,16 @@ class CarritoProducto(db.Model):
 
 class Pago(db.Model):
     __tablename__ = 'pago'
+    __table_args__ = (
+        db.Index('idx_pago_carrito', 'id_carrito'),
+        # Ventas de un periodo (stock en una fecha, reportes)
+        db.Index('idx_pago_fecha', 'fecha_pago'),
+    )
 
     id_pago = db.Column(db.Integer, primary_key=True)
     id_carrito = db.Column(db.Integer, db.ForeignKey('carrito.id_carrito'), nullable=False)
     monto = db.Column(db.Integer, nullable=False)
-    fecha_pago = db.Column(db.DateTime, default=db.func.now())
+    fecha_pago = db.Column(db.DateTime, default=datetime.utcnow)
     metodo_pago = db.Column(db.Enum('tarjeta', 'paypal', 'transferencia', name='metodo_pago'))
     estado = db.Column(db.Enum('pendiente', 'completado', 'rechazado', name='estado_pago'), default='completado')
 
@@ -175,10 +290,15 @@ class TarjetaDetalle(db.Model):
 
     id_tarjeta = db.Column(db.Integer, primary_key=True)
     id_pago = db.Column(db.Integer, db.ForeignKey('pago.id_pago'), unique=True)
-    numero_tarjeta_hash = db.Column(db.String(255), nullable=False)
+    # Modo hash (sin TARJETA_TOKEN_CLAVES): PBKDF2 con sal de número y CVV
+    numero_tarjeta_hash = db.Column(db.String(255))
     nombre_en_tarjeta = db.Column(db.String(100), nullable=False)
-    cvv_hash = db.Column(db.String(255), nullable=False)
+    cvv_hash = db.Column(db.String(255))
     fecha_expiracion = db.Column(db.String(7), nullable=False)
+    # Modo token: HMAC del número con la clave token_version y los últimos 4 dígitos; el CVV no se guarda
+    numero_tarjeta_token = db.Column(db.String(64), index=True)
+    token_version = db.Column(db.Integer)
+    ultimos_cuatro = db.Column(db.String(4))
 
     pago = db.relationship('Pago', backref=db.backref('tarjeta', uselist=False))
 
@@ -188,25 +308,48 @@ class TarjetaDetalle(db.Model):
 
     @numero_tarjeta.setter
     def numero_tarjeta(self, numero):
-        self.numero_tarjeta_hash = generate_password_hash(numero)
+        if tokenizador_tarjetas.activo:
+            self.numero_tarjeta_token, self.token_version = tokenizador_tarjetas.tokenizar(numero)
+            self.ultimos_cuatro = str(numero)[-4:]
+            self.numero_tarjeta_hash = None
+        else:
+            self.numero_tarjeta_hash = generate_password_hash(numero)
 
     def verificar_numero_tarjeta(self, numero):
+        if self.numero_tarjeta_token:
+            return tokenizador_tarjetas.verificar(self.numero_tarjeta_token, self.token_version, numero)
         return check_password_hash(self.numero_tarjeta_hash, numero)
 
+    @classmethod
+    def buscar_por_numero(cls, numero):
+        """Tarjetas tokenizadas con ese número (con cualquier clave vigente); no encuentra filas en modo hash"""
+        if not tokenizador_tarjetas.activo:
+            return []
+        return cls.query.filter(cls.numero_tarjeta_token.in_(tokenizador_tarjetas.tokens_posibles(numero))).all()
+
     @property
     def cvv(self):
         raise AttributeError("El CVV no se puede leer directamente.")
 
     @cvv.setter
     def cvv(self, valor):
-        self.cvv_hash = generate_password_hash(str(valor))  # Convertir a string
+        if tokenizador_tarjetas.activo:
+            # El CVV solo se valida en la petición; no se persiste ni siquiera como hash
+            self.cvv_hash = None
+        else:
+            self.cvv_hash = generate_password_hash(str(valor))  # Convertir a string
 
     def verificar_cvv(self, valor):
+        if not self.cvv_hash:
+            return False
         return check_password_hash(self.cvv_hash, valor)
 
 
 class Factura(db.Model):
     __tablename__ = 'factura'
+    __table_args__ = (
+        db.Index('idx_factura_pago_fecha', 'id_pago', 'factura_fecha'),
+    )
 
     id_factura = db.Column(db.Integer, primary_key=True)
     id_pago = db.Column(db.Integer, db.ForeignKey('pago.id_pago'))
@@ -218,6 +361,10 @@ class Factura(db.Model):
 
 class DetalleFactura(db.Model):
     __tablename__ = 'detalle_factura'
+    __table_args__ = (
+        db.Index('idx_detalle_factura_factura', 'id_factura'),
+        db.Index('idx_detalle_factura_producto', 'id_producto'),
+    )
 
     id_detalle_factura = db.Column(db.Integer, primary_key=True)
     id_factura = db.Column(db.Integer, db.ForeignKey('factura.id_factura'))
@@ -229,6 +376,10 @@ class DetalleFactura(db.Model):
 
 class Orden(db.Model):
     __tablename__ = 'orden'
+    __table_args__ = (
+        # Pedidos del usuario ordenados por fecha
+        db.Index('idx_orden_usuario_fecha', 'id_usuario', 'fecha_orden'),
+    )
 
     id_orden = db.Column(db.Integer, primary_key=True)
     id_usuario = db.Column(db.Integer, db.ForeignKey('usuario.id_usuario'))
@@ -243,6 +394,15 @@ class Orden(db.Model):
 
 class Envio(db.Model):
     __tablename__ = 'envio'
+    __table_args__ = (
+        # Listado de envíos del admin: filtro por igualdad + orden (fecha_creacion, id) DESC
+        db.Index('idx_envio_estado_fecha', 'estado_envio', 'fecha_creacion', 'id'),
+        db.Index('idx_envio_ciudad_fecha', 'ciudad', 'fecha_creacion', 'id'),
+        db.Index('idx_envio_departamento_fecha', 'departamento', 'fecha_creacion', 'id'),
+        db.Index('idx_envio_fecha', 'fecha_creacion', 'id'),
+        db.Index('idx_envio_factura', 'id_factura'),
+        db.Index('idx_envio_usuario', 'usuario_id'),
+    )
     
     ESTADOS_VALIDOS = {
         'Empacando',
@@ -250,6 +410,22 @@ class Envio(db.Model):
         'En Camino a Tu Hogar',
         'Tu Pedido Ya Ha Sido Entregado'
     }
+
+    # Estado actual -> estados a los que puede pasar
+    TRANSICIONES_PERMITIDAS = {
+        'Empacando': {'Validando', 'En Camino a Tu Hogar'},
+        'Validando': {'Empacando', 'En Camino a Tu Hogar'},
+        'En Camino a Tu Hogar': {'Tu Pedido Ya Ha Sido Entregado'},
+        'Tu Pedido Ya Ha Sido Entregado': set()
+    }
+
+    @classmethod
+    def transicion_permitida(cls, estado_actual, nuevo_estado):
+        if estado_actual not in cls.TRANSICIONES_PERMITIDAS:
+            # Envíos antiguos con estados fuera del grafo pueden pasar a cualquier estado válido
+            return nuevo_estado in cls.ESTADOS_VALIDOS
+        return nuevo_estado in cls.TRANSICIONES_PERMITIDAS[estado_actual]
+
     
     id = db.Column(db.Integer, primary_key=True)
     direccion = db.Column(db.String(255), nullable=False)
@@ -258,10 +434,217 @@ class Envio(db.Model):
     codigo_postal = db.Column(db.String(20), nullable=False)
     pais = db.Column(db.String(100), nullable=False)
     estado_envio = db.Column(db.String(100), default="Empacando")
-    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+    # NOT NULL: el listado del admin pagina por keyset sobre (fecha_creacion, id)
+    fecha_creacion = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     fecha_actualizacion = db.Column(db.DateTime)  # Añadir este campo
     
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id_usuario'), nullable=False)
     usuario = db.relationship('Usuario', back_populates='envios')
     id_factura = db.Column(db.Integer, db.ForeignKey('factura.id_factura'), nullable=False)  # Cambiar a nullable=False
-    factura = db.relationship('Factura', backref=db.backref('envios', lazy=True))
\ No newline at end of file
+    factura = db.relationship('Factura', backref=db.backref('envios', lazy=True))
+
+
+class HistorialEnvio(db.Model):
+    """Registro de solo inserción de los cambios de estado de cada envío"""
+    __tablename__ = 'historial_envio'
+    __table_args__ = (
+        db.Index('idx_historial_envio_envio', 'id_envio', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    id_envio = db.Column(db.Integer, db.ForeignKey('envio.id'), nullable=False)
+    estado_anterior = db.Column(db.String(100))
+    estado_nuevo = db.Column(db.String(100), nullable=False)
+    fecha_cambio = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    id_usuario = db.Column(db.Integer, db.ForeignKey('usuario.id_usuario'))
+
+
+class CorreoPendiente(db.Model):
+    """Bandeja de salida: el correo se encola en la transacción de la petición y se renderiza y envía en lote después"""
+    __tablename__ = 'correo_pendiente'
+    __table_args__ = (
+        db.Index('idx_correo_pendiente_envio', 'fecha_envio', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)
+    destinatario = db.Column(db.String(100), nullable=False)
+    datos = db.Column(db.JSON, nullable=False)
+    fecha_creacion = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    fecha_envio = db.Column(db.DateTime)
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    ultimo_error = db.Column(db.String(255))
+    # Reclamado por un despacho en curso; caduca a los CORREO_PLAZO_RECLAMO segundos
+    fecha_reclamo = db.Column(db.DateTime)
+    # No se vuelve a intentar antes (espera exponencial tras un fallo)
+    proximo_intento = db.Column(db.DateTime)
+
+
+# Filas de version_recurso: se crean con la tabla (create_all y migraciones); incrementar nunca inserta
+RECURSOS = ('catalogo', 'categorias', 'stock')
+
+
+class VersionRecurso(db.Model):
+    """
+    Versión de cada recurso cacheable, para los ETag.
+
+    'catalogo' cambia con los datos de los productos que no se mueven con las
+    ventas (nombre, precio, categoría, umbral, altas y bajas). El stock y los
+    contadores de ventas van en 'stock', que no se sube dentro de la
+    transacción de la venta: diferir() la sube después del commit, y como
+    mucho una vez por CATALOGO_VENTANA_STOCK segundos y worker. Así las
+    compras no se serializan en la misma fila ni invalidan el catálogo en
+    cada venta; a cambio, el stock del catálogo puede ir hasta una ventana
+    por detrás.
+    """
+    __tablename__ = 'version_recurso'
+
+    nombre = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    fecha_actualizacion = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def obtener(cls, nombre):
+        """Devuelve (version, fecha_actualizacion) del recurso; (0, None) si nunca se ha escrito"""
+        fila = db.session.query(cls.version, cls.fecha_actualizacion).filter(cls.nombre == nombre).first()
+        if not fila:
+            return 0, None
+        return fila.version, fila.fecha_actualizacion
+
+    @classmethod
+    def obtener_catalogo(cls):
+        """Versión del catálogo público ('catalogo.stock') y la fecha del último cambio de cualquiera de las dos"""
+        filas = {fila.nombre: fila for fila in db.session.query(cls.nombre, cls.version, cls.fecha_actualizacion)
+                 .filter(cls.nombre.in_(('catalogo', 'stock')))}
+        version = '.'.join(str(filas[nombre].version if nombre in filas else 0) for nombre in ('catalogo', 'stock'))
+        return version, max((fila.fecha_actualizacion for fila in filas.values()), default=None)
+
+    @classmethod
+    def incrementar(cls, nombre, conexion=None):
+        """Sube la versión del recurso dentro de la transacción actual"""
+        conexion = conexion or db.session.connection()
+        tabla = cls.__table__
+        conexion.execute(
+            tabla.update()
+            .where(tabla.c.nombre == nombre)
+            .values(version=tabla.c.version + 1, fecha_actualizacion=datetime.utcnow())
+        )
+
+    @staticmethod
+    def diferir(nombre):
+        """Sube la versión después del commit de la sesión, agrupando las de una ventana"""
+        db.session.info.setdefault('versiones_diferidas', set()).add(nombre)
+
+
+@event.listens_for(VersionRecurso.__table__, 'after_create')
+def _crear_filas_version(tabla, conexion, **kwargs):
+    conexion.execute(tabla.insert(), [
+        {'nombre': nombre, 'version': 1, 'fecha_actualizacion': datetime.utcnow()} for nombre in RECURSOS
+    ])
+
+
+# Nombre -> pid del proceso que ya tiene una subida programada
+_versiones_pendientes = {}
+_versiones_lock = threading.Lock()
+
+
+@event.listens_for(db.session, 'after_commit')
+def _programar_versiones_diferidas(session):
+    for nombre in session.info.pop('versiones_diferidas', ()):
+        _programar_version(nombre)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_versiones_diferidas(session):
+    session.info.pop('versiones_diferidas', None)
+
+
+def _programar_version(nombre):
+    app = current_app._get_current_object()
+    ventana = app.config.get('CATALOGO_VENTANA_STOCK', 30)
+    if ventana <= 0:
+        _subir_version(app, nombre)
+        return
+    with _versiones_lock:
+        # Con --preload un temporizador del maestro no existe en el worker
+        if _versiones_pendientes.get(nombre) == os.getpid():
+            return
+        _versiones_pendientes[nombre] = os.getpid()
+    temporizador = threading.Timer(ventana, _subir_version, (app, nombre, True))
+    temporizador.daemon = True
+    temporizador.start()
+
+
+def _subir_version(app, nombre, programada=False):
+    if programada:
+        # Antes de subirla: una venta que confirme a partir de aquí programa otra
+        with _versiones_lock:
+            _versiones_pendientes.pop(nombre, None)
+    try:
+        # Conexión propia y sin contexto de aplicación: no toca la sesión de la petición en curso
+        with db.get_engine(app).begin() as conexion:
+            VersionRecurso.incrementar(nombre, conexion)
+    except Exception:
+        app.logger.exception("No se pudo subir la versión de %s", nombre)
+
+
+# Recursos cacheables (ETag) que cambian cuando se escribe cada modelo
+RECURSOS_VERSIONADOS = {
+    Producto: 'catalogo',
+    Categoria: 'categorias',
+}
+
+# Columnas de Producto que cambian con las ventas: van en la versión diferida 'stock'
+ATRIBUTOS_STOCK = {'producto_stock', 'unidades_vendidas', 'ultima_venta', 'fecha_actualizacion'}
+
+
+@event.listens_for(db.session, 'before_flush')
+def _versionar_recursos(session, flush_context, instances):
+    recursos = set()
+    for objeto in list(session.new) + list(session.deleted):
+        if type(objeto) in RECURSOS_VERSIONADOS:
+            recursos.add(RECURSOS_VERSIONADOS[type(objeto)])
+    for objeto in session.dirty:
+        if type(objeto) not in RECURSOS_VERSIONADOS or not session.is_modified(objeto):
+            continue
+        if isinstance(objeto, Producto):
+            cambiados = {atributo.key for atributo in inspect(objeto).attrs if atributo.history.has_changes()}
+            if cambiados <= ATRIBUTOS_STOCK:
+                VersionRecurso.diferir('stock')
+                continue
+        recursos.add(RECURSOS_VERSIONADOS[type(objeto)])
+
+    if recursos:
+        conexion = session.connection()
+        for nombre in sorted(recursos):
+            VersionRecurso.incrementar(nombre, conexion)
+
+
+@event.listens_for(db.session, 'before_flush')
+def _eventos_umbral_stock(session, flush_context, instances):
+    """Umbral inicial de los productos nuevos y eventos de cruce para los cambios de stock hechos con el ORM"""
+    for objeto in session.new:
+        if isinstance(objeto, Producto) and objeto.umbral_reposicion is None:
+            with session.no_autoflush:
+                umbral = session.query(Categoria.umbral_reposicion)\
+                    .filter(Categoria.id_categoria == objeto.categoria_id).scalar()
+            objeto.umbral_reposicion = umbral if umbral is not None else UMBRAL_REPOSICION_DEFECTO
+
+    for objeto in list(session.dirty):
+        if not isinstance(objeto, Producto):
+            continue
+        estado = inspect(objeto).attrs
+        historial, historial_umbral = estado.producto_stock.history, estado.umbral_reposicion.history
+        cambia_stock = bool(historial.deleted and historial.added)
+        cambia_umbral = bool(historial_umbral.deleted and historial_umbral.added)
+        if not cambia_stock and not cambia_umbral:
+            continue
+        anterior = historial.deleted[0] if cambia_stock else objeto.producto_stock
+        nuevo = objeto.producto_stock
+        umbral_anterior = historial_umbral.deleted[0] if cambia_umbral else objeto.umbral_reposicion
+        if anterior is None or nuevo is None or umbral_anterior is None or objeto.umbral_reposicion is None:
+            continue
+        tipo = EventoStock.tipo_cruce(anterior, nuevo, objeto.umbral_reposicion, umbral_anterior)
+        if tipo:
+            session.add(EventoStock(id_producto=objeto.id_producto, tipo=tipo, stock_anterior=anterior,
+                                    stock_nuevo=nuevo, umbral=objeto.umbral_reposicion))
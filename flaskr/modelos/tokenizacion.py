@@ -0,0 +1,55 @@
+import hashlib
+import hmac
+
+
+class TokenizadorTarjetas:
+    """
+    Tokeniza números de tarjeta con HMAC-SHA256 y una clave del servidor.
+
+    A diferencia del hash PBKDF2 con sal, el token es determinista (permite
+    buscar tarjetas repetidas con un índice) y cuesta microsegundos. Su
+    seguridad depende de la clave, no del coste del hash.
+
+    Las claves se configuran como "version:secreto" separadas por comas
+    (TARJETA_TOKEN_CLAVES). La versión más alta es la activa para nuevas
+    tarjetas; las anteriores se conservan para verificar y buscar filas ya
+    tokenizadas hasta que se retiren. Sin claves el modo token está apagado y
+    se sigue usando el hash de werkzeug.
+    """
+
+    def __init__(self):
+        self.claves = {}
+
+    def configurar(self, claves_config):
+        self.claves = {}
+        for entrada in filter(None, (c.strip() for c in (claves_config or '').split(','))):
+            version, _, secreto = entrada.partition(':')
+            if not version.isdigit() or not secreto:
+                raise ValueError("TARJETA_TOKEN_CLAVES debe tener el formato version:secreto[,version:secreto]")
+            self.claves[int(version)] = secreto.encode('utf-8')
+
+    @property
+    def activo(self):
+        return bool(self.claves)
+
+    @property
+    def version_activa(self):
+        return max(self.claves)
+
+    def tokenizar(self, numero, version=None):
+        """Devuelve (token, version_clave)"""
+        version = self.version_activa if version is None else version
+        token = hmac.new(self.claves[version], str(numero).encode('utf-8'), hashlib.sha256).hexdigest()
+        return token, version
+
+    def tokens_posibles(self, numero):
+        """Token del número con cada clave vigente, para buscar duplicados entre versiones"""
+        return [self.tokenizar(numero, version)[0] for version in self.claves]
+
+    def verificar(self, token, version, numero):
+        if version not in self.claves:
+            return False
+        return hmac.compare_digest(token, self.tokenizar(numero, version)[0])
+
+
+tokenizador_tarjetas = TokenizadorTarjetas()
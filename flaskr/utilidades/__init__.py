@@ -0,0 +1,17 @@
+from .autorizacion import admin_required, es_administrador, rol_vigente, cache_roles, ROL_ADMINISTRADOR
+from .cache_http import calcular_etag, respuesta_condicional
+from .cache_ttl import CacheTTL
+from .compresion import Compresion
+from .exportacion import exportar_consulta, FORMATOS_EXPORTACION
+from .difusor import difusor_envios, difusor_eventos_stock, serializar_evento_stock, formato_sse
+from .limitador import LimitadorTasa, limitador, es_ruta_critica
+from .correos import despachador_correos
+from .mantenimiento import archivar_historial_stock, tomar_foto_stock, stock_en_fecha, reparar_contadores_ventas
+from .catalogo_columnar import CatalogoColumnar, catalogo_columnar
+from .lotes import ejecutar_lote, LoteInvalido
+from .campos import leer_proyeccion, CamposInvalidos
+from .paginacion import leer_limite, paginar_por_fecha, estimar_total, CursorInvalido
+
+__all__ = ["admin_required", "es_administrador", "rol_vigente", "cache_roles", "ROL_ADMINISTRADOR",
+           "calcular_etag", "respuesta_condicional", "CacheTTL", "Compresion", "exportar_consulta", "FORMATOS_EXPORTACION",
+           "difusor_envios", "difusor_eventos_stock", "serializar_evento_stock", "formato_sse", "LimitadorTasa", "limitador", "es_ruta_critica", "despachador_correos", "CatalogoColumnar", "catalogo_columnar", "archivar_historial_stock", "tomar_foto_stock", "stock_en_fecha", "reparar_contadores_ventas", "ejecutar_lote", "LoteInvalido", "leer_proyeccion", "CamposInvalidos", "leer_limite", "paginar_por_fecha", "estimar_total", "CursorInvalido"]
@@ -0,0 +1,52 @@
+from functools import wraps
+from flask_jwt_extended import verify_jwt_in_request, get_jwt, get_jwt_identity
+
+from ..modelos import db, Usuario
+from .cache_ttl import CacheTTL
+
+
+ROL_ADMINISTRADOR = 1
+
+# Rol vigente por usuario. El claim "rol" del token puede quedar desfasado si un
+# admin cambia el rol o borra al usuario; esta caché lo confirma con, como mucho,
+# una consulta por usuario cada ttl segundos.
+cache_roles = CacheTTL(ttl=60)
+
+
+def rol_vigente(id_usuario):
+    """rol_id actual del usuario (None si ya no existe)"""
+    try:
+        id_usuario = int(id_usuario)
+    except (TypeError, ValueError):
+        return None
+    return cache_roles.obtener_o_calcular(
+        id_usuario,
+        lambda: db.session.query(Usuario.rol_id).filter(Usuario.id_usuario == id_usuario).scalar()
+    )
+
+
+def es_administrador():
+    """Debe llamarse con un JWT ya verificado"""
+    rol_token = get_jwt().get('rol')
+    if rol_token is not None and rol_token != ROL_ADMINISTRADOR:
+        return False
+    # Tokens antiguos sin claim, o claim de admin: se confirma con la caché
+    return rol_vigente(get_jwt_identity()) == ROL_ADMINISTRADOR
+
+
+def admin_required(respuesta_denegada=None, locations=None):
+    """
+    Igual que jwt_required() pero además exige rol de administrador, leído del
+    claim "rol" del token en lugar de cargar el Usuario en cada petición.
+    """
+    respuesta_denegada = respuesta_denegada or ({'error': 'Acceso no autorizado'}, 403)
+
+    def decorador(fn):
+        @wraps(fn)
+        def envoltura(*args, **kwargs):
+            verify_jwt_in_request(locations=locations)
+            if not es_administrador():
+                return respuesta_denegada
+            return fn(*args, **kwargs)
+        return envoltura
+    return decorador
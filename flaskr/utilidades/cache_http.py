@@ -0,0 +1,41 @@
+import hashlib
+from flask import request, Response
+from werkzeug.http import http_date
+
+
+def calcular_etag(*partes):
+    """ETag fuerte a partir de las partes que identifican la versión de la respuesta"""
+    contenido = '|'.join(str(parte) for parte in partes)
+    return hashlib.sha1(contenido.encode('utf-8')).hexdigest()
+
+
+def respuesta_condicional(partes_etag, construir, ultima_modificacion=None, cache_control='private, no-cache'):
+    """
+    GET condicional: responde 304 sin construir el cuerpo si el cliente ya tiene
+    la versión actual; si no, llama a construir() -> (datos, estado) y añade
+    ETag, Last-Modified y Cache-Control a la respuesta.
+    """
+    etag = calcular_etag(request.path, request.query_string.decode('utf-8'), *partes_etag)
+
+    cabeceras = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': cache_control,
+    }
+    if ultima_modificacion:
+        cabeceras['Last-Modified'] = http_date(ultima_modificacion)
+
+    # If-None-Match tiene prioridad sobre If-Modified-Since (RFC 7232)
+    if request.if_none_match:
+        no_modificado = request.if_none_match.contains_weak(etag)
+    elif ultima_modificacion and request.if_modified_since:
+        no_modificado = ultima_modificacion.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    else:
+        no_modificado = False
+
+    if no_modificado:
+        return Response(status=304, headers=cabeceras)
+
+    datos, estado = construir()
+    if estado != 200:
+        return datos, estado
+    return datos, estado, cabeceras
@@ -0,0 +1,56 @@
+import threading
+import time
+
+
+_SIN_VALOR = object()
+
+
+class CacheTTL:
+    """Caché en memoria del proceso con caducidad por entrada y tamaño máximo"""
+
+    def __init__(self, ttl=60, maximo=10000):
+        self.ttl = ttl
+        self.maximo = maximo
+        self._datos = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, clave, por_defecto=None):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return por_defecto
+            valor, expira = entrada
+            if expira <= time.monotonic():
+                del self._datos[clave]
+                return por_defecto
+            return valor
+
+    def guardar(self, clave, valor):
+        with self._lock:
+            if len(self._datos) >= self.maximo and clave not in self._datos:
+                self._purgar()
+            self._datos[clave] = (valor, time.monotonic() + self.ttl)
+
+    def obtener_o_calcular(self, clave, calcular):
+        valor = self.obtener(clave, _SIN_VALOR)
+        if valor is _SIN_VALOR:
+            valor = calcular()
+            self.guardar(clave, valor)
+        return valor
+
+    def invalidar(self, clave=None):
+        """Borra una entrada, o toda la caché si no se indica clave"""
+        with self._lock:
+            if clave is None:
+                self._datos.clear()
+            else:
+                self._datos.pop(clave, None)
+
+    def _purgar(self):
+        ahora = time.monotonic()
+        for clave in [c for c, (_, expira) in self._datos.items() if expira <= ahora]:
+            del self._datos[clave]
+        # Si sigue lleno se descarta la mitad más antigua
+        if len(self._datos) >= self.maximo:
+            for clave in sorted(self._datos, key=lambda c: self._datos[c][1])[:self.maximo // 2]:
+                del self._datos[clave]
@@ -0,0 +1,83 @@
+from functools import lru_cache
+from flask import request
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only, selectinload
+
+
+# Nunca se pueden pedir, aunque el esquema los tenga
+CAMPOS_PROHIBIDOS = {'contrasena', 'contrasena_hash'}
+
+
+class CamposInvalidos(ValueError):
+    pass
+
+
+def _leer_lista(nombre):
+    valor = request.args.get(nombre)
+    if valor is None:
+        return None
+    return [campo.strip() for campo in valor.split(',') if campo.strip()]
+
+
+@lru_cache(maxsize=None)
+def _campos_disponibles(esquema_cls, modelo):
+    """(columnas, relaciones) del modelo que el esquema serializa"""
+    mapper = inspect(modelo)
+    columnas, relaciones = [], []
+    for nombre, campo in esquema_cls().dump_fields.items():
+        if nombre in CAMPOS_PROHIBIDOS:
+            continue
+        if nombre in mapper.relationships:
+            relaciones.append(nombre)
+        elif nombre in mapper.column_attrs:
+            columnas.append(nombre)
+    return tuple(columnas), tuple(relaciones)
+
+
+@lru_cache(maxsize=256)
+def _esquema(esquema_cls, only):
+    return esquema_cls(many=True, only=only) if only is not None else esquema_cls(many=True)
+
+
+def _opcion_relacion(modelo, nombre):
+    # El esquema solo emite las claves primarias de la relación
+    relacion = getattr(modelo, nombre)
+    destino = inspect(modelo).relationships[nombre].mapper
+    return selectinload(relacion).load_only(*[getattr(destino.class_, c.key) for c in destino.primary_key])
+
+
+def leer_proyeccion(modelo, esquema_cls):
+    """
+    Lee ?fields= y ?expand= de la petición para un listado de modelo.
+
+    fields: columnas (y relaciones) a devolver, separadas por comas.
+    expand: relaciones a incluir; sin fields ni expand se devuelven todas,
+    como antes. Con cualquiera de los dos, las relaciones no pedidas se omiten.
+
+    Devuelve (opciones, esquema): opciones de carga para query.options(),
+    con load_only sobre las columnas pedidas y selectinload para las
+    relaciones (sin N+1), y un esquema many=True limitado a lo mismo.
+    Lanza CamposInvalidos si se pide algo que el listado no ofrece.
+    """
+    columnas, relaciones = _campos_disponibles(esquema_cls, modelo)
+    campos = _leer_lista('fields')
+    expandir = _leer_lista('expand')
+
+    desconocidos = [c for c in campos or [] if c not in columnas and c not in relaciones]
+    desconocidos += [r for r in expandir or [] if r not in relaciones]
+    if desconocidos:
+        raise CamposInvalidos(f"Campos no válidos: {', '.join(desconocidos)}")
+
+    if campos is None and expandir is None:
+        return [_opcion_relacion(modelo, r) for r in relaciones], _esquema(esquema_cls, None)
+
+    pedidas = set(campos or columnas) | set(expandir or [])
+    columnas = [c for c in columnas if c in pedidas]
+    relaciones = [r for r in relaciones if r in pedidas]
+
+    opciones = [_opcion_relacion(modelo, r) for r in relaciones]
+    if campos is not None:
+        # La clave primaria se carga siempre (identidad de la sesión), aunque no se devuelva
+        clave = [getattr(modelo, c.key) for c in inspect(modelo).primary_key]
+        opciones.append(load_only(*clave, *[getattr(modelo, c) for c in columnas]))
+    return opciones, _esquema(esquema_cls, tuple(columnas + relaciones))
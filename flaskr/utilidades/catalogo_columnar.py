@@ -0,0 +1,237 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:  # numpy es opcional; sin él el catálogo se consulta siempre con SQL
+    np = None
+
+from ..modelos import db, Producto
+
+
+# Solape al pedir los productos cambiados (CATALOGO_MARGEN_CAMBIOS, segundos). fecha_actualizacion
+# la pone el reloj del worker al hacer flush, y la fila solo se ve al confirmar: el margen tiene que
+# cubrir el desfase entre relojes más la transacción de escritura más larga
+MARGEN_CAMBIOS = 120
+
+# Cada cuánto se recarga entero aunque no falte nada (CATALOGO_RECARGA_COMPLETA, segundos): acota
+# lo que dura un cambio que se escapó del margen
+RECARGA_COMPLETA = 900
+
+SEPARADOR = '\x00'
+
+
+class _Columnas:
+    """Foto inmutable del catálogo: los hilos que leen nunca ven una actualización a medias"""
+
+    def __init__(self, ids, precios, stocks, categorias, vendidas, nombres):
+        self.ids = ids
+        self.precios = precios
+        self.stocks = stocks
+        self.categorias = categorias
+        self.vendidas = vendidas
+        self.nombres = nombres
+        # Todos los nombres normalizados en un solo texto; offsets[i] es donde empieza el del producto i
+        self.texto = SEPARADOR.join(nombres) + SEPARADOR
+        longitudes = np.fromiter((len(n) + 1 for n in nombres), dtype=np.int64, count=len(nombres))
+        self.offsets = np.concatenate(([0], np.cumsum(longitudes)[:-1])).astype(np.int64)
+
+
+class CatalogoColumnar:
+    """
+    Catálogo en memoria por columnas (NumPy) para filtrar y ordenar sin SQL.
+
+    Carga id, precio, stock, categoría y unidades vendidas de Producto en
+    arrays, y los nombres normalizados en un único texto con offsets. Los
+    filtros de precio, categoría y stock son máscaras vectorizadas; la
+    búsqueda por nombre recorre el texto con str.find y convierte cada
+    posición en fila con searchsorted sobre los offsets.
+
+    Con gunicorn --preload se carga en el maestro antes del fork y los
+    workers comparten las páginas (copy-on-write) hasta que se actualizan.
+
+    Cada consulta recibe la versión del catálogo; si cambió, se piden solo
+    los productos con fecha_actualizacion posterior a la última vista menos
+    CATALOGO_MARGEN_CAMBIOS y se parchean las columnas (copias nuevas, así
+    que los lectores en curso no se ven afectados). Si desaparecieron
+    productos, o pasaron CATALOGO_RECARGA_COMPLETA segundos desde la última
+    carga entera, se recarga todo.
+
+    La precarga abre conexiones en el maestro; se cierran (session.remove y
+    engine.dispose) antes del fork para que ningún worker herede un socket
+    compartido con los demás.
+
+    Configuración (app.config):
+        CATALOGO_COLUMNAR           activa el motor (requiere numpy)
+        CATALOGO_MARGEN_CAMBIOS     solape de la carga incremental, en segundos
+        CATALOGO_RECARGA_COMPLETA   periodo de la recarga completa, en segundos
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._columnas = None
+        self._version = None
+        self._marca = None
+        self._cargado = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CATALOGO_COLUMNAR', False)
+        app.config.setdefault('CATALOGO_MARGEN_CAMBIOS', MARGEN_CAMBIOS)
+        app.config.setdefault('CATALOGO_RECARGA_COMPLETA', RECARGA_COMPLETA)
+        self.app = app
+        if not self.activo:
+            return
+        with app.app_context():
+            try:
+                self.cargar()
+            except Exception:
+                # Sin tablas todavía (migraciones); se cargará en la primera consulta
+                app.logger.warning("No se pudo precargar el catálogo columnar", exc_info=True)
+                db.session.rollback()
+            finally:
+                # Con --preload esto corre en el maestro: los workers no deben heredar sus conexiones
+                db.session.remove()
+                db.engine.dispose()
+
+    @property
+    def activo(self):
+        return np is not None and self.app is not None and bool(self.app.config.get('CATALOGO_COLUMNAR'))
+
+    def reiniciar(self):
+        """Descarta el catálogo cargado; la próxima consulta lo vuelve a leer entero"""
+        with self._lock:
+            self._columnas = None
+            self._version = None
+
+    def cargar(self, version=None):
+        """Carga completa del catálogo"""
+        filas = self._consulta().order_by(Producto.id_producto).all()
+        self._columnas = self._construir(filas)
+        self._marca = max((f.fecha_actualizacion for f in filas if f.fecha_actualizacion), default=datetime.utcnow())
+        self._version = version
+        self._cargado = time.monotonic()
+
+    def _vigente(self, version):
+        return self._columnas is not None and version == self._version
+
+    def sincronizar(self, version):
+        if self._vigente(version):
+            return
+        with self._lock:
+            if self._vigente(version):
+                return
+            if self._columnas is None or \
+                    time.monotonic() - self._cargado > self.app.config['CATALOGO_RECARGA_COMPLETA']:
+                self.cargar(version)
+            else:
+                self._actualizar(version)
+
+    def filtrar(self, version, q=None, precio_min=None, precio_max=None, categoria=None,
+                solo_en_stock=False, orden=None):
+        """Ids de los productos que cumplen los filtros, en el orden pedido; None si el motor no está activo"""
+        if not self.activo:
+            return None
+        self.sincronizar(version)
+        c = self._columnas
+
+        mascara = np.ones(len(c.ids), dtype=bool)
+        if precio_min is not None:
+            mascara &= c.precios >= precio_min
+        if precio_max is not None:
+            mascara &= c.precios <= precio_max
+        if categoria is not None:
+            mascara &= c.categorias == categoria
+        if solo_en_stock:
+            mascara &= c.stocks > 0
+        if q:
+            mascara &= self._coincidencias(c, q)
+
+        filas = np.flatnonzero(mascara)
+        if orden == 'populares':
+            # Igual que SQL: unidades vendidas DESC, id DESC
+            filas = filas[np.lexsort((-c.ids[filas], -c.vendidas[filas]))]
+        return c.ids[filas].tolist()
+
+    def _coincidencias(self, c, q):
+        patron = self._normalizar(q)
+        posiciones = []
+        inicio = c.texto.find(patron)
+        while inicio != -1:
+            posiciones.append(inicio)
+            inicio = c.texto.find(patron, inicio + 1)
+        mascara = np.zeros(len(c.ids), dtype=bool)
+        if posiciones:
+            mascara[np.searchsorted(c.offsets, np.array(posiciones, dtype=np.int64), side='right') - 1] = True
+        return mascara
+
+    def _actualizar(self, version):
+        anterior = self._columnas
+        margen = timedelta(seconds=self.app.config['CATALOGO_MARGEN_CAMBIOS'])
+        cambios = self._consulta().filter(Producto.fecha_actualizacion >= self._marca - margen).all()
+        total = db.session.query(db.func.count(Producto.id_producto)).scalar()
+
+        ids = anterior.ids.copy()
+        columnas = [anterior.precios.copy(), anterior.stocks.copy(), anterior.categorias.copy(), anterior.vendidas.copy()]
+        nombres = list(anterior.nombres)
+        nuevos = []
+        for fila in cambios:
+            posicion = np.searchsorted(ids, fila.id_producto)
+            if posicion < len(ids) and ids[posicion] == fila.id_producto:
+                for columna, valor in zip(columnas, self._valores(fila)):
+                    columna[posicion] = valor
+                nombres[posicion] = self._normalizar(fila.producto_nombre)
+            else:
+                nuevos.append(fila)
+
+        if len(ids) + len(nuevos) != total:
+            # Se borraron productos: no hay marca que lo diga, se recarga todo
+            self.cargar(version)
+            return
+
+        if nuevos:
+            nuevos.sort(key=lambda f: f.id_producto)
+            ids = np.concatenate((ids, [f.id_producto for f in nuevos]))
+            columnas = [np.concatenate((columna, [self._valores(f)[i] for f in nuevos]))
+                        for i, columna in enumerate(columnas)]
+            nombres += [self._normalizar(f.producto_nombre) for f in nuevos]
+            orden = np.argsort(ids, kind='stable')
+            ids = ids[orden]
+            columnas = [columna[orden] for columna in columnas]
+            nombres = [nombres[i] for i in orden]
+
+        self._columnas = _Columnas(ids, *columnas, nombres)
+        self._marca = max([self._marca] + [f.fecha_actualizacion for f in cambios if f.fecha_actualizacion])
+        self._version = version
+
+    def _construir(self, filas):
+        return _Columnas(
+            np.fromiter((f.id_producto for f in filas), dtype=np.int64, count=len(filas)),
+            np.fromiter((f.producto_precio for f in filas), dtype=np.int64, count=len(filas)),
+            np.fromiter((f.producto_stock for f in filas), dtype=np.int64, count=len(filas)),
+            np.fromiter((f.categoria_id for f in filas), dtype=np.int64, count=len(filas)),
+            np.fromiter((f.unidades_vendidas or 0 for f in filas), dtype=np.int64, count=len(filas)),
+            [self._normalizar(f.producto_nombre) for f in filas]
+        )
+
+    @staticmethod
+    def _consulta():
+        return db.session.query(
+            Producto.id_producto, Producto.producto_nombre, Producto.producto_precio, Producto.producto_stock,
+            Producto.categoria_id, Producto.unidades_vendidas, Producto.fecha_actualizacion
+        )
+
+    @staticmethod
+    def _valores(fila):
+        return fila.producto_precio, fila.producto_stock, fila.categoria_id, fila.unidades_vendidas or 0
+
+    @staticmethod
+    def _normalizar(texto):
+        # Como ILIKE: sin distinguir mayúsculas; el separador no puede aparecer dentro de un nombre
+        return (texto or '').lower().replace(SEPARADOR, ' ')
+
+
+catalogo_columnar = CatalogoColumnar()
@@ -0,0 +1,132 @@
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional; sin él solo se ofrece gzip
+    brotli = None
+
+
+TIPOS_COMPRIMIBLES = {
+    'application/json',
+    'application/x-ndjson',
+    'text/csv',
+    'text/html',
+    'text/plain',
+}
+
+
+class Compresion:
+    """
+    Comprime las respuestas con brotli o gzip según Accept-Encoding.
+
+    Configuración (app.config):
+        COMPRESION_TAMANO_MINIMO   bytes mínimos para comprimir una respuesta normal
+        COMPRESION_NIVEL_GZIP      nivel zlib (1-9)
+        COMPRESION_NIVEL_BROTLI    calidad brotli (0-11)
+        COMPRESION_TIPOS           mimetypes que se comprimen
+
+    Las respuestas en streaming se comprimen trozo a trozo sin cargarlas en memoria.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESION_TAMANO_MINIMO', 500)
+        app.config.setdefault('COMPRESION_NIVEL_GZIP', 6)
+        app.config.setdefault('COMPRESION_NIVEL_BROTLI', 4)
+        app.config.setdefault('COMPRESION_TIPOS', TIPOS_COMPRIMIBLES)
+        self.config = app.config
+        app.after_request(self.comprimir_respuesta)
+
+    def codificaciones_disponibles(self):
+        return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    def elegir_codificacion(self):
+        return request.accept_encodings.best_match(self.codificaciones_disponibles())
+
+    def nuevo_compresor(self, codificacion):
+        if codificacion == 'br':
+            return _CompresorBrotli(self.config['COMPRESION_NIVEL_BROTLI'])
+        return _CompresorGzip(self.config['COMPRESION_NIVEL_GZIP'])
+
+    def comprimir_respuesta(self, response):
+        if response.mimetype not in self.config['COMPRESION_TIPOS']:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        codificacion = self.elegir_codificacion()
+
+        if response.status_code == 304:
+            # El 304 debe anunciar el mismo ETag (débil) que la representación comprimida
+            if codificacion:
+                _debilitar_etag(response)
+            return response
+
+        if (not codificacion
+                or response.status_code < 200
+                or response.status_code == 204
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        if response.is_streamed:
+            compresor = self.nuevo_compresor(codificacion)
+            response.response = _comprimir_stream(response.response, compresor)
+            response.headers.pop('Content-Length', None)
+        else:
+            datos = response.get_data()
+            if len(datos) < self.config['COMPRESION_TAMANO_MINIMO']:
+                return response
+            compresor = self.nuevo_compresor(codificacion)
+            response.set_data(compresor.comprimir(datos) + compresor.terminar())
+
+        response.headers['Content-Encoding'] = codificacion
+        _debilitar_etag(response)
+        return response
+
+
+class _CompresorGzip:
+    def __init__(self, nivel):
+        # wbits=31 produce el formato gzip (cabecera + crc)
+        self._compresor = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+
+    def comprimir(self, datos):
+        return self._compresor.compress(datos)
+
+    def terminar(self):
+        return self._compresor.flush()
+
+
+class _CompresorBrotli:
+    def __init__(self, calidad):
+        self._compresor = brotli.Compressor(quality=calidad)
+
+    def comprimir(self, datos):
+        return self._compresor.process(datos)
+
+    def terminar(self):
+        return self._compresor.finish()
+
+
+def _comprimir_stream(trozos, compresor):
+    try:
+        for trozo in trozos:
+            if isinstance(trozo, str):
+                trozo = trozo.encode('utf-8')
+            datos = compresor.comprimir(trozo)
+            if datos:
+                yield datos
+        yield compresor.terminar()
+    finally:
+        if hasattr(trozos, 'close'):
+            trozos.close()
+
+
+def _debilitar_etag(response):
+    """Un ETag fuerte identifica bytes exactos; tras comprimir pasa a ser débil"""
+    etag, debil = response.get_etag()
+    if etag and not debil:
+        response.set_etag(etag, weak=True)
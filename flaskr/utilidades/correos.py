@@ -0,0 +1,214 @@
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from flask_mail import Message
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import or_
+
+from ..modelos import db, CorreoPendiente, DetalleFactura, Producto
+
+
+REMITENTE = 'dilanf1506@gmail.com'
+
+# tipo -> (plantilla, asunto)
+PLANTILLAS = {
+    'factura': ('factura_email.html', 'Factura de Compra - PHPhone'),
+}
+
+
+class DespachadorCorreos:
+    """
+    Renderiza y envía en lote los correos encolados en correo_pendiente.
+
+    La petición solo inserta una fila con datos planos (sin objetos ORM) en su
+    misma transacción; el renderizado y el SMTP salen del camino de la
+    petición. Cada pasada toma hasta CORREO_LOTE correos, carga los detalles
+    de todas sus facturas en una sola consulta, renderiza con la plantilla ya
+    compilada y los envía por una única conexión SMTP.
+
+    Las plantillas se compilan una vez al arrancar (antes del fork con
+    --preload) y el bytecode se guarda en JINJA_CACHE_DIR, así que los
+    reinicios tampoco recompilan.
+
+    Un hilo por worker despacha cada CORREO_INTERVALO_DESPACHO segundos o al
+    llamar a despertar() tras el commit. Las filas se reclaman (fecha_reclamo,
+    con FOR UPDATE SKIP LOCKED en PostgreSQL) y se confirma antes de hablar
+    con el SMTP, así que ningún bloqueo queda abierto durante el envío y los
+    dos workers no envían el mismo correo. Un reclamo de un worker que murió
+    a mitad de envío caduca a los CORREO_PLAZO_RECLAMO segundos y el correo se
+    reintenta (puede llegar dos veces, nunca ninguna).
+
+    Un correo que falla al renderizar o al enviarse gasta un intento y no se
+    vuelve a tomar hasta proximo_intento, con espera exponencial desde
+    CORREO_REINTENTO_BASE hasta CORREO_REINTENTO_MAXIMO segundos; tras
+    CORREO_MAX_INTENTOS se deja de reintentar. Si no se puede conectar al
+    SMTP no se gastan intentos: el lote se aplaza con la misma espera,
+    creciendo con cada caída seguida, y la pasada termina.
+    """
+
+    def __init__(self, app=None, mail=None):
+        self.app = None
+        self._reiniciar_estado()
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail):
+        app.config.setdefault('CORREO_DESPACHO_AUTOMATICO', True)
+        app.config.setdefault('CORREO_INTERVALO_DESPACHO', 5.0)
+        app.config.setdefault('CORREO_LOTE', 50)
+        app.config.setdefault('CORREO_MAX_INTENTOS', 5)
+        app.config.setdefault('CORREO_PLAZO_RECLAMO', 300)
+        app.config.setdefault('CORREO_REINTENTO_BASE', 30)
+        app.config.setdefault('CORREO_REINTENTO_MAXIMO', 3600)
+        app.config.setdefault('JINJA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'phphone-jinja'))
+        self.app = app
+        self.mail = mail
+
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])
+        self.plantillas = {tipo: app.jinja_env.get_template(plantilla) for tipo, (plantilla, _) in PLANTILLAS.items()}
+
+    def _reiniciar_estado(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._evento = threading.Event()
+        self._hilo = None
+        self._fallos_conexion = 0
+
+    def encolar_factura(self, destinatario, id_factura, factura_fecha, total):
+        """Añade el correo de la factura a la sesión; se envía cuando el llamador confirme la transacción"""
+        db.session.add(CorreoPendiente(
+            tipo='factura',
+            destinatario=destinatario,
+            datos={'factura_id': id_factura, 'factura_fecha': factura_fecha, 'total': total}
+        ))
+
+    def despertar(self):
+        """Pide una pasada inmediata (llamar después del commit)"""
+        if not self.app.config['CORREO_DESPACHO_AUTOMATICO']:
+            return
+        # Con --preload el hilo del maestro no existe en el worker
+        if os.getpid() != self._pid:
+            self._reiniciar_estado()
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, name='despachador-correos', daemon=True)
+                self._hilo.start()
+        self._evento.set()
+
+    def _bucle(self):
+        while True:
+            self._evento.wait(self.app.config['CORREO_INTERVALO_DESPACHO'])
+            self._evento.clear()
+            try:
+                with self.app.app_context():
+                    while self.despachar_pendientes() == self.app.config['CORREO_LOTE']:
+                        pass
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception("Error despachando correos pendientes")
+
+    def despachar_pendientes(self):
+        """
+        Una pasada: reclama, renderiza y envía un lote. Devuelve cuántos correos se
+        procesaron; 0 si no se pudo conectar al SMTP, para que el bucle no insista.
+        """
+        ahora = datetime.utcnow()
+        vencido = ahora - timedelta(seconds=self.app.config['CORREO_PLAZO_RECLAMO'])
+        pendientes = CorreoPendiente.query\
+            .filter(CorreoPendiente.fecha_envio.is_(None),
+                    CorreoPendiente.intentos < self.app.config['CORREO_MAX_INTENTOS'],
+                    or_(CorreoPendiente.proximo_intento.is_(None), CorreoPendiente.proximo_intento <= ahora),
+                    or_(CorreoPendiente.fecha_reclamo.is_(None), CorreoPendiente.fecha_reclamo < vencido))\
+            .order_by(CorreoPendiente.id)\
+            .limit(self.app.config['CORREO_LOTE'])\
+            .with_for_update(skip_locked=True)\
+            .all()
+        if not pendientes:
+            db.session.commit()
+            return 0
+
+        # 1. Renderizar y reclamar; un correo que no se puede renderizar falla solo, sin frenar la cola
+        mensajes = {}
+        for pendiente, mensaje in zip(pendientes, self._renderizar(pendientes)):
+            if isinstance(mensaje, Exception):
+                self._registrar_fallo(pendiente, mensaje, ahora)
+                continue
+            mensajes[pendiente.id] = mensaje
+            pendiente.fecha_reclamo = ahora
+        db.session.commit()  # el SMTP no se hace con los bloqueos de la transacción abiertos
+
+        # 2. Enviar fuera de la transacción
+        resultados = {}
+        error_conexion = None
+        try:
+            with self.mail.connect() as conexion:
+                for id_correo, mensaje in mensajes.items():
+                    try:
+                        conexion.send(mensaje)
+                        resultados[id_correo] = None
+                    except Exception as e:
+                        resultados[id_correo] = e
+        except Exception as e:
+            # Caída del servidor, no de cada correo: no gasta intentos, se espera antes de volver
+            error_conexion = e
+            self._fallos_conexion += 1
+            self.app.logger.warning("No se pudo conectar al servidor de correo: %s", e)
+        else:
+            self._fallos_conexion = 0
+
+        # 3. Registrar el resultado y liberar el reclamo
+        enviado = datetime.utcnow()
+        for pendiente in CorreoPendiente.query.filter(CorreoPendiente.id.in_(list(mensajes))):
+            pendiente.fecha_reclamo = None
+            if pendiente.id not in resultados:
+                pendiente.ultimo_error = str(error_conexion)[:255]
+                pendiente.proximo_intento = enviado + self._espera(self._fallos_conexion)
+            elif resultados[pendiente.id] is None:
+                pendiente.fecha_envio = enviado
+            else:
+                self._registrar_fallo(pendiente, resultados[pendiente.id], enviado)
+        db.session.commit()
+        return 0 if error_conexion is not None else len(pendientes)
+
+    def _registrar_fallo(self, pendiente, error, ahora):
+        pendiente.intentos += 1
+        pendiente.ultimo_error = str(error)[:255]
+        pendiente.proximo_intento = ahora + self._espera(pendiente.intentos)
+
+    def _espera(self, fallos):
+        """Espera exponencial tras `fallos` fallos seguidos: base, 2·base, 4·base... hasta el máximo"""
+        segundos = self.app.config['CORREO_REINTENTO_BASE'] * 2 ** max(0, fallos - 1)
+        return timedelta(seconds=min(segundos, self.app.config['CORREO_REINTENTO_MAXIMO']))
+
+    def _renderizar(self, pendientes):
+        """Un Message por correo, o la excepción con la que falló su renderizado"""
+        ids_factura = [p.datos.get('factura_id') for p in pendientes if p.tipo == 'factura' and isinstance(p.datos, dict)]
+        detalles = {}
+        for linea in db.session.query(
+            DetalleFactura.id_factura, Producto.producto_nombre, DetalleFactura.cantidad, DetalleFactura.precio_unitario
+        ).join(Producto, Producto.id_producto == DetalleFactura.id_producto)\
+                .filter(DetalleFactura.id_factura.in_(ids_factura))\
+                .order_by(DetalleFactura.id_factura, DetalleFactura.id_detalle_factura):
+            detalles.setdefault(linea.id_factura, []).append({
+                'producto_nombre': linea.producto_nombre,
+                'cantidad': linea.cantidad,
+                'precio_unitario': linea.precio_unitario,
+            })
+
+        mensajes = []
+        for pendiente in pendientes:
+            try:
+                _, asunto = PLANTILLAS[pendiente.tipo]
+                mensaje = Message(asunto, sender=REMITENTE, recipients=[pendiente.destinatario])
+                mensaje.html = self.plantillas[pendiente.tipo].render(
+                    detalles=detalles.get(pendiente.datos['factura_id'], []), **pendiente.datos
+                )
+            except Exception as e:
+                self.app.logger.exception("No se pudo renderizar el correo pendiente %s", pendiente.id)
+                mensaje = e
+            mensajes.append(mensaje)
+        return mensajes
+
+despachador_correos = DespachadorCorreos()
@@ -0,0 +1,194 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from ..modelos import db, HistorialEnvio, EventoStock
+
+
+# Huecos de la secuencia que se siguen esperando como máximo
+MAXIMO_HUECOS = 1000
+
+
+class DifusorTabla:
+    """
+    Pub/sub en proceso sobre una tabla de solo inserción.
+
+    Un único hilo por worker sondea la tabla (id > último visto) y reparte las
+    filas nuevas a las colas de los clientes suscritos a su canal (el valor de
+    columna_canal, o None si todos reciben todo), así que el coste en base de
+    datos es una consulta por intervalo y worker, no una por cliente. Como la
+    tabla es compartida, una fila escrita en cualquier worker de gunicorn
+    llega a los suscriptores de todos.
+
+    El orden de la secuencia no es el orden de commit: una fila con id menor
+    puede confirmarse después de otra con id mayor. Los ids que faltan por
+    debajo del último visto se guardan como huecos y se vuelven a consultar
+    durante SSE_VENTANA_HUECOS segundos; pasado ese plazo se dan por
+    perdidos (transacción deshecha o id descartado por la secuencia).
+
+    Cada conexión tiene una cola acotada (SSE_COLA_MAXIMA): si el cliente no
+    consume, se descarta el evento más antiguo. SSE_MAX_CONEXIONES limita las
+    conexiones abiertas por worker, porque con el worker gthread cada stream
+    ocupa uno de sus hilos.
+    """
+
+    def __init__(self, modelo, serializar, columna_canal=None, nombre='difusor', app=None):
+        self.modelo = modelo
+        self.serializar = serializar
+        self.columna_canal = columna_canal
+        self.nombre = nombre
+        self.app = None
+        self._reiniciar_estado()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SSE_INTERVALO_SONDEO', 1.0)
+        app.config.setdefault('SSE_COLA_MAXIMA', 10)
+        app.config.setdefault('SSE_MAX_CONEXIONES', 2)
+        app.config.setdefault('SSE_VENTANA_HUECOS', 30.0)
+        self.app = app
+
+    def _reiniciar_estado(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._suscriptores = {}
+        self._conexiones = 0
+        self._hilo = None
+        self._ultimo_id = None
+        self._huecos = {}  # id sin confirmar todavía -> instante (monotonic) en que se deja de esperar
+
+    def _comprobar_fork(self):
+        # Con --preload el proceso maestro importa la app antes de hacer fork;
+        # los hilos y locks heredados no sirven en el worker
+        if os.getpid() != self._pid:
+            self._reiniciar_estado()
+
+    def suscribir(self, canal=None):
+        """Devuelve una cola con las filas nuevas del canal, o None si no quedan conexiones libres"""
+        self._comprobar_fork()
+        with self._lock:
+            if self._conexiones >= self.app.config['SSE_MAX_CONEXIONES']:
+                return None
+            self._conexiones += 1
+            cola = queue.Queue(maxsize=self.app.config['SSE_COLA_MAXIMA'])
+            self._suscriptores.setdefault(canal, set()).add(cola)
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._sondear, name=self.nombre, daemon=True)
+                self._hilo.start()
+        return cola
+
+    def desuscribir(self, canal, cola):
+        with self._lock:
+            colas = self._suscriptores.get(canal)
+            if not colas or cola not in colas:
+                return
+            colas.discard(cola)
+            if not colas:
+                del self._suscriptores[canal]
+            self._conexiones -= 1
+
+    def publicar(self, canal, evento):
+        with self._lock:
+            colas = list(self._suscriptores.get(canal, ()))
+        for cola in colas:
+            try:
+                cola.put_nowait(evento)
+            except queue.Full:
+                # Solo importa el estado más reciente: se descarta el más antiguo
+                try:
+                    cola.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    cola.put_nowait(evento)
+                except queue.Full:
+                    pass
+
+    def _sondear(self):
+        while True:
+            with self._lock:
+                canales = list(self._suscriptores)
+            try:
+                with self.app.app_context():
+                    if self._ultimo_id is None:
+                        self._ultimo_id = db.session.query(db.func.max(self.modelo.id)).scalar() or 0
+                    if canales:
+                        self._repartir_cambios(canales)
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception("Error sondeando %s", self.modelo.__tablename__)
+            time.sleep(self.app.config['SSE_INTERVALO_SONDEO'])
+
+    def _repartir_cambios(self, canales):
+        ahora = time.monotonic()
+        self._huecos = {id_fila: limite for id_fila, limite in self._huecos.items() if limite > ahora}
+
+        # Primero solo ids (y canal) de las filas nuevas y de los huecos pendientes
+        nuevas = self.modelo.id > self._ultimo_id
+        if self._huecos:
+            nuevas = db.or_(nuevas, self.modelo.id.in_(list(self._huecos)))
+        columnas = [self.modelo.id] + ([self.columna_canal] if self.columna_canal is not None else [])
+        visibles = db.session.query(*columnas).filter(nuevas).order_by(self.modelo.id).all()
+        if not visibles:
+            return
+
+        anterior = self._ultimo_id
+        for visible in visibles:
+            self._huecos.pop(visible.id, None)
+        tope = max(anterior, visibles[-1].id)
+        vistos = {visible.id for visible in visibles}
+        limite = ahora + self.app.config['SSE_VENTANA_HUECOS']
+        # Un salto grande de la secuencia (p. ej. tras reiniciar PostgreSQL) no llena la lista de huecos
+        for id_fila in range(max(anterior + 1, tope - MAXIMO_HUECOS), tope):
+            if id_fila not in vistos:
+                self._huecos[id_fila] = limite
+        self._ultimo_id = tope
+
+        ids = [visible.id for visible in visibles
+               if self.columna_canal is None or getattr(visible, self.columna_canal.key) in canales]
+        if not ids:
+            return
+        filas = self.modelo.query.filter(self.modelo.id.in_(ids)).order_by(self.modelo.id).all()
+        for fila in filas:
+            canal = getattr(fila, self.columna_canal.key) if self.columna_canal is not None else None
+            self.publicar(canal, self.serializar(fila))
+
+
+def formato_sse(datos, evento=None, id_evento=None):
+    lineas = []
+    if id_evento is not None:
+        lineas.append(f'id: {id_evento}')
+    if evento:
+        lineas.append(f'event: {evento}')
+    lineas.append(f'data: {json.dumps(datos, ensure_ascii=False)}')
+    return '\n'.join(lineas) + '\n\n'
+
+
+def _serializar_historial_envio(cambio):
+    return {
+        'id': cambio.id,
+        'id_envio': cambio.id_envio,
+        'estado_envio': cambio.estado_nuevo,
+        'fecha': cambio.fecha_cambio.isoformat()
+    }
+
+
+def serializar_evento_stock(evento):
+    return {
+        'id': evento.id,
+        'id_producto': evento.id_producto,
+        'tipo': evento.tipo,
+        'stock_anterior': evento.stock_anterior,
+        'stock_nuevo': evento.stock_nuevo,
+        'umbral': evento.umbral,
+        'fecha': evento.fecha.isoformat()
+    }
+
+
+# Cambios de estado por envío (canal = id_envio)
+difusor_envios = DifusorTabla(HistorialEnvio, _serializar_historial_envio, HistorialEnvio.id_envio, 'difusor-envios')
+# Cruces de umbral de stock para el panel de admin (un solo canal)
+difusor_eventos_stock = DifusorTabla(EventoStock, serializar_evento_stock, nombre='difusor-eventos-stock')
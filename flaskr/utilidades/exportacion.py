@@ -0,0 +1,79 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from flask import Response, stream_with_context
+
+
+FORMATOS_EXPORTACION = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# Filas que se traen del cursor del servidor en cada viaje
+TAMANO_LOTE = 500
+
+
+def exportar_consulta(consulta, formato, nombre_archivo):
+    """
+    Exporta una consulta de columnas (no entidades) como NDJSON o CSV en streaming.
+
+    Las filas se leen con yield_per (cursor del lado del servidor en PostgreSQL) y
+    se escriben lote a lote, así que la memoria del worker no depende del tamaño
+    de la tabla. Se deben pedir columnas y no modelos para que la sesión no vaya
+    acumulando objetos en el identity map.
+    """
+    if formato not in FORMATOS_EXPORTACION:
+        return {"message": f"Formato no soportado. Use: {', '.join(FORMATOS_EXPORTACION)}"}, 400
+
+    columnas = [descripcion['name'] for descripcion in consulta.column_descriptions]
+    filas = consulta.yield_per(TAMANO_LOTE)
+    generador = _lineas_csv(filas, columnas) if formato == 'csv' else _lineas_ndjson(filas, columnas)
+
+    return Response(
+        stream_with_context(generador),
+        mimetype=FORMATOS_EXPORTACION[formato],
+        headers={'Content-Disposition': f'attachment; filename={nombre_archivo}.{formato}'}
+    )
+
+
+def _valor_exportable(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return float(valor)
+    return valor
+
+
+def _lotes(filas):
+    lote = []
+    for fila in filas:
+        lote.append(fila)
+        if len(lote) >= TAMANO_LOTE:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def _lineas_ndjson(filas, columnas):
+    for lote in _lotes(filas):
+        yield ''.join(
+            json.dumps({columna: _valor_exportable(valor) for columna, valor in zip(columnas, fila)},
+                       ensure_ascii=False) + '\n'
+            for fila in lote
+        )
+
+
+def _lineas_csv(filas, columnas):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(columnas)
+    for lote in _lotes(filas):
+        escritor.writerows([_valor_exportable(valor) for valor in fila] for fila in lote)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
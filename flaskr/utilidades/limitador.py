@@ -0,0 +1,314 @@
+import hashlib
+import math
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import request, g
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+
+from .lotes import ENTORNO_SUBPETICION, SECUENCIAL
+
+
+# ruta (o "ruta?parámetro": solo cuando viene ese parámetro) -> (capacidad, tokens por segundo)
+LIMITES_POR_DEFECTO = {
+    '/login': (10, 10 / 60),
+    '/signin': (5, 5 / 60),
+    '/productos?q': (30, 2),
+    '/reportes/productos-mas-vendidos': (5, 1 / 10),
+}
+
+# Se admiten siempre, aunque se haya superado el límite de concurrencia
+RUTAS_CRITICAS = ('/pago', '/factura', '/checkout')
+
+# Buckets por conjunto: una clave solo puede ocupar una de las VIAS ranuras de su conjunto
+VIAS = 4
+
+# Segundos que se espera el lock compartido antes de comprobar si su dueño murió
+TIMEOUT_LOCK = 0.05
+
+
+class LimitadorTasa:
+    """
+    Limita la tasa de los endpoints caros y descarta carga por prioridad.
+
+    Cada ruta de LIMITES_TASA tiene un token bucket por IP y otro por identidad
+    JWT; la petición se rechaza con 429 si cualquiera de los dos está vacío.
+
+    Los buckets viven en memoria compartida (mmap anónimo creado en
+    init_app), en conjuntos de VIAS ranuras: una clave nueva ocupa una ranura
+    libre, o con el bucket ya lleno, o la usada hace más tiempo (LRU), así que
+    el tráfico de otras claves no rellena el bucket de un cliente limitado.
+    Con gunicorn --preload el maestro crea la app antes del fork y los workers
+    heredan la misma memoria, así que los límites son globales; sin --preload
+    son por worker.
+
+    Las peticiones en curso se cuentan en una ranura por worker (su pid), que
+    solo escribe ese worker; el total es la suma. Si gunicorn mata un worker a
+    mitad de petición, child_exit (gunicorn.conf.py) pone su ranura a cero, y
+    una ranura de un pid muerto se reutiliza. El lock de los buckets se pide
+    con timeout: si su dueño murió se libera, y si no se consigue la petición
+    se admite sin limitar en lugar de bloquear el worker.
+
+    Descarte por prioridad: con LIMITE_CONCURRENCIA peticiones en curso entre
+    todos los workers se responde 503 al resto, y las rutas limitadas (baja
+    prioridad) se descartan antes, desde LIMITE_CONCURRENCIA_BAJA. Las rutas
+    de RUTAS_CRITICAS (pago, factura y checkout) se admiten siempre, y por
+    eso no se pueden meter en un /batch. Las subpeticiones de /batch pasan por
+    los buckets de su ruta; las secuenciales no cuentan concurrencia (el lote
+    ya ocupa una plaza y corren de una en una), las paralelas sí, una plaza
+    por hilo.
+
+    Configuración (app.config):
+        LIMITE_TASA_HABILITADO       activa el limitador
+        LIMITES_TASA                 {ruta: (capacidad, tokens por segundo)}
+        LIMITE_CONCURRENCIA          peticiones en curso a partir de las que se descarta (0 = sin descarte)
+        LIMITE_CONCURRENCIA_BAJA     idem para las rutas limitadas
+        LIMITE_PROXIES_CONFIABLES    proxies delante de la app (para tomar la IP de X-Forwarded-For)
+        LIMITE_TASA_RANURAS          número de buckets en memoria compartida
+        LIMITE_MAX_WORKERS           ranuras de concurrencia (workers vivos a la vez)
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LIMITE_TASA_HABILITADO', True)
+        app.config.setdefault('LIMITES_TASA', LIMITES_POR_DEFECTO)
+        app.config.setdefault('LIMITE_CONCURRENCIA', 8)
+        app.config.setdefault('LIMITE_CONCURRENCIA_BAJA', 4)
+        app.config.setdefault('LIMITE_PROXIES_CONFIABLES', 0)
+        app.config.setdefault('LIMITE_TASA_RANURAS', 4096)
+        app.config.setdefault('LIMITE_MAX_WORKERS', 64)
+        self.config = app.config
+        self.logger = app.logger
+        self.limites = {}
+        for ruta, presupuesto in app.config['LIMITES_TASA'].items():
+            ruta, _, parametro = ruta.partition('?')
+            self.limites.setdefault(ruta, []).append((parametro or None, presupuesto))
+
+        ranuras = max(VIAS, app.config['LIMITE_TASA_RANURAS'] // VIAS * VIAS)
+        self._lock = multiprocessing.Lock()
+        self._dueno_lock = multiprocessing.RawValue('q', 0)
+        self._claves = multiprocessing.RawArray('Q', ranuras)
+        self._tokens = multiprocessing.RawArray('d', ranuras)
+        self._actualizado = multiprocessing.RawArray('d', ranuras)
+        self._lleno = multiprocessing.RawArray('d', ranuras)  # instante en que el bucket vuelve a estar lleno
+
+        workers = app.config['LIMITE_MAX_WORKERS']
+        self._pids = multiprocessing.RawArray('q', workers)
+        self._en_curso = multiprocessing.RawArray('i', workers)
+        self._lock_local = threading.Lock()
+        self._ranura_worker = None
+        self._pid_ranura = None
+
+        app.before_request(self.admitir)
+        app.teardown_request(self.liberar)
+
+    def reiniciar(self):
+        with self._bloqueo():
+            for i in range(len(self._claves)):
+                self._claves[i] = 0
+            for i in range(len(self._en_curso)):
+                self._en_curso[i] = 0
+
+    @property
+    def en_curso(self):
+        """Peticiones en curso entre todos los workers"""
+        return sum(self._en_curso)
+
+    def registrar_worker(self):
+        """post_fork de gunicorn: el worker nuevo empieza con su ranura a cero"""
+        self._ranura_worker = None
+        self._lock_local = threading.Lock()
+        ranura = self._mi_ranura()
+        if ranura is not None:
+            self._en_curso[ranura] = 0
+
+    def liberar_worker(self, pid):
+        """child_exit de gunicorn (en el maestro): descarta las peticiones y el lock de un worker muerto"""
+        for i, pid_ranura in enumerate(self._pids):
+            if pid_ranura == pid:
+                self._en_curso[i] = 0
+                self._pids[i] = 0
+        self._liberar_lock_de(pid)
+
+    def admitir(self):
+        if not self.config['LIMITE_TASA_HABILITADO'] or request.method == 'OPTIONS':
+            return None
+
+        presupuesto = self._presupuesto()
+        if presupuesto is not None:
+            espera = self._consumir(self._claves_cliente(), *presupuesto)
+            if espera:
+                return {'mensaje': 'Demasiadas solicitudes, intente de nuevo más tarde'}, 429, \
+                    {'Retry-After': str(math.ceil(espera))}
+
+        if request.environ.get(ENTORNO_SUBPETICION) == SECUENCIAL:
+            return None
+
+        if es_ruta_critica(request.path):
+            tope = None
+        elif presupuesto is not None:
+            tope = self.config['LIMITE_CONCURRENCIA_BAJA']
+        else:
+            tope = self.config['LIMITE_CONCURRENCIA']
+
+        ranura = self._mi_ranura()
+        if ranura is None:
+            return None
+        with self._lock_local:
+            if tope and self.en_curso >= tope:
+                return {'mensaje': 'Servidor ocupado, intente de nuevo en unos segundos'}, 503, {'Retry-After': '2'}
+            self._en_curso[ranura] += 1
+        g.limitador_admitida = ranura
+        return None
+
+    def liberar(self, _excepcion=None):
+        # Las subpeticiones secuenciales comparten g con el lote: la plaza la libera el lote
+        if request.environ.get(ENTORNO_SUBPETICION) == SECUENCIAL:
+            return
+        ranura = g.pop('limitador_admitida', None)
+        if ranura is not None:
+            with self._lock_local:
+                self._en_curso[ranura] = max(0, self._en_curso[ranura] - 1)
+
+    def _mi_ranura(self):
+        """Ranura de concurrencia de este worker; None si no queda ninguna (no se cuenta)"""
+        pid = os.getpid()
+        if self._ranura_worker is not None and self._pid_ranura == pid:
+            return self._ranura_worker
+        with self._bloqueo() as adquirido:
+            if not adquirido:
+                return None
+            libre = None
+            for i, pid_ranura in enumerate(self._pids):
+                if pid_ranura == pid:
+                    libre = i
+                    break
+                if libre is None and (pid_ranura == 0 or not _proceso_vivo(pid_ranura)):
+                    libre = i
+            if libre is None:
+                self.logger.warning("Sin ranuras de concurrencia libres (LIMITE_MAX_WORKERS)")
+                return None
+            if self._pids[libre] != pid:
+                self._pids[libre] = pid
+                self._en_curso[libre] = 0
+        self._ranura_worker, self._pid_ranura = libre, pid
+        return libre
+
+    @contextmanager
+    def _bloqueo(self):
+        """Lock compartido con timeout; entrega False si no se pudo tomar"""
+        adquirido = self._lock.acquire(timeout=TIMEOUT_LOCK)
+        if not adquirido:
+            dueno = self._dueno_lock.value
+            if dueno and not _proceso_vivo(dueno):
+                self._liberar_lock_de(dueno)
+            adquirido = self._lock.acquire(timeout=TIMEOUT_LOCK)
+        if not adquirido:
+            self.logger.warning("Lock del limitador ocupado; se admite la petición sin limitar")
+            yield False
+            return
+        self._dueno_lock.value = os.getpid()
+        try:
+            yield True
+        finally:
+            self._dueno_lock.value = 0
+            self._lock.release()
+
+    def _liberar_lock_de(self, pid):
+        if pid and self._dueno_lock.value == pid:
+            self._dueno_lock.value = 0
+            try:
+                self._lock.release()
+            except ValueError:
+                pass
+
+    def _presupuesto(self):
+        if request.url_rule is None:
+            return None
+        for parametro, presupuesto in self.limites.get(request.url_rule.rule, ()):
+            if parametro is None or request.args.get(parametro):
+                return presupuesto
+        return None
+
+    def _claves_cliente(self):
+        ruta = request.url_rule.rule
+        claves = [f'{ruta}|ip|{self._ip_cliente()}']
+        try:
+            verify_jwt_in_request(optional=True)
+            identidad = get_jwt_identity()
+        except Exception:
+            # Un token inválido se rechaza después en la vista; aquí solo cuenta la IP
+            identidad = None
+        if identidad is not None:
+            claves.append(f'{ruta}|id|{identidad}')
+        return claves
+
+    def _ip_cliente(self):
+        proxies = self.config['LIMITE_PROXIES_CONFIABLES']
+        reenviadas = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+        if proxies and len(reenviadas) >= proxies:
+            return reenviadas[-proxies]
+        return request.remote_addr
+
+    def _consumir(self, claves, capacidad, por_segundo):
+        """Gasta un token de cada bucket; devuelve 0 o los segundos hasta que haya token en todos"""
+        ahora = time.monotonic()
+        with self._bloqueo() as adquirido:
+            if not adquirido:
+                return 0
+            ranuras = []
+            for clave in claves:
+                ranuras.append(self._ranura(clave, ahora, capacidad, excluir=ranuras))
+            disponibles = []
+            for indice in ranuras:
+                transcurrido = ahora - self._actualizado[indice]
+                disponibles.append(min(capacidad, self._tokens[indice] + transcurrido * por_segundo))
+
+            espera = max((1 - tokens) / por_segundo for tokens in disponibles)
+            if espera > 0:
+                return espera
+            for indice, tokens in zip(ranuras, disponibles):
+                self._tokens[indice] = tokens - 1
+                self._actualizado[indice] = ahora
+                self._lleno[indice] = ahora + (capacidad - tokens + 1) / por_segundo
+        return 0
+
+    def _ranura(self, clave, ahora, capacidad, excluir=()):
+        """Ranura del bucket de la clave dentro de su conjunto; si no tiene, la reasigna con el bucket lleno"""
+        huella = int.from_bytes(hashlib.blake2b(clave.encode('utf-8'), digest_size=8).digest(), 'big') or 1
+        inicio = huella % (len(self._claves) // VIAS) * VIAS
+        candidatas = [i for i in range(inicio, inicio + VIAS) if i not in excluir]
+        for indice in candidatas:
+            if self._claves[indice] == huella:
+                return indice
+        # Libre, o con el bucket ya lleno (nada que perder), o la menos usada recientemente
+        indice = next((i for i in candidatas if self._claves[i] == 0 or self._lleno[i] <= ahora), None)
+        if indice is None:
+            indice = min(candidatas, key=lambda i: self._actualizado[i])
+        self._claves[indice] = huella
+        self._tokens[indice] = capacidad
+        self._actualizado[indice] = ahora
+        self._lleno[indice] = ahora
+        return indice
+
+
+def es_ruta_critica(ruta):
+    return any(ruta == critica or ruta.startswith(critica + '/') for critica in RUTAS_CRITICAS)
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+limitador = LimitadorTasa()
@@ -0,0 +1,162 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, request
+from werkzeug.exceptions import HTTPException, MethodNotAllowed
+from werkzeug.test import EnvironBuilder
+
+from ..modelos import db
+
+
+# Marca en el entorno WSGI de las subpeticiones de /batch: 'secuencial' (comparten la plaza del
+# lote en el limitador) o 'paralela' (cada hilo ocupa su propia plaza)
+ENTORNO_SUBPETICION = 'flaskr.subpeticion'
+SECUENCIAL = 'secuencial'
+PARALELA = 'paralela'
+
+# Cabeceras de la petición del lote que heredan todas las subpeticiones
+CABECERAS_HEREDADAS = ('Authorization', 'X-Forwarded-For', 'Accept-Language')
+
+# Cabeceras de la subpetición que se ignoran: las de transporte (hop-by-hop) y las de codificación.
+# El cuerpo de cada resultado va dentro del JSON del lote, que ya se comprime entero
+CABECERAS_DESCARTADAS = {
+    'Accept-Encoding', 'Content-Encoding', 'Content-Length', 'Connection', 'Keep-Alive',
+    'Proxy-Authenticate', 'Proxy-Authorization', 'Te', 'Trailer', 'Trailers', 'Transfer-Encoding', 'Upgrade',
+}
+
+# Cabeceras de cada respuesta que se copian al resultado
+CABECERAS_DEVUELTAS = ('ETag', 'Last-Modified', 'Retry-After', 'Location')
+
+
+class LoteInvalido(ValueError):
+    pass
+
+
+class _CupoHilos:
+    """Hilos de lote en uso en este worker, repartidos entre todos los lotes que corren a la vez"""
+
+    def __init__(self):
+        self._reiniciar()
+
+    def _reiniciar(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._ocupados = 0
+
+    def tomar(self, pedidos, maximo):
+        """Reserva hasta `pedidos` hilos sin pasar de `maximo` en el worker; devuelve cuántos se reservaron"""
+        # Con --preload el estado del maestro no vale en el worker
+        if os.getpid() != self._pid:
+            self._reiniciar()
+        with self._lock:
+            concedidos = max(0, min(pedidos, maximo - self._ocupados))
+            self._ocupados += concedidos
+            return concedidos
+
+    def devolver(self, cantidad):
+        with self._lock:
+            self._ocupados -= cantidad
+
+
+cupo_hilos = _CupoHilos()
+
+
+def ejecutar_lote(peticiones, paralelo=False, excluidos=(), hilos=4, hilos_worker=None, ruta_excluida=None):
+    """
+    Ejecuta las subpeticiones de /batch dentro del proceso y devuelve sus resultados en orden.
+
+    Cada subpetición ({"id", "method", "path", "body", "headers"}) pasa por
+    el despacho normal de Flask (before_request, vista, after_request) con la
+    cabecera Authorization del lote, así que cada recurso aplica sus mismos
+    permisos. En modo secuencial todas comparten el contexto de aplicación y
+    la sesión de base de datos del lote.
+
+    Con paralelo=True y solo peticiones GET (no dependen unas de otras) se
+    reparten en un pool de hasta `hilos` hilos; cada hilo usa su propio
+    contexto y sesión, porque una sesión de SQLAlchemy no se puede compartir
+    entre hilos, y el limitador cuenta cada subpetición paralela como una
+    petición en curso más. Entre todos los lotes del worker no se usan más de
+    hilos_worker hilos: si no queda cupo, el lote corre en secuencia.
+
+    excluidos son clases de recurso que no se pueden agrupar (streams, el
+    propio /batch) y ruta_excluida(ruta) las rutas que tampoco (pago y
+    checkout, que el limitador admite siempre como críticas). Lanza
+    LoteInvalido si alguna subpetición está mal formada o excluida.
+    """
+    entornos = [_construir_entorno(indice, peticion, excluidos, ruta_excluida)
+                for indice, peticion in enumerate(peticiones)]
+    app = current_app._get_current_object()
+
+    if paralelo and len(entornos) > 1 and all(entorno['REQUEST_METHOD'] == 'GET' for _, entorno in entornos):
+        pedidos = min(hilos, len(entornos))
+        concedidos = cupo_hilos.tomar(pedidos, pedidos if hilos_worker is None else hilos_worker)
+        if concedidos > 1:
+            def en_hilo(identificador, entorno):
+                entorno[ENTORNO_SUBPETICION] = PARALELA
+                with app.app_context():
+                    return _despachar(app, identificador, entorno)
+
+            try:
+                with ThreadPoolExecutor(max_workers=concedidos, thread_name_prefix='batch') as pool:
+                    return list(pool.map(lambda item: en_hilo(*item), entornos))
+            finally:
+                cupo_hilos.devolver(concedidos)
+        cupo_hilos.devolver(concedidos)
+
+    return [_despachar(app, identificador, entorno) for identificador, entorno in entornos]
+
+
+def _construir_entorno(indice, peticion, excluidos, ruta_excluida=None):
+    if not isinstance(peticion, dict) or not isinstance(peticion.get('path'), str) \
+            or not peticion['path'].startswith('/'):
+        raise LoteInvalido(f"Subpetición {indice}: se requiere 'path' empezando por '/'")
+    metodo = str(peticion.get('method', 'GET')).upper()
+    cabeceras = peticion.get('headers') or {}
+    if not isinstance(cabeceras, dict):
+        raise LoteInvalido(f"Subpetición {indice}: 'headers' debe ser un objeto")
+
+    cabeceras = {clave: str(valor) for clave, valor in cabeceras.items()
+                 if clave.title() not in CABECERAS_HEREDADAS and clave.title() not in CABECERAS_DESCARTADAS}
+    cabeceras.update({clave: request.headers[clave] for clave in CABECERAS_HEREDADAS if clave in request.headers})
+    constructor = EnvironBuilder(
+        path=peticion['path'],
+        method=metodo,
+        base_url=request.host_url,
+        headers=cabeceras,
+        json=peticion.get('body'),
+        environ_base={'REMOTE_ADDR': request.remote_addr, ENTORNO_SUBPETICION: SECUENCIAL}
+    )
+    try:
+        entorno = constructor.get_environ()
+    finally:
+        constructor.close()
+
+    adaptador = current_app.url_map.bind_to_environ(entorno)
+    try:
+        endpoint, _ = adaptador.match()
+    except MethodNotAllowed as e:
+        # La exclusión es por recurso, sea cual sea el método; el despacho responderá 405
+        endpoint, _ = adaptador.match(method=e.valid_methods[0])
+    except HTTPException:
+        endpoint = None  # el despacho responderá 404 en su resultado
+    vista = current_app.view_functions.get(endpoint)
+    if getattr(vista, 'view_class', None) in excluidos or (ruta_excluida and ruta_excluida(entorno['PATH_INFO'])):
+        raise LoteInvalido(f"Subpetición {indice}: {peticion['path']} no se puede incluir en un lote")
+    return peticion.get('id', indice), entorno
+
+
+def _despachar(app, identificador, entorno):
+    with app.request_context(entorno):
+        try:
+            respuesta = app.full_dispatch_request()
+            cuerpo = respuesta.get_json(silent=True) if respuesta.is_json else (respuesta.get_data(as_text=True) or None)
+        except Exception:
+            app.logger.exception("Error en la subpetición %s de un lote", identificador)
+            db.session.rollback()
+            return {'id': identificador, 'status': 500, 'body': {'message': 'Error interno del servidor'}}
+
+    resultado = {'id': identificador, 'status': respuesta.status_code, 'body': cuerpo}
+    cabeceras = {clave: respuesta.headers[clave] for clave in CABECERAS_DEVUELTAS if clave in respuesta.headers}
+    if cabeceras:
+        resultado['headers'] = cabeceras
+    return resultado
@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, literal, union_all, or_
+
+from ..modelos import db, HistorialStock, HistorialStockArchivo, FotoStock, Producto, DetalleFactura, Factura, Pago, CarritoProducto, VersionRecurso
+
+
+# Filas movidas por transacción al archivar
+LOTE_ARCHIVADO = 5000
+
+
+def archivar_historial_stock(dias_retencion, lote=LOTE_ARCHIVADO):
+    """
+    Mueve a historial_stock_archivo los ajustes con más de dias_retencion días
+    para que historial_stock solo guarde los recientes. Trabaja en lotes de
+    `lote` filas, cada uno en su propia transacción (copia y borrado juntos),
+    así que se puede interrumpir y relanzar. Devuelve cuántas filas movió.
+    """
+    limite = datetime.utcnow() - timedelta(days=dias_retencion)
+    tabla = HistorialStock.__table__
+    movidas = 0
+    while True:
+        ids = [fila.id for fila in db.session.query(HistorialStock.id)
+               .filter(HistorialStock.fecha_ajuste < limite)
+               .order_by(HistorialStock.id)
+               .limit(lote)
+               .with_for_update(skip_locked=True)]
+        if not ids:
+            db.session.commit()
+            return movidas
+
+        db.session.execute(HistorialStockArchivo.__table__.insert().from_select(
+            ['id', 'id_producto', 'cantidad_ajuste', 'nuevo_stock', 'fecha_ajuste', 'motivo'],
+            select(tabla.c.id, tabla.c.id_producto, tabla.c.cantidad_ajuste, tabla.c.nuevo_stock,
+                   tabla.c.fecha_ajuste, tabla.c.motivo).where(tabla.c.id.in_(ids))
+        ))
+        db.session.execute(tabla.delete().where(tabla.c.id.in_(ids)))
+        db.session.commit()
+        movidas += len(ids)
+
+
+def tomar_foto_stock(fecha=None):
+    """Guarda el stock actual de todos los productos con un solo INSERT ... SELECT. Devuelve la fecha de la foto"""
+    fecha = fecha or datetime.utcnow()
+    db.session.execute(FotoStock.__table__.insert().from_select(
+        ['fecha', 'id_producto', 'stock'],
+        select(literal(fecha, db.DateTime), Producto.id_producto, Producto.producto_stock)
+    ))
+    db.session.commit()
+    return fecha
+
+
+def stock_en_fecha(corte):
+    """
+    Stock de cada producto en el instante `corte`, sin recorrer todo el historial.
+
+    Parte del punto conocido más cercano a `corte` (una foto de stock o el
+    stock actual, que es una foto de ahora) y aplica solo los movimientos
+    entre ese punto y `corte`: ajustes de historial_stock (y su archivo) y
+    ventas fechadas por su pago. Si el punto es posterior a `corte` los
+    movimientos se deshacen. Con fotos diarias el tramo reproducido es de
+    menos de un día, así que el coste depende del número de productos y no
+    del tamaño del historial.
+
+    Todas las fechas que se comparan (corte, fotos, fecha_ajuste, fecha_pago)
+    son UTC del reloj de la app; las filas antiguas que tomaron la hora del
+    servidor de base de datos (default now()) solo cuadran si este corre en UTC.
+
+    Las unidades de una venta salen de detalle_factura. El /pago antiguo
+    descuenta el stock al pagar y la factura llega (o no) con otra petición:
+    un pago sin factura cuenta las líneas de su carrito, que son las que
+    descontó.
+
+    Devuelve (fecha_de_partida, filas con id_producto, producto_nombre y stock);
+    fecha_de_partida es None si se partió del stock actual.
+    """
+    ahora = datetime.utcnow()
+    anterior = db.session.query(func.max(FotoStock.fecha)).filter(FotoStock.fecha <= corte).scalar()
+    posterior = db.session.query(func.min(FotoStock.fecha)).filter(FotoStock.fecha > corte).scalar()
+    candidatos = [f for f in (anterior, posterior) if f is not None]
+    if corte < ahora:
+        candidatos.append(ahora)
+    partida = min(candidatos, key=lambda f: abs(f - corte)) if candidatos else ahora
+
+    if partida is ahora:
+        base = select(Producto.id_producto, Producto.producto_stock.label('stock')).subquery()
+        fecha_partida = None
+    else:
+        base = select(FotoStock.id_producto, FotoStock.stock).where(FotoStock.fecha == partida).subquery()
+        fecha_partida = partida
+    desde, hasta = sorted((partida, corte))
+    signo = 1 if partida <= corte else -1
+
+    movimientos = union_all(
+        select(HistorialStock.id_producto, HistorialStock.cantidad_ajuste.label('cantidad'))
+        .where(HistorialStock.fecha_ajuste >= desde, HistorialStock.fecha_ajuste < hasta),
+        select(HistorialStockArchivo.id_producto, HistorialStockArchivo.cantidad_ajuste)
+        .where(HistorialStockArchivo.fecha_ajuste >= desde, HistorialStockArchivo.fecha_ajuste < hasta),
+        select(DetalleFactura.id_producto, -DetalleFactura.cantidad)
+        .join(Factura, Factura.id_factura == DetalleFactura.id_factura)
+        .join(Pago, Pago.id_pago == Factura.id_pago)
+        .where(Pago.fecha_pago >= desde, Pago.fecha_pago < hasta),
+        select(CarritoProducto.id_producto, -CarritoProducto.cantidad)
+        .join(Pago, Pago.id_carrito == CarritoProducto.id_carrito)
+        .where(Pago.fecha_pago >= desde, Pago.fecha_pago < hasta,
+               ~select(Factura.id_factura).where(Factura.id_pago == Pago.id_pago).exists())
+    ).subquery()
+    delta = select(movimientos.c.id_producto, func.sum(movimientos.c.cantidad).label('cantidad'))\
+        .group_by(movimientos.c.id_producto).subquery()
+
+    filas = db.session.query(
+        base.c.id_producto,
+        Producto.producto_nombre,
+        (base.c.stock + signo * func.coalesce(delta.c.cantidad, 0)).label('stock')
+    ).outerjoin(Producto, Producto.id_producto == base.c.id_producto)\
+        .outerjoin(delta, delta.c.id_producto == base.c.id_producto)\
+        .order_by(Producto.producto_nombre, base.c.id_producto)\
+        .all()
+    return fecha_partida, filas
+
+
+def reparar_contadores_ventas():
+    """
+    Recalcula unidades_vendidas y ultima_venta de todos los productos a partir
+    de detalle_factura, para corregir desvíos (facturas borradas, cargas
+    manuales). Solo escribe los productos cuyo contador no coincide. Devuelve
+    cuántos productos se corrigieron.
+    """
+    unidades = select(func.coalesce(func.sum(DetalleFactura.cantidad), 0))\
+        .where(DetalleFactura.id_producto == Producto.id_producto)\
+        .scalar_subquery()
+    ultima = select(func.max(Factura.factura_fecha))\
+        .join(DetalleFactura, DetalleFactura.id_factura == Factura.id_factura)\
+        .where(DetalleFactura.id_producto == Producto.id_producto)\
+        .scalar_subquery()
+
+    corregidos = Producto.query.filter(or_(
+        Producto.unidades_vendidas != unidades,
+        Producto.ultima_venta.is_distinct_from(ultima)
+    )).update({Producto.unidades_vendidas: unidades, Producto.ultima_venta: ultima}, synchronize_session=False)
+    if corregidos:
+        VersionRecurso.incrementar('stock')
+    db.session.commit()
+    return corregidos
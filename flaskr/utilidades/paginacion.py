@@ -0,0 +1,91 @@
+import base64
+import json
+import threading
+import time
+from datetime import datetime
+from flask import request
+from sqlalchemy import func, tuple_
+
+from ..modelos import db
+
+
+LIMITE_POR_DEFECTO = 50
+LIMITE_MAXIMO = 200
+
+# Segundos que se reutiliza un conteo cuando no hay estimación del planificador
+TTL_CONTEO = 60
+
+_conteos = {}
+_conteos_lock = threading.Lock()
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+def leer_limite():
+    limite = request.args.get('limite', LIMITE_POR_DEFECTO, type=int)
+    return max(1, min(limite, LIMITE_MAXIMO))
+
+
+def codificar_cursor(fecha, id_registro):
+    valor = json.dumps([fecha.isoformat() if fecha else None, id_registro])
+    return base64.urlsafe_b64encode(valor.encode('utf-8')).decode('ascii')
+
+
+def decodificar_cursor(cursor):
+    try:
+        fecha, id_registro = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(fecha), int(id_registro)
+    except (ValueError, TypeError):
+        raise CursorInvalido("Cursor de paginación inválido")
+
+
+def paginar_por_fecha(consulta, columna_fecha, columna_id, limite, cursor=None, claves=None):
+    """
+    Paginación por keyset sobre (fecha DESC, id DESC): cada página continúa
+    justo después de la última fila de la anterior, así que el coste no crece
+    con el número de página como con OFFSET.
+
+    Devuelve (filas, siguiente_cursor). La consulta debe traer ambas columnas;
+    si van con label, claves=(nombre_fecha, nombre_id) indica cómo leerlas.
+    """
+    clave_fecha, clave_id = claves or (columna_fecha.key, columna_id.key)
+    if cursor:
+        fecha, id_registro = decodificar_cursor(cursor)
+        consulta = consulta.filter(tuple_(columna_fecha, columna_id) < tuple_(fecha, id_registro))
+
+    filas = consulta.order_by(columna_fecha.desc(), columna_id.desc()).limit(limite + 1).all()
+
+    siguiente_cursor = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        ultima = filas[-1]
+        siguiente_cursor = codificar_cursor(getattr(ultima, clave_fecha), getattr(ultima, clave_id))
+    return filas, siguiente_cursor
+
+
+def estimar_total(consulta, clave):
+    """
+    Total aproximado de filas de la consulta sin hacer COUNT(*).
+
+    En PostgreSQL se usa la estimación del planificador (EXPLAIN), que no lee
+    la tabla. En otros motores se cuenta y se guarda el resultado TTL_CONTEO
+    segundos por combinación de filtros.
+    """
+    conexion = db.session.connection()
+    if conexion.dialect.name == 'postgresql':
+        compilada = consulta.statement.compile(dialect=conexion.dialect)
+        plan = conexion.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + compilada.string, compilada.params).scalar()
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    ahora = time.monotonic()
+    with _conteos_lock:
+        guardado = _conteos.get(clave)
+        if guardado and guardado[1] > ahora:
+            return guardado[0]
+
+    total = db.session.query(func.count()).select_from(consulta.order_by(None).subquery()).scalar()
+    with _conteos_lock:
+        _conteos[clave] = (total, ahora + TTL_CONTEO)
+    return total
@@ -1,18 +1,20 @@
+import io
+import csv
 import os
 import re
+import time
+import queue
 import pytz
 from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta
-from flask import request, current_app, jsonify
+from flask import request, current_app, jsonify, Response
 from flask_restful import Resource, reqparse
-from flask_mail import Message
 from flask import current_app
-from flask import request, render_template
-from flask import render_template
 from sqlalchemy.exc import IntegrityError, NoResultFound
-from flaskr.modelos.esquemas import PaypalDetalleSchema, TransferenciaDetalleSchema, TarjetaDetalleSchema, FacturaSchema, HistorialStockSchema
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
-from ..modelos import db, Usuario, TarjetaDetalle, TransferenciaDetalle, PaypalDetalle, Producto, Categoria, CarritoProductoSchema, CarritoProducto, Rol, UsuarioSchema, ProductoSchema, CategoriaSchema, RolSchema, PagoSchema, EnvioSchema, OrdenSchema, CarritoSchema, FacturaSchema, DetalleFacturaSchema, DetalleFactura, Factura, Pago, Orden, Envio, Carrito, HistorialStock
+from flaskr.modelos.esquemas import PaypalDetalleSchema, TransferenciaDetalleSchema, TarjetaDetalleSchema, FacturaSchema
+from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, verify_jwt_in_request
+from ..modelos import db, HashingSaturado, VersionRecurso, EventoStock, Usuario, TarjetaDetalle, TransferenciaDetalle, PaypalDetalle, Producto, Categoria, CarritoProductoSchema, CarritoProducto, Rol, UsuarioSchema, ProductoSchema, CategoriaSchema, RolSchema, PagoSchema, EnvioSchema, OrdenSchema, CarritoSchema, FacturaSchema, DetalleFacturaSchema, DetalleFactura, Factura, Pago, Orden, Envio, Carrito, HistorialStock, HistorialStockArchivo, HistorialEnvio
+from ..utilidades import despachador_correos, admin_required, es_administrador, rol_vigente, cache_roles, respuesta_condicional, exportar_consulta, difusor_envios, difusor_eventos_stock, serializar_evento_stock, formato_sse, CacheTTL, catalogo_columnar, leer_limite, paginar_por_fecha, estimar_total, CursorInvalido, stock_en_fecha, leer_proyeccion, CamposInvalidos, ejecutar_lote, LoteInvalido, es_ruta_critica
 
 # Uso de los schemas creados en modelos
 usuario_schema = UsuarioSchema()
@@ -20,7 +22,6 @@ producto_schema = ProductoSchema()
 categoria_schema = CategoriaSchema()
 carrito_schema = CarritoSchema()
 factura_schema = FacturaSchema()
-facturas_schema = FacturaSchema(many=True) 
 orden_schema = OrdenSchema()
 detalle_factura_schema = DetalleFacturaSchema()
 envio_schema = EnvioSchema()
@@ -29,13 +30,34 @@ carrito_producto_schema = CarritoProductoSchema(many=True)
 paypal_schema = PaypalDetalleSchema()
 transferencia_schema = TransferenciaDetalleSchema()
 tarjeta_schema = TarjetaDetalleSchema()
-historial_stock_schema = HistorialStockSchema()
-historiales_stock_schema = HistorialStockSchema(many=True)
+
+# Resumen de categorías por (versión de categorías, versión del catálogo): cualquier escritura de productos lo invalida
+cache_resumen_categorias = CacheTTL(ttl=300, maximo=16)
 
 #insercion de productos con imagenees de manera local
 UPLOAD_FOLDER = os.path.join('static', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
+def obtener_carrito_activo(id_usuario):
+    """Carrito abierto del usuario; se crea en la primera interacción con el carrito, no en el login"""
+    carrito = Carrito.query.filter_by(id_usuario=id_usuario, procesado=False).first()
+    if not carrito:
+        carrito = Carrito(id_usuario=id_usuario, fecha=datetime.now(), total=0, procesado=False)
+        db.session.add(carrito)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Otra petición del mismo usuario lo creó a la vez (uq_carrito_usuario_abierto)
+            db.session.rollback()
+            carrito = Carrito.query.filter_by(id_usuario=id_usuario, procesado=False).one()
+    return carrito
+
+
+def escapar_like(texto):
+    """Escapa los comodines de LIKE para buscar el texto literal (con escape='\\')"""
+    return texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -47,8 +69,12 @@ class VistaProtegida(Resource):
 
 class VistaUsuarios(Resource):
     def get(self):
-        usuarios = Usuario.query.all()
-        return [usuario_schema.dump(usuario) for usuario in usuarios], 200
+        try:
+            opciones, esquema = leer_proyeccion(Usuario, UsuarioSchema)
+        except CamposInvalidos as e:
+            return {'message': str(e)}, 400
+        usuarios = Usuario.query.options(*opciones).all()
+        return esquema.dump(usuarios), 200
 
     def post(self):
         if not all(key in request.json for key in ['nombre', 'numerodoc', 'correo', 'contrasena']):
@@ -82,6 +108,9 @@ class VistaUsuarios(Resource):
             db.session.commit()
             
             return {"message": "Usuario creado exitosamente"}, 201
+        except HashingSaturado:
+            db.session.rollback()
+            raise
         except Exception as e:
             db.session.rollback()
             return {"message": f"Error al crear usuario: {str(e)}"}, 500
@@ -125,8 +154,12 @@ class VistaUsuario(Resource):
                 usuario.contrasena = request.json['contrasena']
 
             db.session.commit()
+            cache_roles.invalidar(id_usuario)
             return {'mensaje': 'Usuario actualizado correctamente'}, 200
 
+        except HashingSaturado:
+            db.session.rollback()
+            raise
         except NoResultFound:
             db.session.rollback()
             return {'mensaje': 'Recurso no encontrado'}, 404
@@ -155,6 +188,7 @@ class VistaUsuario(Resource):
 
         db.session.delete(usuario)
         db.session.commit()
+        cache_roles.invalidar(id_usuario)
 
         return {"message": "Usuario eliminado exitosamente."}, 200
 
@@ -220,39 +254,131 @@ class VistaPerfilUsuario(Resource):
             "usuario": usuario_schema.dump(usuario)
         }, 200
 
+# Límites de los tramos de precio de las facetas; el último tramo no tiene tope
+TRAMOS_PRECIO = (0, 100000, 500000, 1000000, 2000000)
+
+
+def calcular_facetas(consulta_busqueda, condiciones_precio, categoria, solo_en_stock):
+    """
+    Conteos por categoría, por tramo de precio y con/sin stock para la barra de filtros.
+
+    Cada faceta aplica todos los filtros menos el suyo (al elegir una categoría
+    siguen viéndose las demás con su conteo). Se resuelve en una sola consulta:
+    se agrupa la búsqueda por (categoría, tramo, hay stock, cumple el precio)
+    y cada faceta se suma en Python sobre esas pocas filas.
+    """
+    tramo = db.case(
+        *[(Producto.producto_precio < limite, indice) for indice, limite in enumerate(TRAMOS_PRECIO[1:])],
+        else_=len(TRAMOS_PRECIO) - 1
+    )
+    hay_stock = db.case((Producto.producto_stock > 0, 1), else_=0)
+    cumple_precio = db.case((db.and_(*condiciones_precio), 1), else_=0) if condiciones_precio else db.literal(1)
+
+    grupos = consulta_busqueda.outerjoin(Categoria, Categoria.id_categoria == Producto.categoria_id)\
+        .with_entities(Producto.categoria_id, Categoria.nombre, tramo.label('tramo'), hay_stock.label('hay_stock'),
+                       cumple_precio.label('cumple_precio'), db.func.count().label('total'))\
+        .group_by(Producto.categoria_id, Categoria.nombre, 'tramo', 'hay_stock', 'cumple_precio')\
+        .all()
+
+    categorias = {}
+    tramos = [0] * len(TRAMOS_PRECIO)
+    stock = {'en_stock': 0, 'sin_stock': 0}
+    for grupo in grupos:
+        ok_categoria = categoria is None or grupo.categoria_id == categoria
+        ok_stock = not solo_en_stock or grupo.hay_stock
+        if grupo.cumple_precio and ok_stock:
+            entrada = categorias.setdefault(grupo.categoria_id, {'id_categoria': grupo.categoria_id,
+                                                                 'nombre': grupo.nombre, 'total': 0})
+            entrada['total'] += grupo.total
+        if ok_categoria and ok_stock:
+            tramos[grupo.tramo] += grupo.total
+        if ok_categoria and grupo.cumple_precio:
+            stock['en_stock' if grupo.hay_stock else 'sin_stock'] += grupo.total
+
+    return {
+        'categorias': sorted(categorias.values(), key=lambda c: (-c['total'], c['id_categoria'])),
+        'precios': [{
+            'desde': desde,
+            'hasta': TRAMOS_PRECIO[indice + 1] if indice + 1 < len(TRAMOS_PRECIO) else None,
+            'total': tramos[indice]
+        } for indice, desde in enumerate(TRAMOS_PRECIO)],
+        'stock': stock
+    }
+
+
 class VistaProductos(Resource):
     def get(self):
         """Obtener todos los productos o filtrar por término de búsqueda, precio, categoría y stock."""
+        version, fecha_version = VersionRecurso.obtener_catalogo()
+        max_age = current_app.config.get('CATALOGO_CACHE_MAX_AGE', 60)
+        return respuesta_condicional(
+            ('catalogo', version),
+            lambda: self._listar_productos(version),
+            ultima_modificacion=fecha_version,
+            cache_control=f'public, max-age={max_age}'
+        )
+
+    def _listar_productos(self, version=None):
         search_term = request.args.get('q')  # Término de búsqueda
         min_price = request.args.get('min_price')  # Precio mínimo
         max_price = request.args.get('max_price')  # Precio máximo
         category_id = request.args.get('category_id')  # ID de la categoría
         in_stock = request.args.get('in_stock')  # Productos con stock disponible
+        try:
+            # ?fields= y ?expand=: solo se leen y devuelven las columnas y relaciones pedidas
+            opciones, esquema = leer_proyeccion(Producto, ProductoSchema)
+        except CamposInvalidos as e:
+            return {'message': str(e)}, 400
 
         # Consulta base
         query = Producto.query
 
         # Filtro por nombre del producto
         if search_term:
-            query = query.filter(Producto.producto_nombre.ilike(f'%{search_term}%'))
+            # % y _ se buscan tal cual, igual que en el catálogo columnar
+            query = query.filter(Producto.producto_nombre.ilike(f'%{escapar_like(search_term)}%', escape='\\'))
+        consulta_busqueda = query
 
         # Filtro por rango de precios
-        if min_price and min_price.replace('.', '', 1).isdigit():
-            query = query.filter(Producto.producto_precio >= float(min_price))
-        if max_price and max_price.replace('.', '', 1).isdigit():
-            query = query.filter(Producto.producto_precio <= float(max_price))
+        precio_min = float(min_price) if min_price and min_price.replace('.', '', 1).isdigit() else None
+        precio_max = float(max_price) if max_price and max_price.replace('.', '', 1).isdigit() else None
+        condiciones_precio = []
+        if precio_min is not None:
+            condiciones_precio.append(Producto.producto_precio >= precio_min)
+        if precio_max is not None:
+            condiciones_precio.append(Producto.producto_precio <= precio_max)
+        query = query.filter(*condiciones_precio)
 
         # Filtro por categoría
-        if category_id and category_id.isdigit():
-            query = query.filter(Producto.categoria_id == int(category_id))
+        categoria = int(category_id) if category_id and category_id.isdigit() else None
+        if categoria is not None:
+            query = query.filter(Producto.categoria_id == categoria)
 
         # Filtro por stock disponible
-        if in_stock and in_stock.lower() == 'true':
+        solo_en_stock = bool(in_stock and in_stock.lower() == 'true')
+        if solo_en_stock:
             query = query.filter(Producto.producto_stock > 0)
 
-        # Ejecutar la consulta y devolver los resultados
-        productos = query.all()
-        return [producto_schema.dump(producto) for producto in productos], 200
+        # Más vendidos primero (contador mantenido al facturar, con índice)
+        orden = request.args.get('orden')
+        if orden == 'populares':
+            query = query.order_by(Producto.unidades_vendidas.desc(), Producto.id_producto.desc())
+
+        # Con el catálogo columnar los filtros y el orden se resuelven en memoria y solo se leen las filas elegidas
+        ids = catalogo_columnar.filtrar(version, q=search_term, precio_min=precio_min, precio_max=precio_max,
+                                        categoria=categoria, solo_en_stock=solo_en_stock, orden=orden)
+        if ids is not None:
+            por_id = {p.id_producto: p for p in Producto.query.options(*opciones).filter(Producto.id_producto.in_(ids))} if ids else {}
+            productos = [por_id[i] for i in ids if i in por_id]
+        else:
+            # Ejecutar la consulta y devolver los resultados
+            productos = query.options(*opciones).all()
+        productos_data = esquema.dump(productos)
+
+        if request.args.get('facetas', '').lower() == 'true':
+            facetas = calcular_facetas(consulta_busqueda, condiciones_precio, categoria, solo_en_stock)
+            return {'productos': productos_data, 'facetas': facetas}, 200
+        return productos_data, 200
 
     @jwt_required()
     def post(self):
@@ -310,6 +436,11 @@ class VistaProducto(Resource):
             producto.categoria_id = int(data['categoria_id'])
         if 'producto_foto' in data:
             producto.producto_foto = data['producto_foto']  # Nueva URL de Cloudinary
+        if 'umbral_reposicion' in data:
+            umbral = data['umbral_reposicion']
+            if not isinstance(umbral, int) or isinstance(umbral, bool) or umbral < 0:
+                return {'message': 'umbral_reposicion debe ser un entero no negativo'}, 400
+            producto.umbral_reposicion = umbral
 
         db.session.commit()
         return producto_schema.dump(producto), 200
@@ -336,6 +467,31 @@ class VistaCategoria(Resource):
 
         # Actualizar el nombre de la categoría
         categoria.nombre = request.json.get('nombre', categoria.nombre)
+
+        # El umbral de reposición de la categoría se aplica a todos sus productos en una sola sentencia
+        if 'umbral_reposicion' in request.json:
+            umbral = request.json['umbral_reposicion']
+            if not isinstance(umbral, int) or isinstance(umbral, bool) or umbral < 0:
+                return {'mensaje': 'umbral_reposicion debe ser un entero no negativo'}, 400
+            categoria.umbral_reposicion = umbral
+
+            # El UPDATE masivo no pasa por los before_flush: los cruces y la versión del catálogo van a mano
+            productos = db.session.query(Producto.id_producto, Producto.producto_stock, Producto.umbral_reposicion)\
+                .filter(Producto.categoria_id == id_categoria)\
+                .order_by(Producto.id_producto).with_for_update().all()
+            eventos = []
+            fecha = datetime.utcnow()
+            for fila in productos:
+                tipo = EventoStock.tipo_cruce(fila.producto_stock, fila.producto_stock, umbral, fila.umbral_reposicion)
+                if tipo:
+                    eventos.append({'id_producto': fila.id_producto, 'tipo': tipo, 'stock_anterior': fila.producto_stock,
+                                    'stock_nuevo': fila.producto_stock, 'umbral': umbral, 'fecha': fecha})
+            Producto.query.filter(Producto.categoria_id == id_categoria)\
+                .update({Producto.umbral_reposicion: umbral}, synchronize_session=False)
+            if eventos:
+                db.session.execute(EventoStock.__table__.insert().values(eventos))
+            if productos:
+                VersionRecurso.incrementar('catalogo')
         db.session.commit()
 
         # Retornar la categoría actualizada
@@ -348,6 +504,9 @@ class VistaCategoria(Resource):
         if not categoria:
             return {'mensaje': 'La categoría no existe'}, 404
 
+        if Producto.query.filter(Producto.categoria_id == id_categoria).first():
+            return {'mensaje': 'La categoría tiene productos asociados'}, 409
+
         # Eliminar la categoría
         db.session.delete(categoria)
         db.session.commit()
@@ -356,10 +515,56 @@ class VistaCategoria(Resource):
 
 
 class VistaCategorias(Resource):
-    @jwt_required()
     def get(self):
-        categorias = Categoria.query.all()
-        categorias_data = [categoria_schema.dump(categoria) for categoria in categorias]
+        version, fecha_version = VersionRecurso.obtener('categorias')
+
+        # Público: la tienda muestra las categorías con su resumen sin iniciar sesión
+        if request.args.get('con_resumen', '').lower() == 'true':
+            version_catalogo, fecha_catalogo = VersionRecurso.obtener_catalogo()
+            max_age = current_app.config.get('CATALOGO_CACHE_MAX_AGE', 60)
+            return respuesta_condicional(
+                ('categorias', version, 'catalogo', version_catalogo),
+                lambda: (cache_resumen_categorias.obtener_o_calcular((version, version_catalogo), self._resumen_categorias), 200),
+                ultima_modificacion=max(filter(None, (fecha_version, fecha_catalogo)), default=None),
+                cache_control=f'public, max-age={max_age}'
+            )
+
+        verify_jwt_in_request()
+        return respuesta_condicional(
+            ('categorias', version),
+            self._listar_categorias,
+            ultima_modificacion=fecha_version
+        )
+
+    def _resumen_categorias(self):
+        """Número de productos, productos con stock y rango de precios de cada categoría en una sola consulta"""
+        filas = db.session.query(
+            Categoria.id_categoria,
+            Categoria.nombre,
+            db.func.count(Producto.id_producto).label('productos'),
+            db.func.count(Producto.id_producto).filter(Producto.producto_stock > 0).label('productos_en_stock'),
+            db.func.min(Producto.producto_precio).label('precio_minimo'),
+            db.func.max(Producto.producto_precio).label('precio_maximo')
+        ).outerjoin(Producto, Producto.categoria_id == Categoria.id_categoria)\
+         .group_by(Categoria.id_categoria, Categoria.nombre)\
+         .order_by(Categoria.nombre)\
+         .all()
+        return [{
+            'id_categoria': fila.id_categoria,
+            'nombre': fila.nombre,
+            'productos': fila.productos,
+            'productos_en_stock': fila.productos_en_stock,
+            'precio_minimo': fila.precio_minimo,
+            'precio_maximo': fila.precio_maximo
+        } for fila in filas]
+
+    def _listar_categorias(self):
+        try:
+            opciones, esquema = leer_proyeccion(Categoria, CategoriaSchema)
+        except CamposInvalidos as e:
+            return {'message': str(e)}, 400
+        categorias = Categoria.query.options(*opciones).all()
+        categorias_data = esquema.dump(categorias)
         return categorias_data, 200  # ✅ NO uses jsonify
 
 
@@ -381,25 +586,30 @@ class VistaLogin(Resource):
 
         # Verificar que el usuario exista y que la contraseña sea correcta
         if usuario and usuario.verificar_contrasena(contrasena):
-            # Generar el token de acceso, asegurándose de que 'identity' sea una cadena
-            token_de_acceso = create_access_token(identity=str(usuario.id_usuario))
-
-            # Verificar si el usuario ya tiene un carrito abierto (no procesado)
-            carrito = Carrito.query.filter_by(id_usuario=usuario.id_usuario, procesado=False).first()
-
-            if not carrito:
-                # Si no existe un carrito, crearlo
-                carrito = Carrito(id_usuario=usuario.id_usuario, total=0)
-                db.session.add(carrito)
+            # Si cambiaron los parámetros de hash (HASH_METODO), se actualiza aprovechando la contraseña en claro
+            if usuario.necesita_rehash():
+                usuario.contrasena = contrasena
                 db.session.commit()
 
-            # Devolver el mensaje, token y el carrito (si es necesario)
-            return {
+            # Generar el token de acceso, asegurándose de que 'identity' sea una cadena
+            # El rol va como claim para que los endpoints de admin no consulten la base de datos
+            token_de_acceso = create_access_token(
+                identity=str(usuario.id_usuario),
+                additional_claims={"rol": usuario.rol_id}
+            )
+
+            respuesta = {
                 "mensaje": "Inicio de sesión exitoso",
                 "token": token_de_acceso,
-                "rol": usuario.rol_id,  # Asumiendo que 'rol_id' es un campo en el modelo Usuario
-                "carrito": CarritoSchema().dump(carrito)  # Devolver el carrito al frontend
-            }, 200
+                "rol": usuario.rol_id  # Asumiendo que 'rol_id' es un campo en el modelo Usuario
+            }
+
+            # El carrito se crea al usarlo (POST /carrito, GET /carrito/activo); los clientes
+            # que aún lo leen del login lo piden con ?incluir_carrito=true
+            if request.args.get('incluir_carrito', '').lower() == 'true':
+                respuesta["carrito"] = CarritoSchema().dump(obtener_carrito_activo(usuario.id_usuario))
+
+            return respuesta, 200
 
         return {"mensaje": "Usuario o contraseña incorrectos"}, 401
 
@@ -448,6 +658,9 @@ class VistaSignIn(Resource):
 
             return {"mensaje": "Usuario creado exitosamente"}, 201
 
+        except HashingSaturado:
+            db.session.rollback()
+            raise
         except Exception as e:
             db.session.rollback()
             return {"mensaje": f"Error al crear usuario: {str(e)}"}, 500
@@ -484,14 +697,8 @@ class VistaCarrito(Resource):
         # Obtenemos el usuario desde el token JWT
         user_id = get_jwt_identity()
         
-        # Verificar si el usuario ya tiene un carrito abierto
-        carrito = Carrito.query.filter_by(id_usuario=user_id, procesado=False).first()
-
-        if not carrito:
-            # Si no existe, se crea un carrito vacío
-            carrito = Carrito(id_usuario=user_id, total=0)
-            db.session.add(carrito)
-            db.session.commit()
+        # Devuelve el carrito abierto o crea uno vacío
+        carrito = obtener_carrito_activo(user_id)
 
         return CarritoSchema().dump(carrito), 201
 
@@ -501,11 +708,8 @@ class VistaCarrito(Resource):
         # Obtener el usuario desde el token JWT
         user_id = get_jwt_identity()
         
-        # Buscar el carrito de compras activo del usuario
-        carrito = Carrito.query.filter_by(id_usuario=user_id, procesado=False).first()
-
-        if not carrito:
-            return {"message": "No se encontró un carrito activo para el usuario."}, 404
+        # El carrito abierto del usuario; se crea vacío si todavía no tiene
+        carrito = obtener_carrito_activo(user_id)
 
         return CarritoSchema().dump(carrito), 200
 
@@ -593,18 +797,22 @@ class VistaCarritoActivo(Resource):
     def get(self):
         id_usuario = get_jwt_identity()
 
-        carrito = Carrito.query.filter_by(id_usuario=id_usuario, procesado=False).first()
+        carrito = obtener_carrito_activo(id_usuario)
 
-        if not carrito:
-            carrito = Carrito(
-                id_usuario=id_usuario,
-                fecha=datetime.now(),
-                total=0,
-                procesado=False
-            )
-            db.session.add(carrito)
-            db.session.commit()
+        # El ETag depende de las líneas del carrito y de la versión del catálogo
+        # (nombre, precio y stock de cada producto salen en la respuesta)
+        lineas = db.session.query(CarritoProducto.id_producto, CarritoProducto.cantidad)\
+            .filter(CarritoProducto.id_carrito == carrito.id_carrito)\
+            .order_by(CarritoProducto.id_carrito_producto)\
+            .all()
+        version_catalogo, _ = VersionRecurso.obtener_catalogo()
 
+        return respuesta_condicional(
+            ('carrito', carrito.id_carrito, carrito.total, version_catalogo, [tuple(linea) for linea in lineas]),
+            lambda: self._detalle_carrito(carrito)
+        )
+
+    def _detalle_carrito(self, carrito):
         productos_carrito = []
         for item in carrito.productos:  # Asegúrate de tener esta relación en tu modelo
             producto = item.producto
@@ -626,14 +834,32 @@ class VistaCarritoActivo(Resource):
 class VistaPagos(Resource):
     @jwt_required()
     def get(self):
+        formato = request.args.get('format')
+        if formato:
+            consulta = db.session.query(
+                Pago.id_pago, Pago.id_carrito, Pago.monto, Pago.fecha_pago, Pago.metodo_pago, Pago.estado
+            ).order_by(Pago.id_pago)
+            return exportar_consulta(consulta, formato, 'pagos')
+
         pagos = Pago.query.all()
         return [pago_schema.dump(pago) for pago in pagos], 200
 
 class VistaFacturas(Resource):
     @jwt_required()
     def get(self):
-        facturas = Factura.query.all()
-        return facturas_schema.dump(facturas), 200
+        formato = request.args.get('format')
+        if formato:
+            consulta = db.session.query(
+                Factura.id_factura, Factura.id_pago, Factura.factura_fecha, Factura.total
+            ).order_by(Factura.id_factura)
+            return exportar_consulta(consulta, formato, 'facturas')
+
+        try:
+            opciones, esquema = leer_proyeccion(Factura, FacturaSchema)
+        except CamposInvalidos as e:
+            return {'message': str(e)}, 400
+        facturas = Factura.query.options(*opciones).all()
+        return esquema.dump(facturas), 200
 
 
 
@@ -723,32 +949,66 @@ class VistaPago(Resource):
 
         return {"message": "Pago creado exitosamente, productos actualizados, nuevo carrito creado", "id_pago": nuevo_pago.id_pago}, 201
 
+def validar_tarjeta(datos):
+    """Devuelve el mensaje de error de los datos de tarjeta, o None si son válidos"""
+    if not datos.get('numero_tarjeta') or not re.match(r'^\d{16}$', str(datos.get('numero_tarjeta'))):
+        return "El número de tarjeta debe tener exactamente 16 dígitos"
+
+    if not datos.get('nombre_en_tarjeta') or not re.match(r'^[a-zA-Z\s]+$', datos.get('nombre_en_tarjeta')):
+        return "El nombre en la tarjeta solo debe contener letras"
+
+    if not datos.get('cvv') or not re.match(r'^\d{3}$', str(datos.get('cvv'))):
+        return "El CVV debe tener exactamente 3 dígitos"
+
+    if not datos.get('fecha_expiracion') or not re.match(r'^\d{4}$', str(datos.get('fecha_expiracion'))):
+        return "La fecha de expiración debe tener 4 dígitos (MMAA)"
+
+    # Validar fecha no expirada
+    try:
+        mes = int(str(datos.get('fecha_expiracion'))[:2])
+        ano = int(str(datos.get('fecha_expiracion'))[2:]) + 2000
+        if ano < datetime.now().year or (ano == datetime.now().year and mes < datetime.now().month):
+            return "La tarjeta está expirada"
+    except:
+        return "Formato de fecha inválido"
+    return None
+
+
+def validar_transferencia(datos):
+    """Devuelve el mensaje de error de los datos de transferencia, o None si son válidos"""
+    if not datos.get('nombre_titular') or not re.match(r'^[a-zA-Z\s]+$', datos.get('nombre_titular')):
+        return "El nombre del titular solo debe contener letras"
+
+    if not datos.get('banco_origen') or not re.match(r'^[a-zA-Z\s]+$', datos.get('banco_origen')):
+        return "El nombre del banco solo debe contener letras"
+
+    if not datos.get('numero_cuenta') or not re.match(r'^\d{1,16}$', str(datos.get('numero_cuenta'))):
+        return "El número de cuenta debe contener solo números (máximo 16 dígitos)"
+
+    if datos.get('comprobante_url') and not re.match(r'^[a-zA-Z0-9]{1,30}$', datos.get('comprobante_url')):
+        return "El URL del comprobante debe contener solo letras y números (máximo 30 caracteres)"
+    return None
+
+
+def validar_paypal(datos):
+    """Devuelve el mensaje de error de los datos de PayPal, o None si son válidos"""
+    if not datos.get('email_paypal') or not re.match(r'^[^\s@]+@[^\s@]+\.[^\s@]+$', datos.get('email_paypal')):
+        return "Por favor ingrese un correo electrónico válido para PayPal"
+
+    if not datos.get('confirmacion_id') or not re.match(r'^\d+$', str(datos.get('confirmacion_id'))):
+        return "El ID de confirmación de PayPal debe contener solo números"
+    return None
+
+
 class VistaTarjeta(Resource):
     @jwt_required()
     def post(self):
         datos = request.json
         
         # Validaciones de tarjeta (igual que antes)
-        if not datos.get('numero_tarjeta') or not re.match(r'^\d{16}$', str(datos.get('numero_tarjeta'))):
-            return {"mensaje": "El número de tarjeta debe tener exactamente 16 dígitos"}, 400
-            
-        if not datos.get('nombre_en_tarjeta') or not re.match(r'^[a-zA-Z\s]+$', datos.get('nombre_en_tarjeta')):
-            return {"mensaje": "El nombre en la tarjeta solo debe contener letras"}, 400
-            
-        if not datos.get('cvv') or not re.match(r'^\d{3}$', str(datos.get('cvv'))):
-            return {"mensaje": "El CVV debe tener exactamente 3 dígitos"}, 400
-            
-        if not datos.get('fecha_expiracion') or not re.match(r'^\d{4}$', str(datos.get('fecha_expiracion'))):
-            return {"mensaje": "La fecha de expiración debe tener 4 dígitos (MMAA)"}, 400
-            
-        # Validar fecha no expirada
-        try:
-            mes = int(str(datos.get('fecha_expiracion'))[:2])
-            ano = int(str(datos.get('fecha_expiracion'))[2:]) + 2000
-            if ano < datetime.now().year or (ano == datetime.now().year and mes < datetime.now().month):
-                return {"mensaje": "La tarjeta está expirada"}, 400
-        except:
-            return {"mensaje": "Formato de fecha inválido"}, 400
+        error = validar_tarjeta(datos)
+        if error:
+            return {"mensaje": error}, 400
 
         # Verificar que existe un pago asociado (como lo hace PayPal)
         if not datos.get('id_pago'):
@@ -778,17 +1038,9 @@ class VistaTransferencia(Resource):
         datos = request.json
         
         # Validaciones
-        if not datos.get('nombre_titular') or not re.match(r'^[a-zA-Z\s]+$', datos.get('nombre_titular')):
-            return {"mensaje": "El nombre del titular solo debe contener letras"}, 400
-            
-        if not datos.get('banco_origen') or not re.match(r'^[a-zA-Z\s]+$', datos.get('banco_origen')):
-            return {"mensaje": "El nombre del banco solo debe contener letras"}, 400
-            
-        if not datos.get('numero_cuenta') or not re.match(r'^\d{1,16}$', str(datos.get('numero_cuenta'))):
-            return {"mensaje": "El número de cuenta debe contener solo números (máximo 16 dígitos)"}, 400
-            
-        if datos.get('comprobante_url') and not re.match(r'^[a-zA-Z0-9]{1,30}$', datos.get('comprobante_url')):
-            return {"mensaje": "El URL del comprobante debe contener solo letras y números (máximo 30 caracteres)"}, 400
+        error = validar_transferencia(datos)
+        if error:
+            return {"mensaje": error}, 400
 
         nueva_transferencia = TransferenciaDetalle(
             id_pago=datos.get('id_pago'),
@@ -807,11 +1059,9 @@ class VistaPaypal(Resource):
         datos = request.json
         
         # Validaciones
-        if not datos.get('email_paypal') or not re.match(r'^[^\s@]+@[^\s@]+\.[^\s@]+$', datos.get('email_paypal')):
-            return {"mensaje": "Por favor ingrese un correo electrónico válido para PayPal"}, 400
-            
-        if not datos.get('confirmacion_id') or not re.match(r'^\d+$', str(datos.get('confirmacion_id'))):
-            return {"mensaje": "El ID de confirmación de PayPal debe contener solo números"}, 400
+        error = validar_paypal(datos)
+        if error:
+            return {"mensaje": error}, 400
 
         nuevo_paypal = PaypalDetalle(
             id_pago=datos.get('id_pago'),
@@ -840,16 +1090,20 @@ class VistaProductosRecomendados(Resource):
     def get(self):
         # Obtener el usuario desde el token JWT
         user_id = get_jwt_identity()
+        try:
+            opciones, esquema = leer_proyeccion(Producto, ProductoSchema)
+        except CamposInvalidos as e:
+            return {'message': str(e)}, 400
 
         # Obtener el carrito no procesado del usuario
         carrito = Carrito.query.filter_by(id_usuario=user_id, procesado=False).first()
 
         # Si el usuario no tiene un carrito activo, devolvemos todos los productos
         if not carrito:
-            productos = Producto.query.all()
+            productos = Producto.query.options(*opciones).all()
         else:
             # Obtener los productos que NO están en el carrito
-            productos = Producto.query.filter(
+            productos = Producto.query.options(*opciones).filter(
                 ~Producto.id_producto.in_(
                     db.session.query(CarritoProducto.id_producto)
                     .join(Carrito, Carrito.id_carrito == CarritoProducto.id_carrito)
@@ -858,11 +1112,67 @@ class VistaProductosRecomendados(Resource):
             ).all()
 
         # Convertir los productos a una lista de diccionarios
-        productos_lista = ProductoSchema(many=True).dump(productos)
+        productos_lista = esquema.dump(productos)
 
         return productos_lista, 200
 
 
+def total_carrito(id_carrito):
+    """Suma de cantidad x precio actual de las líneas del carrito, calculada en la base de datos"""
+    return int(db.session.query(db.func.coalesce(db.func.sum(CarritoProducto.cantidad * Producto.producto_precio), 0))
+               .join(Producto, Producto.id_producto == CarritoProducto.id_producto)
+               .filter(CarritoProducto.id_carrito == id_carrito)
+               .scalar())
+
+
+def crear_factura_de_carrito(id_pago, id_carrito, total=None):
+    """
+    Crea la factura y sus detalles sin confirmar la transacción.
+
+    El total se calcula en la base de datos y los detalles se insertan con un
+    único INSERT ... SELECT, así que el número de sentencias no depende de las
+    líneas del carrito. También suma las unidades a los contadores de ventas
+    de cada producto. Devuelve (id_factura, total, fecha).
+    """
+    monto_linea = CarritoProducto.cantidad * Producto.producto_precio
+    lineas_carrito = db.session.query(CarritoProducto)\
+        .join(Producto, Producto.id_producto == CarritoProducto.id_producto)\
+        .filter(CarritoProducto.id_carrito == id_carrito)
+    if total is None:
+        total = total_carrito(id_carrito)
+
+    # Factura con hora de Bogotá
+    fecha_bogota = datetime.now(pytz.timezone('America/Bogota'))
+    nueva_factura = Factura(id_pago=id_pago, factura_fecha=fecha_bogota, total=total)
+    db.session.add(nueva_factura)
+    db.session.flush()  # Para obtener el id_factura antes del commit
+    id_factura = nueva_factura.id_factura
+
+    db.session.execute(
+        DetalleFactura.__table__.insert().from_select(
+            ['id_factura', 'id_producto', 'cantidad', 'precio_unitario', 'monto_total'],
+            lineas_carrito.with_entities(
+                db.literal(id_factura), CarritoProducto.id_producto,
+                CarritoProducto.cantidad, Producto.producto_precio, monto_linea
+            ).statement
+        )
+    )
+
+    # Contadores de ventas del catálogo (orden=populares), en la misma transacción que la factura;
+    # su versión ('stock') se sube después del commit, fuera de la venta
+    vendidas = db.session.query(db.func.sum(DetalleFactura.cantidad))\
+        .filter(DetalleFactura.id_factura == id_factura, DetalleFactura.id_producto == Producto.id_producto)\
+        .scalar_subquery()
+    Producto.query.filter(
+        Producto.id_producto.in_(db.session.query(DetalleFactura.id_producto).filter(DetalleFactura.id_factura == id_factura))
+    ).update({
+        Producto.unidades_vendidas: Producto.unidades_vendidas + vendidas,
+        Producto.ultima_venta: fecha_bogota
+    }, synchronize_session=False)
+    VersionRecurso.diferir('stock')
+    return id_factura, total, fecha_bogota
+
+
 class VistaFactura(Resource):
     @jwt_required()
     def post(self):
@@ -877,77 +1187,36 @@ class VistaFactura(Resource):
             if not pago:
                 return {"error": "Pago no encontrado"}, 404
 
-            # 2. Obtener el carrito asociado a ese pago
-            carrito = Carrito.query.get(pago.id_carrito)
+            # 2. Obtener el carrito asociado a ese pago y el correo del usuario en una sola consulta
+            carrito = db.session.query(Carrito.id_carrito, Usuario.correo)\
+                .outerjoin(Usuario, Usuario.id_usuario == Carrito.id_usuario)\
+                .filter(Carrito.id_carrito == pago.id_carrito)\
+                .first()
             if not carrito:
                 return {"error": "Carrito no encontrado para el pago"}, 404
 
-            # 3. Calcular el total de la factura sumando los productos en el carrito y redondearlo
-            total_factura = sum(cp.cantidad * cp.producto.producto_precio for cp in carrito.productos)
-            total_factura_int = int(total_factura)  # Convertimos el total a entero
-
-            # 4. Crear la factura con hora de Bogotá
-            bogota_timezone = pytz.timezone('America/Bogota')
-            fecha_bogota = datetime.now(bogota_timezone)
+            # 3-5. Crear la factura y sus detalles a partir de las líneas del carrito
+            id_factura, total_factura_int, fecha_bogota = crear_factura_de_carrito(pago.id_pago, carrito.id_carrito)
 
-            nueva_factura = Factura(
-                id_pago=pago.id_pago,
-                factura_fecha=fecha_bogota,
-                total=total_factura_int  # Asignamos el total como entero
-            )
+            # Convertir la fecha y total a string con formato 'YYYY-MM-DD HH:MM:SS'
+            factura_fecha_str = fecha_bogota.strftime('%Y-%m-%d %H:%M:%S')
+            total_factura_str = f"${total_factura_int:,.0f}"  # Formatear el total con signo de pesos y miles
 
-            db.session.add(nueva_factura)
-            db.session.flush()  # Para obtener el id_factura antes del commit
-
-            # 5. Crear detalles de factura por cada producto en el carrito
-            for cp in carrito.productos:  # Suponiendo relación: carrito.productos -> CarritoProducto
-                detalle = DetalleFactura(
-                    id_factura=nueva_factura.id_factura,
-                    id_producto=cp.producto.id_producto,
-                    cantidad=cp.cantidad,
-                    precio_unitario=cp.producto.producto_precio,
-                    monto_total=int(cp.cantidad * cp.producto.producto_precio)  # Convertimos el monto total a entero
-                )
-                db.session.add(detalle)
+            # 6. Encolar el correo en la misma transacción; se renderiza y envía fuera de la petición
+            if carrito.correo:
+                despachador_correos.encolar_factura(carrito.correo, id_factura, factura_fecha_str, total_factura_int)
 
-            # 6. Confirmar todo
+            # 7. Confirmar todo
             db.session.commit()
 
-            # 7. Obtener el correo del usuario asociado al pago
-            carrito = Carrito.query.get(pago.id_carrito)  # Obtener el carrito asociado al pago
-            if not carrito:
-                return {"error": "No se encontró el carrito asociado al pago"}, 404
-
-            usuario = Usuario.query.get(carrito.id_usuario)  # Obtener el usuario asociado al carrito
-            if not usuario or not usuario.correo:
+            # 8. Verificar el correo del usuario asociado al pago
+            if not carrito.correo:
                 return {"error": "No se encontró el correo electrónico del usuario"}, 404
-
-            # 8. Crear el mensaje de correo electrónico
-            msg = Message(
-                'Factura de Compra - PHPhone',  # Asunto
-                sender='dilanf1506@gmail.com',  # Correo del admin
-                recipients=[usuario.correo]  # Correo del usuario
-            )
-
-            # Convertir la fecha y total a string con formato 'YYYY-MM-DD HH:MM:SS'
-            factura_fecha_str = nueva_factura.factura_fecha.strftime('%Y-%m-%d %H:%M:%S')
-            total_factura_str = f"${total_factura_int:,.0f}"  # Formatear el total con signo de pesos y miles
-
-            # 9. Enviar el correo
-            msg.html = render_template(
-                'factura_email.html',
-                factura_id=nueva_factura.id_factura,
-                factura_fecha=factura_fecha_str,
-                total=total_factura_int,  # Aquí mandamos el total formateado
-                detalles=carrito.productos  # Enviamos los productos también
-            )
-            from flaskr import mail 
-            # 9. Enviar el correo
-            mail.send(msg)
+            despachador_correos.despertar()
 
             return {
-                "message": "Factura y detalles creados exitosamente, y correo enviado.",
-                "id_factura": nueva_factura.id_factura,
+                "message": "Factura y detalles creados exitosamente, correo de la factura en cola de envío.",
+                "id_factura": id_factura,
                 "factura_fecha": factura_fecha_str,
                 "total": total_factura_str  # Devolver el total formateado como cadena
             }, 201
@@ -1001,6 +1270,18 @@ class VistaDetalleFactura(Resource):
                 } for detalle in detalles
             ], 200
         else:
+            formato = request.args.get('format')
+            if formato:
+                consulta = db.session.query(
+                    DetalleFactura.id_detalle_factura,
+                    DetalleFactura.id_factura,
+                    DetalleFactura.id_producto,
+                    DetalleFactura.cantidad,
+                    DetalleFactura.precio_unitario,
+                    DetalleFactura.monto_total
+                ).order_by(DetalleFactura.id_detalle_factura)
+                return exportar_consulta(consulta, formato, 'detalles_factura')
+
             # Obtener todos los detalles de facturas (versión básica sin join para mantener performance)
             detalles = DetalleFactura.query.all()
             return [
@@ -1145,31 +1426,195 @@ class VistaEnvio(Resource):
             current_app.logger.error(f"Error al crear envío y orden: {str(e)}")
             return {"error": f"Error al crear envío y orden: {str(e)}"}, 500
         
+CAMPOS_DIRECCION_ENVIO = ['direccion', 'ciudad', 'departamento', 'codigo_postal', 'pais']
+
+VALIDADORES_PAGO = {
+    'tarjeta': validar_tarjeta,
+    'paypal': validar_paypal,
+    'transferencia': validar_transferencia,
+}
+
+
+class VistaCheckout(Resource):
+    """
+    Compra en una sola petición y una sola transacción: pago, detalle del
+    método de pago, descuento de stock, factura, envío y orden. Sustituye la
+    secuencia /pago, /pago/<metodo>, /factura y /envio, que se mantiene.
+
+    Cuerpo: {"metodo_pago": "tarjeta|paypal|transferencia", "pago": {...}, "envio": {...}}
+    """
+
+    @jwt_required()
+    def post(self):
+        datos = request.get_json(silent=True) or {}
+        id_usuario = int(get_jwt_identity())
+
+        # Todas las validaciones antes de tocar la base de datos
+        metodo_pago = datos.get('metodo_pago')
+        if metodo_pago not in VALIDADORES_PAGO:
+            return {"error": "metodo_pago debe ser uno de: " + ", ".join(VALIDADORES_PAGO)}, 400
+        datos_pago = datos.get('pago') or {}
+        error = VALIDADORES_PAGO[metodo_pago](datos_pago)
+        if error:
+            return {"error": error}, 400
+        datos_envio = datos.get('envio') or {}
+        for campo in CAMPOS_DIRECCION_ENVIO:
+            if not datos_envio.get(campo):
+                return {"error": f"Falta el campo 'envio.{campo}' en el cuerpo JSON"}, 400
+
+        try:
+            # Se bloquea el carrito para que dos checkouts simultáneos no lo procesen dos veces
+            carrito = Carrito.query.filter_by(id_usuario=id_usuario, procesado=False).with_for_update().first()
+            if not carrito:
+                return {"error": "No hay carrito encontrado o el carrito ya fue procesado"}, 400
+
+            lineas = CarritoProducto.query.filter_by(id_carrito=carrito.id_carrito).count()
+            if not lineas:
+                return {"error": "El carrito está vacío"}, 400
+
+            # Descuento de stock en una sola sentencia; solo se actualizan los productos con stock suficiente
+            cantidad = db.session.query(CarritoProducto.cantidad)\
+                .filter(CarritoProducto.id_carrito == carrito.id_carrito,
+                        CarritoProducto.id_producto == Producto.id_producto)\
+                .scalar_subquery()
+            actualizados = Producto.query.filter(
+                Producto.id_producto.in_(
+                    db.session.query(CarritoProducto.id_producto).filter(CarritoProducto.id_carrito == carrito.id_carrito)
+                ),
+                Producto.producto_stock >= cantidad
+            ).update({Producto.producto_stock: Producto.producto_stock - cantidad}, synchronize_session=False)
+
+            if actualizados != lineas:
+                db.session.rollback()
+                sin_stock = db.session.query(Producto.producto_nombre)\
+                    .join(CarritoProducto, CarritoProducto.id_producto == Producto.id_producto)\
+                    .filter(CarritoProducto.id_carrito == carrito.id_carrito,
+                            Producto.producto_stock < CarritoProducto.cantidad)\
+                    .first()
+                nombre = sin_stock.producto_nombre if sin_stock else ''
+                return {"error": f"No hay suficiente stock para el producto {nombre}".strip()}, 409
+            # El UPDATE masivo no pasa por los before_flush que versionan el stock y emiten los cruces de umbral
+            VersionRecurso.diferir('stock')
+            stock_anterior = Producto.producto_stock + CarritoProducto.cantidad
+            db.session.execute(
+                EventoStock.__table__.insert().from_select(
+                    ['id_producto', 'tipo', 'stock_anterior', 'stock_nuevo', 'umbral', 'fecha'],
+                    db.session.query(
+                        Producto.id_producto, db.literal('stock_bajo'), stock_anterior, Producto.producto_stock,
+                        Producto.umbral_reposicion, db.literal(datetime.utcnow(), db.DateTime)
+                    ).join(CarritoProducto, CarritoProducto.id_producto == Producto.id_producto)
+                    .filter(CarritoProducto.id_carrito == carrito.id_carrito,
+                            Producto.producto_stock < Producto.umbral_reposicion,
+                            stock_anterior >= Producto.umbral_reposicion)
+                    .statement
+                )
+            )
+
+            total = total_carrito(carrito.id_carrito)
+            pago = Pago(
+                id_carrito=carrito.id_carrito,
+                monto=total,
+                metodo_pago=metodo_pago,
+                estado='completado',
+                fecha_pago=datetime.utcnow()
+            )
+            db.session.add(pago)
+            db.session.flush()
+
+            if metodo_pago == 'tarjeta':
+                detalle_pago = TarjetaDetalle(
+                    id_pago=pago.id_pago,
+                    nombre_en_tarjeta=datos_pago.get('nombre_en_tarjeta'),
+                    numero_tarjeta=datos_pago.get('numero_tarjeta'),
+                    fecha_expiracion=datos_pago.get('fecha_expiracion'),
+                    cvv=datos_pago.get('cvv')
+                )
+            elif metodo_pago == 'paypal':
+                detalle_pago = PaypalDetalle(
+                    id_pago=pago.id_pago,
+                    email_paypal=datos_pago.get('email_paypal'),
+                    confirmacion_id=datos_pago.get('confirmacion_id')
+                )
+            else:
+                detalle_pago = TransferenciaDetalle(
+                    id_pago=pago.id_pago,
+                    nombre_titular=datos_pago.get('nombre_titular'),
+                    banco_origen=datos_pago.get('banco_origen'),
+                    numero_cuenta=datos_pago.get('numero_cuenta'),
+                    comprobante_url=datos_pago.get('comprobante_url') or ''
+                )
+            db.session.add(detalle_pago)
+
+            id_factura, total, fecha_bogota = crear_factura_de_carrito(pago.id_pago, carrito.id_carrito, total)
+
+            envio = Envio(
+                fecha_creacion=fecha_bogota,
+                estado_envio="Empacando",
+                usuario_id=id_usuario,
+                id_factura=id_factura,
+                **{campo: datos_envio[campo] for campo in CAMPOS_DIRECCION_ENVIO}
+            )
+            orden = Orden(
+                id_usuario=id_usuario,
+                id_factura=id_factura,
+                fecha_orden=fecha_bogota,
+                monto_total=total,
+                estado='enviada'
+            )
+            carrito.procesado = True
+            db.session.add_all([envio, orden])
+            db.session.flush()
+            respuesta = {
+                "message": "Compra realizada exitosamente",
+                "id_pago": pago.id_pago,
+                "id_factura": id_factura,
+                "id_orden": orden.id_orden,
+                "id_envio": envio.id,
+                "factura_fecha": fecha_bogota.strftime('%Y-%m-%d %H:%M:%S'),
+                "total": f"${total:,.0f}"
+            }
+
+            # El correo sale de la bandeja de salida: un fallo de SMTP no deshace la compra
+            correo = db.session.query(Usuario.correo).filter(Usuario.id_usuario == id_usuario).scalar()
+            if correo:
+                despachador_correos.encolar_factura(correo, id_factura, respuesta["factura_fecha"], total)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error en el checkout: {str(e)}")
+            return {"error": f"Error al procesar la compra: {str(e)}"}, 500
+
+        despachador_correos.despertar()
+        return respuesta, 201
+
 ##ESTADOS DEL ENVIO 
 
 
+def buscar_envio_de_orden(id_orden, id_usuario):
+    """Envío de la orden; los no administradores solo pueden ver los suyos"""
+    query = Envio.query \
+        .join(Factura, Envio.id_factura == Factura.id_factura) \
+        .join(Orden, Factura.id_factura == Orden.id_factura) \
+        .filter(Orden.id_orden == id_orden)
+
+    # Si no es admin, filtrar por usuario
+    if not es_administrador():
+        query = query.filter(Envio.usuario_id == id_usuario)
+
+    return query.first()
+
+
 class VistaEstadoEnvio(Resource):
     @jwt_required()
     def get(self, id_orden):
         try:
             # Obtener el usuario actual desde el token JWT
             usuario_id = get_jwt_identity()
-            usuario = Usuario.query.get(usuario_id)
-            
-            if not usuario:
+            if rol_vigente(usuario_id) is None:
                 return {'error': 'Usuario no encontrado'}, 404
             
             # Buscar el envío asociado a la orden
-            query = Envio.query \
-                .join(Factura, Envio.id_factura == Factura.id_factura) \
-                .join(Orden, Factura.id_factura == Orden.id_factura) \
-                .filter(Orden.id_orden == id_orden)
-            
-            # Si no es admin (rol_id != 1), filtrar por usuario
-            if getattr(usuario, 'rol_id', 0) != 1:
-                query = query.filter(Envio.usuario_id == usuario_id)
-            
-            envio = query.first()
+            envio = buscar_envio_de_orden(id_orden, usuario_id)
             
             if not envio:
                 return {'error': 'Envío no encontrado o no tienes permisos'}, 404
@@ -1205,43 +1650,129 @@ class VistaEstadoEnvio(Resource):
             current_app.logger.error(f"Error en VistaEstadoEnvio: {str(e)}", exc_info=True)
             return {'error': 'Error al obtener el estado de envío'}, 500
 
+class VistaStreamEstadoEnvio(Resource):
+    # EventSource no permite cabeceras, así que el token también se acepta en ?jwt=
+    @jwt_required(locations=['headers', 'query_string'])
+    def get(self, id_orden):
+        usuario_id = get_jwt_identity()
+        if rol_vigente(usuario_id) is None:
+            return {'error': 'Usuario no encontrado'}, 404
+
+        envio = buscar_envio_de_orden(id_orden, usuario_id)
+        if not envio:
+            return {'error': 'Envío no encontrado o no tienes permisos'}, 404
+
+        id_envio = envio.id
+        estado_inicial = {
+            'id_envio': envio.id,
+            'estado_envio': envio.estado_envio,
+            'fecha': (envio.fecha_actualizacion or envio.fecha_creacion).isoformat()
+        }
+        # El stream puede durar minutos: no retener la conexión a la base de datos
+        db.session.close()
+
+        cola = difusor_envios.suscribir(id_envio)
+        if cola is None:
+            return {'error': 'Demasiadas conexiones abiertas, intente más tarde'}, 503, {'Retry-After': '30'}
+
+        config = current_app.config
+
+        def eventos():
+            yield 'retry: 5000\n\n'
+            yield formato_sse(estado_inicial, evento='estado')
+            # Se cierra a los SSE_DURACION_MAXIMA segundos; EventSource reconecta solo
+            fin = time.monotonic() + config['SSE_DURACION_MAXIMA']
+            while time.monotonic() < fin:
+                try:
+                    cambio = cola.get(timeout=config['SSE_LATIDO'])
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield formato_sse(cambio, evento='estado', id_evento=cambio['id'])
+
+        respuesta = Response(eventos(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        # call_on_close se ejecuta aunque el cliente corte antes de empezar a leer
+        respuesta.call_on_close(lambda: difusor_envios.desuscribir(id_envio, cola))
+        return respuesta
+
 estado_parser = reqparse.RequestParser()
 estado_parser.add_argument('nuevo_estado', type=str, required=True, help='Nuevo estado es requerido')
 
 class VistaEnviosAdmin(Resource):
-    @jwt_required()
+    @admin_required()
     def get(self):
-        # Verificar si el usuario es admin (rol_id = 1)
-        usuario_id = get_jwt_identity()
-        usuario = Usuario.query.get(usuario_id)
-        if not usuario or getattr(usuario, 'rol_id', 0) != 1:
-            return {'error': 'Acceso no autorizado'}, 403
+        consulta = db.session.query(
+            Envio.id.label('id_envio'),
+            Envio.usuario_id,
+            Usuario.nombre.label('nombre_usuario'),
+            Envio.estado_envio.label('estado_actual'),
+            Envio.fecha_creacion,
+            Envio.id_factura
+        ).join(Usuario, Envio.usuario_id == Usuario.id_usuario)
+
+        # Filtros (cada uno tiene su índice compuesto terminado en fecha_creacion, id)
+        estado = request.args.get('estado_envio')
+        ciudad = request.args.get('ciudad')
+        departamento = request.args.get('departamento')
+        fecha_desde = request.args.get('fecha_desde')
+        fecha_hasta = request.args.get('fecha_hasta')
+
+        if estado:
+            if estado not in Envio.ESTADOS_VALIDOS:
+                return {'error': f'Estado no válido. Los estados permitidos son: {", ".join(sorted(Envio.ESTADOS_VALIDOS))}'}, 400
+            consulta = consulta.filter(Envio.estado_envio == estado)
+        if ciudad:
+            consulta = consulta.filter(Envio.ciudad == ciudad)
+        if departamento:
+            consulta = consulta.filter(Envio.departamento == departamento)
+        try:
+            if fecha_desde:
+                consulta = consulta.filter(Envio.fecha_creacion >= datetime.strptime(fecha_desde, '%Y-%m-%d'))
+            if fecha_hasta:
+                fin = datetime.strptime(fecha_hasta, '%Y-%m-%d') + timedelta(days=1)
+                consulta = consulta.filter(Envio.fecha_creacion < fin)
+        except ValueError:
+            return {'error': 'Formato de fecha inválido. Use YYYY-MM-DD'}, 400
+
+        formato = request.args.get('format')
+        if formato:
+            return exportar_consulta(consulta.order_by(Envio.id), formato, 'envios')
+
+        clave_conteo = ('envios', estado, ciudad, departamento, fecha_desde, fecha_hasta)
+        total_estimado = estimar_total(consulta, clave_conteo)
+
+        try:
+            envios, siguiente_cursor = paginar_por_fecha(
+                consulta, Envio.fecha_creacion, Envio.id, leer_limite(),
+                cursor=request.args.get('cursor'),
+                claves=('fecha_creacion', 'id_envio')
+            )
+        except CursorInvalido as e:
+            return {'error': str(e)}, 400
 
-        # Obtener todos los envíos con detalles de usuario
-        envios = Envio.query.join(Usuario).all()
-        
         # Formatear respuesta
-        envios_data = []
-        for envio in envios:
-            envios_data.append({
-                'id_envio': envio.id,
-                'usuario_id': envio.usuario_id,
-                'nombre_usuario': envio.usuario.nombre,
-                'estado_actual': envio.estado_envio,
-                'fecha_creacion': envio.fecha_creacion.isoformat(),
-                'id_factura': envio.id_factura
-            })
-        
-        return {'envios': envios_data}, 200
+        envios_data = [{
+            'id_envio': envio.id_envio,
+            'usuario_id': envio.usuario_id,
+            'nombre_usuario': envio.nombre_usuario,
+            'estado_actual': envio.estado_actual,
+            'fecha_creacion': envio.fecha_creacion.isoformat(),
+            'id_factura': envio.id_factura
+        } for envio in envios]
+
+        return {
+            'envios': envios_data,
+            'siguiente_cursor': siguiente_cursor,
+            'total_estimado': total_estimado
+        }, 200
 
 class VistaActualizarEstadoAdmin(Resource):
-    @jwt_required()
+    @admin_required()
     def patch(self, id_envio):
-        # Verificar permisos de admin (rol_id = 1)
-        usuario_id = get_jwt_identity()
-        usuario = Usuario.query.get(usuario_id)
-        if not usuario or getattr(usuario, 'rol_id', 0) != 1:
-            return {'error': 'Acceso no autorizado'}, 403
+        usuario_id = int(get_jwt_identity())
 
         args = estado_parser.parse_args()
         nuevo_estado = args['nuevo_estado']
@@ -1256,6 +1787,15 @@ class VistaActualizarEstadoAdmin(Resource):
         if not envio:
             return {'error': 'Envío no encontrado'}, 404
 
+        if not Envio.transicion_permitida(envio.estado_envio, nuevo_estado):
+            return {'error': f'No se puede pasar de "{envio.estado_envio}" a "{nuevo_estado}"'}, 400
+
+        db.session.add(HistorialEnvio(
+            id_envio=envio.id,
+            estado_anterior=envio.estado_envio,
+            estado_nuevo=nuevo_estado,
+            id_usuario=usuario_id
+        ))
         envio.estado_envio = nuevo_estado
         envio.fecha_actualizacion = datetime.utcnow()
         
@@ -1268,16 +1808,75 @@ class VistaActualizarEstadoAdmin(Resource):
             return {'error': 'Error al actualizar el estado'}, 500
 
 
-        
-        
+class VistaActualizarEstadoMasivoAdmin(Resource):
+    MAXIMO_ENVIOS = 1000
+
+    @admin_required()
+    def patch(self):
+        """Mueve una lista de envíos a un nuevo estado con un UPDATE y un INSERT multi-fila"""
+        usuario_id = int(get_jwt_identity())
+
+        data = request.get_json() or {}
+        nuevo_estado = data.get('nuevo_estado')
+        ids_envio = data.get('ids_envio')
+
+        if not isinstance(nuevo_estado, str) or nuevo_estado not in Envio.ESTADOS_VALIDOS:
+            return {'error': f'Estado no válido. Los estados permitidos son: {", ".join(sorted(Envio.ESTADOS_VALIDOS))}'}, 400
+        # bool es subclase de int: true/false no son ids
+        if not isinstance(ids_envio, list) or not ids_envio or \
+                not all(isinstance(i, int) and not isinstance(i, bool) for i in ids_envio):
+            return {'error': 'ids_envio debe ser una lista de enteros'}, 400
+        if len(ids_envio) > self.MAXIMO_ENVIOS:
+            return {'error': f'Máximo {self.MAXIMO_ENVIOS} envíos por solicitud'}, 400
+
+        ids_envio = set(ids_envio)
+        try:
+            # Bloquear las filas para que el estado leído sea el que se guarda como estado_anterior
+            actuales = dict(
+                db.session.query(Envio.id, Envio.estado_envio)
+                .filter(Envio.id.in_(ids_envio))
+                .with_for_update()
+                .all()
+            )
+
+            rechazados = [
+                {'id_envio': id_envio, 'estado_actual': estado}
+                for id_envio, estado in actuales.items()
+                if not Envio.transicion_permitida(estado, nuevo_estado)
+            ]
+            ids_actualizar = sorted(set(actuales) - {r['id_envio'] for r in rechazados})
+
+            if ids_actualizar:
+                ahora = datetime.utcnow()
+                db.session.query(Envio)\
+                    .filter(Envio.id.in_(ids_actualizar))\
+                    .update({Envio.estado_envio: nuevo_estado, Envio.fecha_actualizacion: ahora},
+                            synchronize_session=False)
+                db.session.execute(HistorialEnvio.__table__.insert().values([{
+                    'id_envio': id_envio,
+                    'estado_anterior': actuales[id_envio],
+                    'estado_nuevo': nuevo_estado,
+                    'fecha_cambio': ahora,
+                    'id_usuario': usuario_id
+                } for id_envio in ids_actualizar]))
+
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error al actualizar estados: {str(e)}", exc_info=True)
+            return {'error': 'Error al actualizar los estados'}, 500
+
+        return {
+            'mensaje': f'{len(ids_actualizar)} envíos actualizados a "{nuevo_estado}"',
+            'actualizados': ids_actualizar,
+            'rechazados': rechazados,
+            'no_encontrados': sorted(ids_envio - set(actuales))
+        }, 200
+
+
 class VistaAjusteStock(Resource):
-    @jwt_required()
+    @admin_required(({"message": "No tienes permisos para realizar esta acción"}, 403))
     def post(self, id_producto):
-        # Verificar permisos (solo administradores pueden ajustar stock)
-        usuario_id = get_jwt_identity()
-        usuario = Usuario.query.get(usuario_id)
-        if usuario.rol_id != 1:  # Asumiendo que 1 es el rol de administrador
-            return {"message": "No tienes permisos para realizar esta acción"}, 403
 
         data = request.get_json()
         cantidad = data.get('cantidad')
@@ -1310,60 +1909,246 @@ class VistaAjusteStock(Resource):
             return {"message": f"Error al actualizar el stock: {str(e)}"}, 500
 
 
+MAX_LINEAS_AJUSTE = 1000
+
+
+def leer_lineas_ajuste():
+    """
+    Líneas {id_producto, cantidad, motivo} de un ajuste masivo, desde JSON
+    (lista o {"ajustes": [...]}) o desde CSV con cabecera id_producto,cantidad[,motivo]
+    (archivo multipart "archivo" o cuerpo text/csv). Lanza ValueError si alguna no es válida.
+    """
+    archivo = request.files.get('archivo')
+    if archivo is not None or request.mimetype == 'text/csv':
+        contenido = archivo.read() if archivo is not None else request.get_data()
+        try:
+            texto = contenido.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise ValueError("El CSV debe estar codificado en UTF-8")
+        lector = csv.DictReader(io.StringIO(texto))
+        if not lector.fieldnames or not {'id_producto', 'cantidad'} <= {c.strip() for c in lector.fieldnames}:
+            raise ValueError("El CSV debe tener las columnas id_producto y cantidad")
+        lineas = [{(c or '').strip(): (v or '').strip() for c, v in fila.items()} for fila in lector]
+        origen = 'Fila'
+    else:
+        data = request.get_json(silent=True)
+        lineas = data.get('ajustes') if isinstance(data, dict) else data
+        if not isinstance(lineas, list):
+            raise ValueError("Se esperaba una lista de ajustes")
+        origen = 'Ajuste'
+
+    if not lineas:
+        raise ValueError("No hay ajustes que aplicar")
+    if len(lineas) > MAX_LINEAS_AJUSTE:
+        raise ValueError(f"Como máximo {MAX_LINEAS_AJUSTE} ajustes por solicitud")
+
+    ajustes = []
+    for numero, linea in enumerate(lineas, start=1):
+        if not isinstance(linea, dict):
+            raise ValueError(f"{origen} {numero}: formato inválido")
+        try:
+            id_producto = int(linea.get('id_producto'))
+            cantidad = int(linea.get('cantidad'))
+        except (TypeError, ValueError):
+            raise ValueError(f"{origen} {numero}: id_producto y cantidad deben ser números enteros")
+        if isinstance(linea.get('cantidad'), float) or cantidad <= 0:
+            raise ValueError(f"{origen} {numero}: la cantidad debe ser un entero positivo")
+        motivo = (linea.get('motivo') or 'Ajuste de stock')[:255]
+        ajustes.append((id_producto, cantidad, motivo))
+    return ajustes
+
+
+class VistaAjusteStockMasivo(Resource):
+    """
+    Entrada de stock de muchos productos en una transacción: un UPDATE con
+    CASE para todos los incrementos y un INSERT de varias filas para el
+    historial. Las líneas repetidas de un mismo producto se suman.
+    """
+    @admin_required(({"message": "No tienes permisos para realizar esta acción"}, 403))
+    def post(self):
+        try:
+            lineas = leer_lineas_ajuste()
+        except ValueError as e:
+            return {"message": str(e)}, 400
+
+        incrementos = {}
+        motivos = {}
+        for id_producto, cantidad, motivo in lineas:
+            incrementos[id_producto] = incrementos.get(id_producto, 0) + cantidad
+            motivos.setdefault(id_producto, [])
+            if motivo not in motivos[id_producto]:
+                motivos[id_producto].append(motivo)
+
+        try:
+            # Bloquea los productos para leer el stock anterior que guarda el historial
+            actuales = {
+                fila.id_producto: fila for fila in db.session.query(
+                    Producto.id_producto, Producto.producto_stock, Producto.umbral_reposicion
+                ).filter(Producto.id_producto.in_(incrementos)).order_by(Producto.id_producto).with_for_update()
+            }
+            faltantes = sorted(set(incrementos) - set(actuales))
+            if faltantes:
+                db.session.rollback()
+                return {"message": "Productos no encontrados", "productos": faltantes}, 404
+
+            Producto.query.filter(Producto.id_producto.in_(incrementos)).update(
+                {Producto.producto_stock: Producto.producto_stock + db.case(incrementos, value=Producto.id_producto)},
+                synchronize_session=False
+            )
+
+            fecha = datetime.utcnow()
+            historial = []
+            eventos = []
+            for id_producto, cantidad in incrementos.items():
+                anterior = actuales[id_producto].producto_stock
+                umbral = actuales[id_producto].umbral_reposicion
+                historial.append({
+                    'id_producto': id_producto,
+                    'stock_anterior': anterior,
+                    'cantidad_ajuste': cantidad,
+                    'nuevo_stock': anterior + cantidad,
+                    'fecha_ajuste': fecha,
+                    'motivo': '; '.join(motivos[id_producto])[:255],
+                })
+                tipo = EventoStock.tipo_cruce(anterior, anterior + cantidad, umbral)
+                if tipo:
+                    eventos.append({'id_producto': id_producto, 'tipo': tipo, 'stock_anterior': anterior,
+                                    'stock_nuevo': anterior + cantidad, 'umbral': umbral, 'fecha': fecha})
+
+            db.session.execute(HistorialStock.__table__.insert().values(historial))
+            # El UPDATE masivo no pasa por los before_flush que versionan el stock y emiten los cruces de umbral
+            if eventos:
+                db.session.execute(EventoStock.__table__.insert().values(eventos))
+            VersionRecurso.diferir('stock')
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return {"message": f"Error al actualizar el stock: {str(e)}"}, 500
+
+        return {
+            "message": "Stock actualizado correctamente",
+            "productos_actualizados": len(historial),
+            "unidades": sum(incrementos.values()),
+            "fecha_ajuste": fecha.isoformat(),
+            "ajustes": [
+                {"id_producto": h['id_producto'], "stock_anterior": h['stock_anterior'],
+                 "ajuste": h['cantidad_ajuste'], "nuevo_stock": h['nuevo_stock']}
+                for h in historial
+            ]
+        }, 200
+
+
+def consultar_historial_stock():
+    """
+    Consulta del historial de stock con los filtros comunes: fecha_desde y
+    fecha_hasta (YYYY-MM-DD, inclusivas) y archivo=true para leer los ajustes
+    ya archivados. Lanza ValueError si una fecha no es válida.
+    """
+    if request.args.get('archivo', 'false').lower() == 'true':
+        modelo = HistorialStockArchivo
+        stock_anterior = (modelo.nuevo_stock - modelo.cantidad_ajuste).label('stock_anterior')
+    else:
+        modelo = HistorialStock
+        stock_anterior = modelo.stock_anterior
+
+    consulta = db.session.query(
+        modelo.id,
+        modelo.id_producto,
+        Producto.producto_nombre,
+        stock_anterior,
+        modelo.cantidad_ajuste,
+        modelo.nuevo_stock,
+        modelo.fecha_ajuste,
+        modelo.motivo
+    ).outerjoin(Producto, modelo.id_producto == Producto.id_producto)
+
+    fecha_desde = request.args.get('fecha_desde')
+    fecha_hasta = request.args.get('fecha_hasta')
+    if fecha_desde:
+        consulta = consulta.filter(modelo.fecha_ajuste >= datetime.strptime(fecha_desde, '%Y-%m-%d'))
+    if fecha_hasta:
+        consulta = consulta.filter(modelo.fecha_ajuste < datetime.strptime(fecha_hasta, '%Y-%m-%d') + timedelta(days=1))
+    return consulta, modelo
+
+
+def paginar_historial_stock(consulta, modelo):
+    try:
+        registros, siguiente_cursor = paginar_por_fecha(
+            consulta, modelo.fecha_ajuste, modelo.id, leer_limite(), cursor=request.args.get('cursor')
+        )
+    except CursorInvalido as e:
+        return {"message": str(e)}, 400
+
+    return {
+        "historial": [{
+            "id": registro.id,
+            "id_producto": registro.id_producto,
+            "producto_nombre": registro.producto_nombre,
+            "stock_anterior": registro.stock_anterior,
+            "cantidad_ajuste": registro.cantidad_ajuste,
+            "nuevo_stock": registro.nuevo_stock,
+            "fecha_ajuste": registro.fecha_ajuste.isoformat(),
+            "motivo": registro.motivo
+        } for registro in registros],
+        "siguiente_cursor": siguiente_cursor
+    }, 200
+
+
 class VistaHistorialStockProducto(Resource):
-    @jwt_required()
+    @admin_required(({"message": "No tienes permisos para ver este historial"}, 403))
     def get(self, id_producto):
-        # Verificar permisos (solo administradores pueden ver el historial)
-        usuario_id = get_jwt_identity()
-        usuario = Usuario.query.get(usuario_id)
-        if usuario.rol_id != 1:  # Asumiendo que 1 es el rol de administrador
-            return {"message": "No tienes permisos para ver este historial"}, 403
 
         producto = Producto.query.get(id_producto)
         if not producto:
             return {"message": "Producto no encontrado"}, 404
 
-        # Obtener todo el historial ordenado por fecha descendente
-        historial = HistorialStock.query.filter_by(id_producto=id_producto)\
-                          .order_by(HistorialStock.fecha_ajuste.desc())\
-                          .all()
+        try:
+            consulta, modelo = consultar_historial_stock()
+        except ValueError:
+            return {"message": "Formato de fecha inválido. Use YYYY-MM-DD"}, 400
 
-        return historiales_stock_schema.dump(historial), 200
+        # Página por keyset sobre el índice (id_producto, fecha_ajuste, id)
+        return paginar_historial_stock(consulta.filter(modelo.id_producto == id_producto), modelo)
 
 
 class VistaHistorialStockGeneral(Resource):
-    @jwt_required()
+    @admin_required(({"message": "No tienes permisos para ver este historial"}, 403))
     def get(self):
-        # Verificar permisos (solo administradores pueden ver el historial)
-        usuario_id = get_jwt_identity()
-        usuario = Usuario.query.get(usuario_id)
-        if usuario.rol_id != 1:  # Asumiendo que 1 es el rol de administrador
-            return {"message": "No tienes permisos para ver este historial"}, 403
 
-        # Obtener todo el historial ordenado por fecha descendente
-        historial = HistorialStock.query\
-                      .join(Producto, HistorialStock.id_producto == Producto.id_producto)\
-                      .order_by(HistorialStock.fecha_ajuste.desc())\
-                      .all()
+        try:
+            consulta, modelo = consultar_historial_stock()
+        except ValueError:
+            return {"message": "Formato de fecha inválido. Use YYYY-MM-DD"}, 400
 
-        # Añadir información del producto a cada registro
-        historial_data = []
-        for registro in historial:
-            registro_data = historial_stock_schema.dump(registro)
-            registro_data['producto_nombre'] = registro.producto.producto_nombre
-            historial_data.append(registro_data)
+        formato = request.args.get('format')
+        if formato:
+            return exportar_consulta(consulta.order_by(modelo.fecha_ajuste.desc(), modelo.id.desc()),
+                                     formato, 'historial_stock')
 
-        return historial_data, 200
+        return paginar_historial_stock(consulta, modelo)
 
 
 class VistaStockProductos(Resource):
-    @jwt_required()
+    @admin_required(({"message": "No tienes permisos para ver este reporte"}, 403))
     def get(self):
-        # Verificar permisos (solo administradores pueden ver este reporte)
-        usuario_id = get_jwt_identity()
-        usuario = Usuario.query.get(usuario_id)
-        if usuario.rol_id != 1:  # Asumiendo que 1 es el rol de administrador
-            return {"message": "No tienes permisos para ver este reporte"}, 403
+
+        # Stock al final de un día pasado (UTC), a partir de la foto más cercana
+        fecha = request.args.get('fecha')
+        if fecha:
+            try:
+                corte = datetime.strptime(fecha, '%Y-%m-%d') + timedelta(days=1)
+            except ValueError:
+                return {"message": "Formato de fecha inválido. Use YYYY-MM-DD"}, 400
+            fecha_partida, filas = stock_en_fecha(corte)
+            return {
+                "fecha": fecha,
+                "foto": fecha_partida.isoformat() if fecha_partida else None,
+                "productos": [{
+                    "id_producto": fila.id_producto,
+                    "producto_nombre": fila.producto_nombre,
+                    "producto_stock": fila.stock
+                } for fila in filas]
+            }, 200
 
         # Obtener todos los productos con su stock actual
         productos = Producto.query.order_by(Producto.producto_nombre).all()
@@ -1488,26 +2273,69 @@ class VistaPedidosUsuario(Resource):
         
         return {"pedidos": pedidos}, 200
     
+class VistaEventosStock(Resource):
+    """Cruces de umbral posteriores a ?despues_de=<id> (lectura incremental por clave primaria)"""
+
+    @admin_required()
+    def get(self):
+        despues_de = request.args.get('despues_de', 0, type=int)
+        limite = leer_limite()
+        eventos = EventoStock.query.filter(EventoStock.id > despues_de)\
+            .order_by(EventoStock.id).limit(limite).all()
+        return {
+            'eventos': [serializar_evento_stock(evento) for evento in eventos],
+            'ultimo_id': eventos[-1].id if eventos else despues_de
+        }, 200
+
+
+class VistaStreamEventosStock(Resource):
+    """Cruces de umbral por Server-Sent Events: el panel de admin deja de sondear /api/productos/bajo-stock"""
+
+    # EventSource no permite cabeceras, así que el token también se acepta en ?jwt=
+    @admin_required(locations=['headers', 'query_string'])
+    def get(self):
+        db.session.close()
+
+        cola = difusor_eventos_stock.suscribir()
+        if cola is None:
+            return {'error': 'Demasiadas conexiones abiertas, intente más tarde'}, 503, {'Retry-After': '30'}
+
+        config = current_app.config
+
+        def eventos():
+            yield 'retry: 5000\n\n'
+            fin = time.monotonic() + config['SSE_DURACION_MAXIMA']
+            while time.monotonic() < fin:
+                try:
+                    evento = cola.get(timeout=config['SSE_LATIDO'])
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield formato_sse(evento, evento=evento['tipo'], id_evento=evento['id'])
+
+        respuesta = Response(eventos(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        respuesta.call_on_close(lambda: difusor_eventos_stock.desuscribir(None, cola))
+        return respuesta
+
+
 class VistaProductosBajoStock(Resource):
-    @jwt_required()
+    @admin_required(({"message": "No autorizado"}, 403))
     def get(self):
-        # Verificar que el usuario es administrador
-        usuario_id = get_jwt_identity()
-        usuario = Usuario.query.get(usuario_id)
-        
-        if not usuario or usuario.rol_id != 1:  # Asumiendo que 1 es admin
-            return {"message": "No autorizado"}, 403
 
-        # Obtener productos con menos de 10 unidades
+        # Productos bajo su umbral de reposición; el predicado coincide con el del índice parcial
         productos_bajo_stock = Producto.query.filter(
-            Producto.producto_stock < 10
-        ).all()
+            Producto.producto_stock < Producto.umbral_reposicion
+        ).order_by(Producto.producto_stock, Producto.id_producto).all()
 
         # Formatear la respuesta
         productos_formateados = [{
             "id_producto": producto.id_producto,
             "nombre": producto.producto_nombre,
             "stock_actual": producto.producto_stock,
+            "umbral_reposicion": producto.umbral_reposicion,
             "precio": producto.producto_precio,
             "foto": producto.producto_foto
         } for producto in productos_bajo_stock]
@@ -1515,4 +2343,35 @@ class VistaProductosBajoStock(Resource):
         return {
             "count": len(productos_bajo_stock),
             "productos": productos_formateados
-        }, 200
\ No newline at end of file
+        }, 200
+
+class VistaBatch(Resource):
+    """
+    Varias peticiones en un solo viaje: {"peticiones": [{"id", "method", "path", "body", "headers"}], "paralelo": bool}.
+    Se ejecutan contra los mismos recursos dentro del proceso y la respuesta
+    trae el status y el cuerpo de cada una, en el mismo orden.
+    """
+    def post(self):
+        # El token se valida una vez aquí: si no es válido falla el lote entero, no cada subpetición
+        verify_jwt_in_request(optional=True)
+
+        data = request.get_json(silent=True)
+        peticiones = data.get('peticiones') if isinstance(data, dict) else data
+        if not isinstance(peticiones, list) or not peticiones:
+            return {"message": "Se esperaba una lista de peticiones"}, 400
+        maximo = current_app.config['BATCH_MAX_PETICIONES']
+        if len(peticiones) > maximo:
+            return {"message": f"Máximo {maximo} peticiones por lote"}, 400
+
+        try:
+            resultados = ejecutar_lote(
+                peticiones,
+                paralelo=isinstance(data, dict) and data.get('paralelo') is True,
+                excluidos={VistaBatch, VistaStreamEstadoEnvio, VistaStreamEventosStock},
+                hilos=current_app.config['BATCH_HILOS'],
+                hilos_worker=current_app.config['BATCH_HILOS_WORKER'],
+                ruta_excluida=es_ruta_critica
+            )
+        except LoteInvalido as e:
+            return {"message": str(e)}, 400
+        return {"resultados": resultados}, 200
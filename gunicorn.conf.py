@@ -0,0 +1,12 @@
+# Hooks de gunicorn (se carga solo desde el directorio de trabajo; el Procfile lo indica con --config)
+from flaskr.utilidades import limitador
+
+
+def post_fork(server, worker):
+    # El worker empieza con su ranura de concurrencia a cero
+    limitador.registrar_worker()
+
+
+def child_exit(server, worker):
+    # Un worker que muere a mitad de petición (timeout, SIGKILL) no deja plazas ni el lock ocupados
+    limitador.liberar_worker(worker.pid)
@@ -4,6 +4,7 @@ from pathlib import Path
 import pytest
 from flaskr import create_app
 from flaskr.modelos import db
+from flaskr.utilidades import cache_roles, limitador
 
 # Configuración de paths
 project_root = str(Path(__file__).parent.parent.parent)  # Sube hasta API_PROYECTO
@@ -22,6 +23,10 @@ def app():
             'pool_recycle': 3600,
         }
     })
+    # Los correos encolados se despachan explícitamente en las pruebas, sin hilo ni SMTP
+    app.config['CORREO_DESPACHO_AUTOMATICO'] = False
+    # Las versiones de stock se suben al confirmar, sin esperar a la ventana
+    app.config['CATALOGO_VENTANA_STOCK'] = 0
 
     # Crear todas las tablas al inicio
     with app.app_context():
@@ -44,4 +49,18 @@ def session(app):
     with app.app_context():
         db.session.begin_nested()
         yield db.session
-        db.session.rollback()
\ No newline at end of file
+        db.session.rollback()
+
+@pytest.fixture(autouse=True)
+def limpiar_cache_roles():
+    """Los ids de usuario se reutilizan entre pruebas; el rol cacheado no debe filtrarse"""
+    cache_roles.invalidar()
+    yield
+    cache_roles.invalidar()
+
+@pytest.fixture(autouse=True)
+def limpiar_limitador():
+    """Los buckets viven en memoria compartida durante toda la sesión de pruebas"""
+    limitador.reiniciar()
+    yield
+    limitador.reiniciar()
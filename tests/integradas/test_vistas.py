@@ -1,7 +1,13 @@
+import io
+import time
 import pytest
+from sqlalchemy.exc import IntegrityError
 from flask import json
 from flask_jwt_extended import create_access_token
-from flaskr.modelos import Usuario, Rol, Factura, DetalleFactura, Producto, Pago, Categoria, Carrito, CarritoProducto, db
+from datetime import datetime, timedelta
+from flaskr.utilidades import limitador, despachador_correos, difusor_eventos_stock, catalogo_columnar, archivar_historial_stock, tomar_foto_stock, reparar_contadores_ventas
+from flaskr.utilidades.lotes import cupo_hilos
+from flaskr.modelos import Usuario, Rol, Factura, DetalleFactura, Producto, Pago, Categoria, Carrito, CarritoProducto, Envio, HistorialEnvio, Orden, TarjetaDetalle, CorreoPendiente, EventoStock, VersionRecurso, HistorialStock, HistorialStockArchivo, FotoStock, db
 from io import BytesIO
 import os
 from datetime import datetime
@@ -302,6 +308,37 @@ class TestVistaProductos:
         data = response.json
         assert all(p['producto_stock'] > 0 for p in data)
 
+    def test_productos_campos_parciales(self):
+        """?fields= devuelve y consulta solo las columnas pedidas; ?expand= añade relaciones"""
+        from sqlalchemy import event
+
+        with self.client.application.app_context():
+            motor = db.engine
+        sentencias = []
+        contar = lambda *args: sentencias.append(args[2])
+        event.listen(motor, 'before_cursor_execute', contar)
+        try:
+            response = self.client.get('/productos?fields=id_producto,producto_nombre,producto_precio,producto_foto')
+        finally:
+            event.remove(motor, 'before_cursor_execute', contar)
+
+        assert response.status_code == 200
+        assert response.json == [{"id_producto": self.producto_prueba.id_producto, "producto_nombre": "Producto Test",
+                                  "producto_precio": 100, "producto_foto": "foto.jpg"}]
+        select_productos = [s for s in sentencias if 'FROM producto' in s]
+        assert len(select_productos) == 1
+        assert 'descripcion' not in select_productos[0] and 'producto_stock' not in select_productos[0]
+
+        response = self.client.get('/productos?fields=producto_nombre&expand=carritos')
+        assert response.json == [{"producto_nombre": "Producto Test", "carritos": []}]
+
+        # Sin parámetros la salida no cambia
+        assert 'carritos' in self.client.get('/productos').json[0]
+
+        response = self.client.get('/productos?fields=producto_nombre,contrasena_hash&expand=rol')
+        assert response.status_code == 400
+        assert 'contrasena_hash' in response.json['message'] and 'rol' in response.json['message']
+
     def test_crear_producto_valido(self):
         os.makedirs('static/uploads', exist_ok=True)
 
@@ -357,6 +394,142 @@ class TestVistaProductos:
 
         assert response.status_code == 400
         assert response.json['message'] == 'No se ha enviado una imagen para el producto'
+    def test_productos_con_facetas(self):
+        """Cada faceta aplica todos los filtros menos el suyo"""
+        with self.client.application.app_context():
+            otra = Categoria(nombre="Otra")
+            db.session.add(otra)
+            db.session.flush()
+            otra_id = otra.id_categoria
+            db.session.add_all([
+                Producto(producto_nombre="Producto Caro", producto_precio=1500000, producto_stock=0,
+                         descripcion="d", producto_foto="f.jpg", categoria_id=self.categoria_id),
+                Producto(producto_nombre="Producto Otro", producto_precio=250000, producto_stock=4,
+                         descripcion="d", producto_foto="f.jpg", categoria_id=otra_id),
+                Producto(producto_nombre="Cargador", producto_precio=300, producto_stock=1,
+                         descripcion="d", producto_foto="f.jpg", categoria_id=otra_id),
+            ])
+            db.session.commit()
+
+        response = self.client.get(f'/productos?q=Producto&category_id={self.categoria_id}&facetas=true')
+        assert response.status_code == 200
+        assert {p["producto_nombre"] for p in response.json["productos"]} == {"Producto Test", "Producto Caro"}
+        facetas = response.json["facetas"]
+        assert [(c["nombre"], c["total"]) for c in facetas["categorias"]] == [("Categoría Test", 2), ("Otra", 1)]
+        assert [t["total"] for t in facetas["precios"]] == [1, 0, 0, 1, 0]
+        assert facetas["precios"][-1]["hasta"] is None
+        assert facetas["stock"] == {"en_stock": 1, "sin_stock": 1}
+
+        response = self.client.get('/productos?q=Producto&in_stock=true&max_price=1000000&facetas=true')
+        facetas = response.json["facetas"]
+        assert [(c["nombre"], c["total"]) for c in facetas["categorias"]] == [("Categoría Test", 1), ("Otra", 1)]
+        assert [t["total"] for t in facetas["precios"]] == [1, 1, 0, 0, 0]
+        assert facetas["stock"] == {"en_stock": 2, "sin_stock": 0}
+
+        # Sin facetas la respuesta sigue siendo la lista
+        assert isinstance(self.client.get('/productos').json, list)
+
+
+class TestCatalogoColumnar:
+    """El catálogo en memoria debe responder lo mismo que la consulta SQL"""
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        pytest.importorskip('numpy')
+        self.client = client
+
+        with self.client.application.app_context():
+            db.session.rollback()
+            db.session.query(Producto).delete()
+            db.session.commit()
+            db.session.add_all([
+                Producto(producto_nombre=nombre, producto_precio=precio, producto_stock=stock, descripcion="d",
+                         producto_foto="f.jpg", categoria_id=categoria, unidades_vendidas=vendidas)
+                for nombre, precio, stock, categoria, vendidas in [
+                    ("Celular Alfa", 900000, 3, 1, 5), ("Celular Beta", 1500000, 0, 1, 9),
+                    ("Funda ALFA", 30000, 12, 2, 5), ("Cargador", 45000, 1, 2, 0), ("Audífonos", 120000, 0, 3, 2),
+                    ("Funda 50% c_arbono \\ mate", 25000, 4, 2, 1),
+                ]
+            ])
+            db.session.commit()
+
+        self.client.application.config['CATALOGO_COLUMNAR'] = True
+        catalogo_columnar.reiniciar()
+        yield
+        self.client.application.config['CATALOGO_COLUMNAR'] = False
+        catalogo_columnar.reiniciar()
+
+    CONSULTAS = [
+        '', '?q=alfa', '?q=celular&in_stock=true', '?min_price=40000&max_price=1000000',
+        '?category_id=2', '?orden=populares', '?q=a&orden=populares&max_price=1000000', '?q=zzz',
+        # Comodines de LIKE: en los dos motores se buscan literalmente
+        '?q=%25', '?q=_', '?q=50%25', '?q=c_', '?q=%5C',
+    ]
+
+    def _comparar(self):
+        # Cada comparación hace dos búsquedas por consulta: que no las corte el límite de /productos?q
+        limitador.reiniciar()
+        for consulta in self.CONSULTAS:
+            self.client.application.config['CATALOGO_COLUMNAR'] = True
+            columnar = [p["id_producto"] for p in self.client.get(f'/productos{consulta}').json]
+            self.client.application.config['CATALOGO_COLUMNAR'] = False
+            sql = [p["id_producto"] for p in self.client.get(f'/productos{consulta}').json]
+            # Sin ORDER BY el orden de SQL no está definido
+            if 'orden=' not in consulta:
+                columnar, sql = sorted(columnar), sorted(sql)
+            assert columnar == sql, consulta
+        self.client.application.config['CATALOGO_COLUMNAR'] = True
+
+    def test_mismos_resultados_que_sql(self):
+        self._comparar()
+
+    def test_recarga_incremental_tras_escrituras(self):
+        self._comparar()
+        with self.client.application.app_context():
+            producto = Producto.query.filter_by(producto_nombre="Cargador").one()
+            producto.producto_nombre = "Cargador Alfa"
+            producto.producto_stock = 0
+            db.session.add(Producto(producto_nombre="Celular Gamma", producto_precio=700000, producto_stock=8,
+                                    descripcion="d", producto_foto="f.jpg", categoria_id=1, unidades_vendidas=20))
+            # Escritura masiva fuera del ORM (como checkout o el ajuste masivo)
+            Producto.query.filter(Producto.categoria_id == 3)\
+                .update({Producto.producto_stock: 6}, synchronize_session=False)
+            db.session.commit()
+        self._comparar()
+
+        with self.client.application.app_context():
+            Producto.query.filter_by(producto_nombre="Celular Beta").delete()
+            db.session.commit()
+        self._comparar()
+
+    def test_escritura_confirmada_tarde_entra_por_el_margen(self):
+        self._comparar()
+        with self.client.application.app_context():
+            # Transacción larga: sellada un minuto antes de la última fecha que ya vio el catálogo
+            atrasada = catalogo_columnar._marca - timedelta(seconds=60)
+            Producto.query.filter_by(producto_nombre="Cargador")\
+                .update({Producto.producto_precio: 2000000, Producto.fecha_actualizacion: atrasada},
+                        synchronize_session=False)
+            VersionRecurso.incrementar('catalogo')
+            db.session.commit()
+        self._comparar()
+
+    def test_recarga_completa_periodica(self):
+        self._comparar()
+        app = self.client.application
+        with app.app_context():
+            # Fuera de cualquier margen: solo la recarga completa lo recoge
+            Producto.query.filter_by(producto_nombre="Cargador")\
+                .update({Producto.producto_stock: 0, Producto.fecha_actualizacion: datetime(2000, 1, 1)},
+                        synchronize_session=False)
+            VersionRecurso.incrementar('catalogo')
+            db.session.commit()
+        app.config['CATALOGO_RECARGA_COMPLETA'] = 0
+        try:
+            self._comparar()
+        finally:
+            app.config['CATALOGO_RECARGA_COMPLETA'] = 900
+
 
 class TestVistaProducto:
     @pytest.fixture(autouse=True)
@@ -524,7 +697,31 @@ class TestVistaLogin:
         assert json_resp['mensaje'] == "Inicio de sesión exitoso"
         assert 'token' in json_resp
         assert json_resp['rol'] == self.usuario_rol_id  
-        assert 'carrito' in json_resp
+        assert 'carrito' not in json_resp
+
+        # El login ya no crea el carrito
+        with self.client.application.app_context():
+            assert Carrito.query.filter_by(id_usuario=self.usuario.id_usuario).count() == 0
+
+    def test_login_con_carrito_opcional(self):
+        """Con ?incluir_carrito=true se crea (si hace falta) y devuelve el carrito activo"""
+        payload = {"correo": "test@gmail.com", "contrasena": "123456789"}
+
+        response = self.client.post('/login?incluir_carrito=true', json=payload)
+        response2 = self.client.post('/login?incluir_carrito=true', json=payload)
+
+        assert response.status_code == 200
+        assert response.json['carrito']['id_usuario'] == self.usuario.id_usuario
+        assert response2.json['carrito']['id_carrito'] == response.json['carrito']['id_carrito']
+
+    def test_token_incluye_rol(self):
+        """El token debe llevar el rol como claim para los endpoints de admin"""
+        from flask_jwt_extended import decode_token
+
+        response = self.client.post('/login', json={"correo": "test@gmail.com", "contrasena": "123456789"})
+
+        with self.client.application.app_context():
+            assert decode_token(response.json['token'])['rol'] == self.usuario_rol_id
 
     def test_login_usuario_incorrecto(self):
         """Debe fallar al iniciar sesión con usuario incorrecto"""
@@ -705,12 +902,27 @@ class TestVistaCarrito:
         assert response.status_code == 200
         assert response.json["id_carrito"] == carrito_id
 
-    def test_sin_carrito_activo_devuelve_404(self):
+    def test_sin_carrito_activo_crea_uno_vacio(self):
         headers = {"Authorization": f"Bearer {self.token}"}
 
         response = self.client.get('/carrito', headers=headers)
-        assert response.status_code == 404
-        assert "no se encontró" in response.json["message"].lower()
+        assert response.status_code == 200
+        assert response.json["total"] == 0
+        assert response.json["procesado"] is False
+
+        # Las lecturas siguientes devuelven el mismo carrito, no uno nuevo
+        assert self.client.get('/carrito', headers=headers).json["id_carrito"] == response.json["id_carrito"]
+        with self.client.application.app_context():
+            assert Carrito.query.filter_by(id_usuario=self.usuario.id_usuario, procesado=False).count() == 1
+
+    def test_un_solo_carrito_abierto_por_usuario(self):
+        with self.client.application.app_context():
+            db.session.add(Carrito(id_usuario=self.usuario.id_usuario, total=0, procesado=False))
+            db.session.commit()
+            db.session.add(Carrito(id_usuario=self.usuario.id_usuario, total=0, procesado=False))
+            with pytest.raises(IntegrityError):
+                db.session.commit()
+            db.session.rollback()
 
     def test_delete_sin_producto_en_carrito_rechaza(self):
         headers = {"Authorization": f"Bearer {self.token}"}
@@ -970,7 +1182,7 @@ class TestVistaFactura:
         assert json_data["total"] == "$30,000"
         assert "factura_fecha" in json_data
         assert "message" in json_data
-        assert json_data["message"] == "Factura y detalles creados exitosamente, y correo enviado."
+        assert json_data["message"] == "Factura y detalles creados exitosamente, correo de la factura en cola de envío."
 
 
 
@@ -1005,3 +1217,1257 @@ class TestVistaFactura:
         assert response.status_code == 404
         assert "error" in response.json
         assert "Pago no encontrado" in response.json["error"]
+
+    def test_crear_factura_sentencias_constantes(self):
+        """Crear la factura cuesta las mismas sentencias SQL con 1 o con 100 líneas"""
+        from sqlalchemy import event
+
+        def crear_factura_contando(lineas):
+            with self.client.application.app_context():
+                db.session.query(DetalleFactura).delete()
+                db.session.query(Factura).delete()
+                db.session.query(CarritoProducto).delete()
+                productos = [
+                    Producto(producto_nombre=f"Producto {i}", producto_precio=100 + i, producto_stock=10,
+                             descripcion="Descripción", producto_foto="test.jpg", categoria_id=1)
+                    for i in range(lineas)
+                ]
+                db.session.add_all(productos)
+                db.session.flush()
+                db.session.add_all([
+                    CarritoProducto(id_carrito=self.carrito_id, id_producto=p.id_producto, cantidad=2)
+                    for p in productos
+                ])
+                db.session.commit()
+                motor = db.engine
+
+            sentencias = []
+            contar = lambda *args: sentencias.append(args[2])
+            event.listen(motor, 'before_cursor_execute', contar)
+            try:
+                response = self.client.post('/factura', json={"id_pago": self.pago_id},
+                                            headers={'Authorization': f'Bearer {self.token}'})
+            finally:
+                event.remove(motor, 'before_cursor_execute', contar)
+            assert response.status_code == 201
+            return response.json, len(sentencias)
+
+        json_1, sentencias_1 = crear_factura_contando(1)
+        json_100, sentencias_100 = crear_factura_contando(100)
+
+        assert sentencias_100 == sentencias_1
+        assert json_100["total"] == f"${sum(2 * (100 + i) for i in range(100)):,.0f}"
+        with self.client.application.app_context():
+            detalles = DetalleFactura.query.filter_by(id_factura=json_100["id_factura"]).all()
+            assert len(detalles) == 100
+            assert all(d.monto_total == d.cantidad * d.precio_unitario for d in detalles)
+
+    def test_factura_actualiza_contadores_y_orden_populares(self):
+        with self.client.application.app_context():
+            otro = Producto(producto_nombre="Producto Otro", producto_precio=100, producto_stock=10,
+                            descripcion="Descripción", producto_foto="test.jpg", categoria_id=1)
+            db.session.add(otro)
+            db.session.commit()
+            id_otro = otro.id_producto
+
+        for _ in range(2):
+            response = self.client.post('/factura', json={"id_pago": self.pago_id},
+                                        headers={'Authorization': f'Bearer {self.token}'})
+            assert response.status_code == 201
+
+        with self.client.application.app_context():
+            producto = Producto.query.get(self.producto_id)
+            assert producto.unidades_vendidas == 4
+            assert producto.ultima_venta is not None
+            assert Producto.query.get(id_otro).unidades_vendidas == 0
+
+        response = self.client.get('/productos?orden=populares')
+        assert [p["id_producto"] for p in response.json][:2] == [self.producto_id, id_otro]
+
+        # Un contador desviado se corrige con la tarea de reparación
+        with self.client.application.app_context():
+            Producto.query.filter_by(id_producto=self.producto_id).update({"unidades_vendidas": 99})
+            Producto.query.filter_by(id_producto=id_otro).update({"unidades_vendidas": 1})
+            db.session.commit()
+            assert reparar_contadores_ventas() == 2
+            assert Producto.query.get(self.producto_id).unidades_vendidas == 4
+            assert Producto.query.get(id_otro).unidades_vendidas == 0
+            assert reparar_contadores_ventas() == 0
+
+
+class TestCacheCondicional:
+    """Pruebas integradas para los GET condicionales (ETag / 304)"""
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+
+        with self.client.application.app_context():
+            db.session.rollback()
+            db.session.query(Producto).delete()
+            db.session.commit()
+
+            producto = Producto(
+                producto_nombre="Producto Cache",
+                producto_precio=100,
+                producto_stock=10,
+                descripcion="Descripción de prueba",
+                producto_foto="foto.jpg",
+                categoria_id=1
+            )
+            db.session.add(producto)
+            db.session.commit()
+            self.producto_id = producto.id_producto
+
+    def test_productos_304_con_if_none_match(self):
+        """Debe responder 304 sin cuerpo si el ETag no ha cambiado"""
+        response = self.client.get('/productos')
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        assert response.headers['Cache-Control'].startswith('public')
+
+        response = self.client.get('/productos', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+    def test_productos_etag_cambia_al_modificar_producto(self):
+        """Debe invalidar el ETag cuando se escribe un producto"""
+        etag = self.client.get('/productos').headers['ETag']
+
+        with self.client.application.app_context():
+            producto = Producto.query.get(self.producto_id)
+            producto.producto_stock = 5
+            db.session.commit()
+
+        response = self.client.get('/productos', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+    def test_stock_se_versiona_aparte_y_agrupado(self):
+        """Los cambios de stock no tocan 'catalogo' y se agrupan en una subida de 'stock' tras la ventana"""
+        app = self.client.application
+        etag = self.client.get('/productos').headers['ETag']
+        app.config['CATALOGO_VENTANA_STOCK'] = 0.3
+        try:
+            with app.app_context():
+                version_catalogo, _ = VersionRecurso.obtener('catalogo')
+                version_stock, _ = VersionRecurso.obtener('stock')
+                for stock in (5, 4, 3):
+                    producto = Producto.query.get(self.producto_id)
+                    producto.producto_stock = stock
+                    db.session.commit()
+                assert VersionRecurso.obtener('catalogo')[0] == version_catalogo
+                assert VersionRecurso.obtener('stock')[0] == version_stock
+
+            # Dentro de la ventana el ETag sigue valiendo; después cambia una sola vez
+            assert self.client.get('/productos', headers={'If-None-Match': etag}).status_code == 304
+            time.sleep(0.6)
+            with app.app_context():
+                assert VersionRecurso.obtener('stock')[0] == version_stock + 1
+            assert self.client.get('/productos', headers={'If-None-Match': etag}).status_code == 200
+        finally:
+            app.config['CATALOGO_VENTANA_STOCK'] = 0
+
+
+class TestResumenCategorias:
+    """GET /categorias?con_resumen=true: conteos y rango de precios por categoría"""
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+
+        with self.client.application.app_context():
+            db.session.rollback()
+            db.session.query(Producto).delete()
+            db.session.query(Categoria).delete()
+            db.session.commit()
+
+            celulares = Categoria(nombre="Celulares")
+            accesorios = Categoria(nombre="Accesorios")
+            vacia = Categoria(nombre="Vacía")
+            db.session.add_all([celulares, accesorios, vacia])
+            db.session.flush()
+            db.session.add_all([
+                Producto(producto_nombre=nombre, producto_precio=precio, producto_stock=stock,
+                         descripcion="d", producto_foto="f.jpg", categoria_id=categoria.id_categoria)
+                for nombre, precio, stock, categoria in [
+                    ("A", 900, 3, celulares), ("B", 1500, 0, celulares), ("C", 50, 7, accesorios),
+                ]
+            ])
+            db.session.commit()
+            self.id_celulares = celulares.id_categoria
+
+    def test_resumen_publico_en_una_consulta(self):
+        from sqlalchemy import event
+
+        with self.client.application.app_context():
+            motor = db.engine
+        sentencias = []
+        contar = lambda *args: sentencias.append(args[2])
+        event.listen(motor, 'before_cursor_execute', contar)
+        try:
+            response = self.client.get('/categorias?con_resumen=true')
+        finally:
+            event.remove(motor, 'before_cursor_execute', contar)
+
+        assert response.status_code == 200
+        assert response.headers['Cache-Control'].startswith('public')
+        assert response.json == [
+            {"id_categoria": response.json[0]["id_categoria"], "nombre": "Accesorios", "productos": 1,
+             "productos_en_stock": 1, "precio_minimo": 50, "precio_maximo": 50},
+            {"id_categoria": self.id_celulares, "nombre": "Celulares", "productos": 2,
+             "productos_en_stock": 1, "precio_minimo": 900, "precio_maximo": 1500},
+            {"id_categoria": response.json[2]["id_categoria"], "nombre": "Vacía", "productos": 0,
+             "productos_en_stock": 0, "precio_minimo": None, "precio_maximo": None},
+        ]
+        # Dos lecturas de versión y la consulta agrupada
+        assert len([s for s in sentencias if 'producto' in s and 'GROUP BY' in s]) == 1
+
+        # Sin resumen sigue haciendo falta el token
+        assert self.client.get('/categorias').status_code != 200
+        with self.client.application.app_context():
+            token = create_access_token(identity="1")
+        response = self.client.get('/categorias', headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        assert "productos" not in response.json[0]
+
+    def test_resumen_se_invalida_al_escribir_productos(self):
+        etag = self.client.get('/categorias?con_resumen=true').headers['ETag']
+        assert self.client.get('/categorias?con_resumen=true', headers={'If-None-Match': etag}).status_code == 304
+
+        with self.client.application.app_context():
+            Producto.query.filter_by(producto_nombre="B").one().producto_stock = 4
+            db.session.commit()
+
+        response = self.client.get('/categorias?con_resumen=true', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        celulares = next(c for c in response.json if c["nombre"] == "Celulares")
+        assert celulares["productos_en_stock"] == 2
+
+
+class TestCompresion:
+    """Pruebas integradas para la compresión de respuestas"""
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+        self.config = self.client.application.config
+        self.tamano_minimo = self.config['COMPRESION_TAMANO_MINIMO']
+        yield
+        self.config['COMPRESION_TAMANO_MINIMO'] = self.tamano_minimo
+
+    def test_respuesta_comprimida_con_gzip(self):
+        """Debe comprimir con gzip si el cliente lo acepta y supera el umbral"""
+        import gzip
+        self.config['COMPRESION_TAMANO_MINIMO'] = 0
+
+        response = self.client.get('/productos', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert isinstance(json.loads(gzip.decompress(response.data)), list)
+
+    def test_respuesta_bajo_umbral_sin_comprimir(self):
+        """No debe comprimir respuestas por debajo del tamaño mínimo"""
+        self.config['COMPRESION_TAMANO_MINIMO'] = 10 ** 9
+
+        response = self.client.get('/productos', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.status_code == 200
+        assert 'Content-Encoding' not in response.headers
+
+
+class TestExportacion:
+    """Pruebas integradas para la exportación NDJSON/CSV en streaming"""
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+
+        with self.client.application.app_context():
+            db.session.rollback()
+            db.session.query(DetalleFactura).delete()
+            db.session.query(Factura).delete()
+            db.session.query(Pago).delete()
+            db.session.commit()
+
+            pago = Pago(id_carrito=1, monto=30000, metodo_pago="tarjeta", estado="completado")
+            db.session.add(pago)
+            db.session.commit()
+            self.pago_id = pago.id_pago
+
+            self.token = create_access_token(identity="1")
+
+    def test_exportar_pagos_ndjson(self):
+        """Debe devolver una línea JSON por pago"""
+        response = self.client.get('/pagos?format=ndjson', headers={'Authorization': f'Bearer {self.token}'})
+
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        lineas = [json.loads(linea) for linea in response.data.decode('utf-8').splitlines()]
+        assert lineas[0]['id_pago'] == self.pago_id
+        assert lineas[0]['monto'] == 30000
+
+    def test_exportar_pagos_csv(self):
+        """Debe devolver un CSV con cabecera"""
+        response = self.client.get('/pagos?format=csv', headers={'Authorization': f'Bearer {self.token}'})
+
+        assert response.status_code == 200
+        assert response.mimetype == 'text/csv'
+        lineas = response.data.decode('utf-8').splitlines()
+        assert lineas[0] == 'id_pago,id_carrito,monto,fecha_pago,metodo_pago,estado'
+        assert len(lineas) == 2
+
+    def test_formato_no_soportado(self):
+        """Debe rechazar formatos desconocidos"""
+        response = self.client.get('/pagos?format=xml', headers={'Authorization': f'Bearer {self.token}'})
+
+        assert response.status_code == 400
+
+
+class TestVistaEnviosAdmin:
+    """Pruebas integradas para el listado paginado de envíos del admin"""
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+
+        with self.client.application.app_context():
+            db.session.rollback()
+            db.session.query(HistorialEnvio).delete()
+            db.session.query(Envio).delete()
+            db.session.commit()
+
+            if not Rol.query.get(1):
+                rol_admin = Rol(nombre_rol="Admin Envios")
+                rol_admin.rol_id = 1
+                db.session.add(rol_admin)
+                db.session.commit()
+
+            admin = Usuario.query.filter_by(correo="admin_envios@gmail.com").first()
+            if not admin:
+                admin = Usuario(nombre="Admin Envios", numerodoc=55501, correo="admin_envios@gmail.com",
+                                contrasena="admin12345", rol_id=1)
+                db.session.add(admin)
+
+            factura = Factura(total=1000)
+            db.session.add(factura)
+            db.session.commit()
+
+            ciudades = ['Bogotá', 'Cali', 'Bogotá', 'Medellín', 'Bogotá']
+            for dia, ciudad in enumerate(ciudades, start=1):
+                db.session.add(Envio(
+                    direccion="Calle 1", ciudad=ciudad, departamento="Test", codigo_postal="110111",
+                    pais="Colombia", estado_envio="Empacando", fecha_creacion=datetime(2025, 1, dia),
+                    usuario_id=admin.id_usuario, id_factura=factura.id_factura
+                ))
+            orden = Orden(id_usuario=admin.id_usuario, id_factura=factura.id_factura, monto_total=1000)
+            db.session.add(orden)
+            db.session.commit()
+            self.id_orden = orden.id_orden
+            self.id_envio = Envio.query.filter_by(id_factura=factura.id_factura).first().id
+
+            self.token = create_access_token(identity=str(admin.id_usuario))
+
+    def test_filtro_por_ciudad(self):
+        """Debe devolver solo los envíos de la ciudad pedida, más recientes primero"""
+        response = self.client.get('/api/admin/envios?ciudad=Bogotá',
+                                   headers={'Authorization': f'Bearer {self.token}'})
+
+        assert response.status_code == 200
+        fechas = [envio['fecha_creacion'] for envio in response.json['envios']]
+        assert len(fechas) == 3
+        assert fechas == sorted(fechas, reverse=True)
+        assert response.json['total_estimado'] == 3
+
+    def test_paginacion_por_cursor(self):
+        """Debe recorrer todas las páginas sin repetir envíos"""
+        headers = {'Authorization': f'Bearer {self.token}'}
+        vistos = []
+        url = '/api/admin/envios?limite=2'
+        while url:
+            response = self.client.get(url, headers=headers)
+            assert response.status_code == 200
+            vistos.extend(envio['id_envio'] for envio in response.json['envios'])
+            cursor = response.json['siguiente_cursor']
+            url = f'/api/admin/envios?limite=2&cursor={cursor}' if cursor else None
+
+        assert len(vistos) == 5
+        assert len(set(vistos)) == 5
+
+    def test_fecha_creacion_obligatoria(self):
+        """Un envío sin fecha rompería el cursor (fecha_creacion, id): la base lo rechaza"""
+        with self.client.application.app_context():
+            envio = Envio.query.get(self.id_envio)
+            envio.fecha_creacion = None
+            with pytest.raises(IntegrityError):
+                db.session.commit()
+            db.session.rollback()
+
+    def test_estado_invalido(self):
+        """Debe rechazar estados fuera de Envio.ESTADOS_VALIDOS"""
+        response = self.client.get('/api/admin/envios?estado_envio=Perdido',
+                                   headers={'Authorization': f'Bearer {self.token}'})
+
+        assert response.status_code == 400
+
+    def test_actualizar_estado_registra_historial(self):
+        """Debe guardar la transición en historial_envio"""
+        response = self.client.patch(f'/api/admin/envios/{self.id_envio}/estado',
+                                     json={'nuevo_estado': 'Validando'},
+                                     headers={'Authorization': f'Bearer {self.token}'})
+
+        assert response.status_code == 200
+        with self.client.application.app_context():
+            historial = HistorialEnvio.query.filter_by(id_envio=self.id_envio).all()
+            assert len(historial) == 1
+            assert historial[0].estado_anterior == 'Empacando'
+            assert historial[0].estado_nuevo == 'Validando'
+
+    def test_stream_envia_estado_inicial(self):
+        """El stream SSE debe empezar con el estado actual del envío"""
+        response = self.client.get(f'/api/envios/{self.id_orden}/estado/stream?jwt={self.token}',
+                                   buffered=False)
+
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        trozos = iter(response.response)
+        assert next(trozos).startswith(b'retry:')
+        evento = next(trozos).decode('utf-8')
+        response.close()
+
+        assert evento.startswith('event: estado')
+        assert json.loads(evento.split('data: ', 1)[1])['estado_envio'] == 'Empacando'
+
+    def test_transicion_no_permitida(self):
+        """No debe permitir saltar de Empacando a Entregado"""
+        response = self.client.patch(f'/api/admin/envios/{self.id_envio}/estado',
+                                     json={'nuevo_estado': 'Tu Pedido Ya Ha Sido Entregado'},
+                                     headers={'Authorization': f'Bearer {self.token}'})
+
+        assert response.status_code == 400
+
+    def test_actualizacion_masiva(self):
+        """Debe mover varios envíos y reportar los rechazados y no encontrados"""
+        with self.client.application.app_context():
+            ids = [envio.id for envio in Envio.query.order_by(Envio.id).all()]
+            entregado = Envio.query.get(ids[0])
+            entregado.estado_envio = 'Tu Pedido Ya Ha Sido Entregado'
+            db.session.commit()
+
+        response = self.client.patch('/api/admin/envios/estado',
+                                     json={'ids_envio': ids + [999999], 'nuevo_estado': 'En Camino a Tu Hogar'},
+                                     headers={'Authorization': f'Bearer {self.token}'})
+
+        assert response.status_code == 200
+        assert response.json['actualizados'] == ids[1:]
+        assert [r['id_envio'] for r in response.json['rechazados']] == [ids[0]]
+        assert response.json['no_encontrados'] == [999999]
+        with self.client.application.app_context():
+            assert HistorialEnvio.query.filter(HistorialEnvio.id_envio.in_(ids)).count() == len(ids) - 1
+            assert Envio.query.get(ids[1]).estado_envio == 'En Camino a Tu Hogar'
+
+    def test_actualizacion_masiva_valida_tipos(self):
+        """Booleanos como ids y estados que no son texto se rechazan con 400, no con 500"""
+        for payload in [
+            {'ids_envio': [True], 'nuevo_estado': 'Validando'},
+            {'ids_envio': [self.id_envio, False], 'nuevo_estado': 'Validando'},
+            {'ids_envio': [self.id_envio], 'nuevo_estado': ['Validando']},
+            {'ids_envio': [self.id_envio], 'nuevo_estado': {'estado': 'Validando'}},
+        ]:
+            response = self.client.patch('/api/admin/envios/estado', json=payload,
+                                         headers={'Authorization': f'Bearer {self.token}'})
+            assert response.status_code == 400, payload
+
+    def test_cliente_no_accede_a_endpoints_admin(self):
+        """Un token con rol de cliente debe recibir 403 sin consultar al usuario"""
+        with self.client.application.app_context():
+            token_cliente = create_access_token(identity="999999", additional_claims={"rol": 2})
+
+        response = self.client.get('/api/admin/envios', headers={'Authorization': f'Bearer {token_cliente}'})
+
+        assert response.status_code == 403
+
+
+class TestLimitador:
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+        self.config = client.application.config
+
+    def test_login_supera_presupuesto_por_ip(self):
+        """Agotado el bucket de /login responde 429 con Retry-After"""
+        capacidad = self.config['LIMITES_TASA']['/login'][0]
+        payload = {"correo": "nadie@gmail.com", "contrasena": "x"}
+
+        codigos = [self.client.post('/login', json=payload).status_code for _ in range(capacidad + 1)]
+
+        assert codigos[:capacidad] == [401] * capacidad
+        respuesta = self.client.post('/login', json=payload)
+        assert respuesta.status_code == 429
+        assert int(respuesta.headers['Retry-After']) >= 1
+
+        # Otra IP tiene su propio bucket
+        otra = self.client.post('/login', json=payload, environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        assert otra.status_code == 401
+
+    def test_busqueda_limitada_solo_con_q(self):
+        """El presupuesto de /productos?q no afecta al listado sin búsqueda"""
+        capacidad = self.config['LIMITES_TASA']['/productos?q'][0]
+        for _ in range(capacidad):
+            self.client.get('/productos?q=telefono')
+
+        assert self.client.get('/productos?q=telefono').status_code == 429
+        assert self.client.get('/productos').status_code == 200
+
+    def test_descarte_por_prioridad(self):
+        """Con la concurrencia al límite se descarta todo salvo pago y factura"""
+        limitador._en_curso[limitador._mi_ranura()] = self.config['LIMITE_CONCURRENCIA']
+
+        assert self.client.get('/productos').status_code == 503
+        assert self.client.post('/login', json={}).status_code == 503
+        with self.client.application.app_context():
+            headers = {"Authorization": f"Bearer {create_access_token(identity='999999')}"}
+        # Se admiten (y fallan después por falta de carrito, no por carga)
+        assert self.client.post('/pago', json={}, headers=headers).status_code == 400
+        assert self.client.post('/factura', json={}, headers=headers).status_code != 503
+        assert limitador.en_curso == self.config['LIMITE_CONCURRENCIA']
+
+    def test_worker_muerto_no_deja_plazas_ni_lock(self):
+        """Las plazas y el lock de un worker matado a mitad de petición se recuperan"""
+        import subprocess, sys
+        proceso = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proceso.wait()
+        muerto = proceso.pid
+
+        ranura = limitador._mi_ranura()
+        otra = next(i for i in range(len(limitador._pids)) if i != ranura and limitador._pids[i] == 0)
+        limitador._pids[otra] = muerto
+        limitador._en_curso[otra] = self.config['LIMITE_CONCURRENCIA']
+        assert self.client.get('/productos').status_code == 503
+
+        # El lock quedó tomado por el worker muerto: se recupera en lugar de bloquear
+        limitador._lock.acquire()
+        limitador._dueno_lock.value = muerto
+        limitador.liberar_worker(muerto)
+        assert limitador.en_curso == 0
+        assert self.client.get('/productos?q=telefono').status_code == 200
+
+        limitador._lock.acquire()
+        limitador._dueno_lock.value = muerto
+        assert self.client.get('/productos?q=telefono').status_code == 200
+        assert limitador._dueno_lock.value == 0
+
+    def test_buckets_asociativos_no_rellenan_clientes_limitados(self):
+        """Otras claves del mismo conjunto desalojan buckets llenos, no el de un cliente limitado"""
+        from flask import Flask
+        from flaskr.utilidades import LimitadorTasa
+        app = Flask('limitador_prueba')
+        app.config['LIMITE_TASA_RANURAS'] = 4  # un único conjunto
+        propio = LimitadorTasa(app)
+
+        assert propio._consumir(['cliente'], 1, 1 / 60) == 0
+        assert propio._consumir(['cliente'], 1, 1 / 60) > 0
+        for i in range(20):
+            propio._consumir([f'otro{i}'], 5, 1000)
+            time.sleep(0.01)
+        assert propio._consumir(['cliente'], 1, 1 / 60) > 0
+
+    def test_descarte_temprano_de_rutas_limitadas(self):
+        """Las rutas limitadas se descartan antes que el resto"""
+        limitador._en_curso[limitador._mi_ranura()] = self.config['LIMITE_CONCURRENCIA_BAJA']
+
+        assert self.client.post('/login', json={}).status_code == 503
+        assert self.client.get('/productos').status_code == 200
+
+
+class TestVistaCheckout:
+    """Pruebas integradas para POST /checkout"""
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+
+        with self.client.application.app_context():
+            db.session.rollback()
+            db.session.query(HistorialEnvio).delete()
+            db.session.query(Envio).delete()
+            db.session.query(Orden).delete()
+            db.session.query(DetalleFactura).delete()
+            db.session.query(Factura).delete()
+            db.session.query(CorreoPendiente).delete()
+            db.session.query(TarjetaDetalle).delete()
+            db.session.query(Pago).delete()
+            db.session.query(CarritoProducto).delete()
+            db.session.query(Carrito).delete()
+            db.session.query(Producto).delete()
+            db.session.query(Usuario).delete()
+            db.session.commit()
+
+            usuario = Usuario(nombre="Comprador", numerodoc=55555, correo="comprador@gmail.com", rol_id=2)
+            usuario.contrasena = "123456789"
+            productos = [
+                Producto(producto_nombre=f"Celular {i}", producto_precio=1000 * i, producto_stock=5,
+                         descripcion="Descripción", producto_foto="foto.jpg", categoria_id=1)
+                for i in (1, 2)
+            ]
+            db.session.add_all([usuario] + productos)
+            db.session.flush()
+            carrito = Carrito(id_usuario=usuario.id_usuario, total=5000)
+            db.session.add(carrito)
+            db.session.flush()
+            db.session.add_all([
+                CarritoProducto(id_carrito=carrito.id_carrito, id_producto=productos[0].id_producto, cantidad=1),
+                CarritoProducto(id_carrito=carrito.id_carrito, id_producto=productos[1].id_producto, cantidad=2),
+            ])
+            db.session.commit()
+
+            self.id_carrito = carrito.id_carrito
+            self.ids_producto = [p.id_producto for p in productos]
+            self.headers = {"Authorization": f"Bearer {create_access_token(identity=str(usuario.id_usuario))}"}
+
+        self.payload = {
+            "metodo_pago": "tarjeta",
+            "pago": {"numero_tarjeta": "4111111111111111", "nombre_en_tarjeta": "COMPRADOR",
+                     "cvv": "123", "fecha_expiracion": "1299"},
+            "envio": {"direccion": "Calle 1", "ciudad": "Bogota", "departamento": "Cundinamarca",
+                      "codigo_postal": "110111", "pais": "Colombia"}
+        }
+
+    def test_checkout_exitoso(self):
+        response = self.client.post('/checkout', json=self.payload, headers=self.headers)
+
+        assert response.status_code == 201
+        datos = response.json
+        assert datos["total"] == "$5,000"
+
+        with self.client.application.app_context():
+            pago = Pago.query.get(datos["id_pago"])
+            assert pago.monto == 5000 and pago.metodo_pago == "tarjeta"
+            assert TarjetaDetalle.query.filter_by(id_pago=pago.id_pago).count() == 1
+            assert Factura.query.get(datos["id_factura"]).total == 5000
+            assert DetalleFactura.query.filter_by(id_factura=datos["id_factura"]).count() == 2
+            assert Orden.query.get(datos["id_orden"]).monto_total == 5000
+            assert Envio.query.get(datos["id_envio"]).estado_envio == "Empacando"
+            assert Carrito.query.get(self.id_carrito).procesado is True
+            assert [Producto.query.get(i).producto_stock for i in self.ids_producto] == [4, 3]
+            # El correo queda en la bandeja de salida, en la misma transacción
+            correo = CorreoPendiente.query.filter_by(destinatario="comprador@gmail.com").one()
+            assert correo.datos["factura_id"] == datos["id_factura"]
+
+    def test_sin_stock_no_escribe_nada(self):
+        with self.client.application.app_context():
+            Producto.query.get(self.ids_producto[1]).producto_stock = 1
+            db.session.commit()
+
+        response = self.client.post('/checkout', json=self.payload, headers=self.headers)
+
+        assert response.status_code == 409
+        assert "Celular 2" in response.json["error"]
+        with self.client.application.app_context():
+            assert Pago.query.count() == 0
+            assert Factura.query.count() == 0
+            assert Carrito.query.get(self.id_carrito).procesado is False
+            assert [Producto.query.get(i).producto_stock for i in self.ids_producto] == [5, 1]
+
+    def test_valida_antes_de_escribir(self):
+        self.payload["pago"]["cvv"] = "12"
+        response = self.client.post('/checkout', json=self.payload, headers=self.headers)
+        assert response.status_code == 400
+        assert "CVV" in response.json["error"]
+
+        del self.payload["envio"]["ciudad"]
+        self.payload["pago"]["cvv"] = "123"
+        response = self.client.post('/checkout', json=self.payload, headers=self.headers)
+        assert response.status_code == 400
+        assert "envio.ciudad" in response.json["error"]
+
+
+class TestDespachadorCorreos:
+    """Renderizado y envío en lote de la bandeja de salida"""
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+
+        with self.client.application.app_context():
+            db.session.query(CorreoPendiente).delete()
+            db.session.query(DetalleFactura).delete()
+            db.session.query(Factura).delete()
+            db.session.query(Producto).delete()
+            db.session.commit()
+
+            producto = Producto(producto_nombre="Celular Correo", producto_precio=1500, producto_stock=5,
+                                descripcion="Descripción", producto_foto="foto.jpg", categoria_id=1)
+            db.session.add(producto)
+            db.session.flush()
+            self.ids_factura = []
+            for i in range(3):
+                factura = Factura(id_pago=1, total=1500 * (i + 1))
+                db.session.add(factura)
+                db.session.flush()
+                db.session.add(DetalleFactura(id_factura=factura.id_factura, id_producto=producto.id_producto,
+                                              cantidad=i + 1, precio_unitario=1500, monto_total=1500 * (i + 1)))
+                despachador_correos.encolar_factura(f"cliente{i}@gmail.com", factura.id_factura,
+                                                    "2026-10-19 10:00:00", 1500 * (i + 1))
+                self.ids_factura.append(factura.id_factura)
+            db.session.commit()
+
+    def test_despacha_lote_por_una_conexion(self):
+        with self.client.application.app_context():
+            with patch('flaskr.mail.connect') as conectar:
+                conexion = conectar.return_value.__enter__.return_value
+                procesados = despachador_correos.despachar_pendientes()
+
+            assert procesados == 3
+            assert conectar.call_count == 1
+            mensajes = [llamada.args[0] for llamada in conexion.send.call_args_list]
+            assert [m.recipients for m in mensajes] == [[f"cliente{i}@gmail.com"] for i in range(3)]
+            assert "Celular Correo" in mensajes[2].html and "Cantidad: 3" in mensajes[2].html
+            assert "$4.500" in mensajes[2].html
+            assert CorreoPendiente.query.filter(CorreoPendiente.fecha_envio.is_(None)).count() == 0
+            assert despachador_correos.despachar_pendientes() == 0
+
+    def test_fallo_de_envio_se_reintenta(self):
+        with self.client.application.app_context():
+            with patch('flaskr.mail.connect') as conectar:
+                conexion = conectar.return_value.__enter__.return_value
+                conexion.send.side_effect = [None, Exception("SMTP caído"), None]
+                despachador_correos.despachar_pendientes()
+
+            fallido = CorreoPendiente.query.filter(CorreoPendiente.fecha_envio.is_(None)).one()
+            assert fallido.intentos == 1
+            assert fallido.ultimo_error == "SMTP caído"
+            assert fallido.fecha_reclamo is None
+            # Espera antes del reintento: la pasada siguiente no lo toma
+            assert fallido.proximo_intento > datetime.utcnow()
+            with patch('flaskr.mail.connect') as conectar:
+                assert despachador_correos.despachar_pendientes() == 0
+            fallido.proximo_intento = datetime.utcnow() - timedelta(seconds=1)
+            db.session.commit()
+            with patch('flaskr.mail.connect'):
+                assert despachador_correos.despachar_pendientes() == 1
+
+    def test_fallo_de_conexion_aplaza_sin_gastar_intentos(self):
+        app = self.client.application
+        with app.app_context():
+            lote = app.config['CORREO_LOTE']
+            app.config['CORREO_LOTE'] = 3
+            try:
+                with patch('flaskr.mail.connect') as conectar:
+                    conectar.return_value.__enter__.side_effect = ConnectionRefusedError("sin SMTP")
+                    # Devuelve 0 aunque el lote estuviera lleno: el bucle no reintenta en caliente
+                    assert despachador_correos.despachar_pendientes() == 0
+                    assert despachador_correos.despachar_pendientes() == 0
+                    assert conectar.call_count == 1
+            finally:
+                app.config['CORREO_LOTE'] = lote
+
+            correos = CorreoPendiente.query.all()
+            assert [c.intentos for c in correos] == [0, 0, 0]
+            assert all(c.fecha_envio is None and c.fecha_reclamo is None for c in correos)
+            assert all(c.proximo_intento > datetime.utcnow() for c in correos)
+            assert correos[0].ultimo_error == "sin SMTP"
+
+    def test_correo_que_no_renderiza_no_frena_la_cola(self):
+        with self.client.application.app_context():
+            roto = CorreoPendiente.query.order_by(CorreoPendiente.id).first()
+            roto.datos = {'sin_factura': True}
+            db.session.commit()
+
+            with patch('flaskr.mail.connect') as conectar:
+                conexion = conectar.return_value.__enter__.return_value
+                assert despachador_correos.despachar_pendientes() == 3
+            assert conexion.send.call_count == 2
+
+            roto = CorreoPendiente.query.get(roto.id)
+            assert roto.fecha_envio is None and roto.fecha_reclamo is None
+            assert roto.intentos == 1 and roto.ultimo_error
+            assert CorreoPendiente.query.filter(CorreoPendiente.fecha_envio.isnot(None)).count() == 2
+
+    def test_envio_fuera_de_la_transaccion_del_reclamo(self):
+        with self.client.application.app_context():
+            with patch('flaskr.mail.connect') as conectar:
+                reclamados = []
+                def enviar(mensaje):
+                    # Durante el SMTP la fila ya está reclamada y confirmada
+                    with db.engine.connect() as conexion:
+                        reclamados.append(conexion.execute(
+                            db.text("SELECT COUNT(*) FROM correo_pendiente WHERE fecha_reclamo IS NOT NULL")
+                        ).scalar())
+                conectar.return_value.__enter__.return_value.send.side_effect = enviar
+                despachador_correos.despachar_pendientes()
+
+            assert reclamados == [3, 3, 3]
+            # Un reclamo vigente no se vuelve a tomar; uno caducado sí
+            correo = CorreoPendiente.query.first()
+            correo.fecha_envio, correo.fecha_reclamo = None, datetime.utcnow()
+            db.session.commit()
+            assert despachador_correos.despachar_pendientes() == 0
+            correo.fecha_reclamo = datetime.utcnow() - timedelta(hours=1)
+            db.session.commit()
+            with patch('flaskr.mail.connect'):
+                assert despachador_correos.despachar_pendientes() == 1
+
+
+class TestEventosStock:
+    """Umbrales de reposición, listado de bajo stock y eventos de cruce"""
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+
+        with self.client.application.app_context():
+            db.session.rollback()
+            db.session.query(EventoStock).delete()
+            db.session.query(HistorialStock).delete()
+            db.session.query(HistorialStockArchivo).delete()
+            db.session.query(FotoStock).delete()
+            db.session.query(DetalleFactura).delete()
+            db.session.query(CarritoProducto).delete()
+            db.session.query(Producto).delete()
+            db.session.query(Categoria).delete()
+            db.session.commit()
+
+            if not Rol.query.get(1):
+                rol_admin = Rol(nombre_rol="Admin Stock")
+                rol_admin.rol_id = 1
+                db.session.add(rol_admin)
+                db.session.commit()
+            admin = Usuario.query.filter_by(correo="admin_stock@gmail.com").first()
+            if not admin:
+                admin = Usuario(nombre="Admin Stock", numerodoc=55601, correo="admin_stock@gmail.com",
+                                contrasena="admin12345", rol_id=1)
+                db.session.add(admin)
+                db.session.commit()
+            self.headers = {"Authorization": f"Bearer {create_access_token(identity=str(admin.id_usuario))}"}
+
+            categoria = Categoria(nombre="Accesorios", umbral_reposicion=3)
+            db.session.add(categoria)
+            db.session.flush()
+            self.id_categoria = categoria.id_categoria
+
+            # Hereda el umbral de la categoría, usa el de por defecto, y umbral propio
+            self.productos = [
+                Producto(producto_nombre="Cargador", producto_precio=100, producto_stock=4,
+                         descripcion="d", producto_foto="f.jpg", categoria_id=categoria.id_categoria),
+                Producto(producto_nombre="Celular", producto_precio=900, producto_stock=9,
+                         descripcion="d", producto_foto="f.jpg", categoria_id=999),
+                Producto(producto_nombre="Funda", producto_precio=50, producto_stock=15, umbral_reposicion=20,
+                         descripcion="d", producto_foto="f.jpg", categoria_id=999),
+            ]
+            db.session.add_all(self.productos)
+            db.session.commit()
+            self.ids = [p.id_producto for p in self.productos]
+
+    def test_umbral_inicial_y_listado_bajo_stock(self):
+        with self.client.application.app_context():
+            assert [Producto.query.get(i).umbral_reposicion for i in self.ids] == [3, 10, 20]
+
+        response = self.client.get('/api/productos/bajo-stock', headers=self.headers)
+        assert response.status_code == 200
+        assert [p["nombre"] for p in response.json["productos"]] == ["Celular", "Funda"]
+        assert response.json["productos"][1]["umbral_reposicion"] == 20
+
+    def test_umbral_de_categoria_se_aplica_a_sus_productos(self):
+        etag = self.client.get('/productos').headers['ETag']
+        response = self.client.put(f'/categoria/{self.id_categoria}', json={"umbral_reposicion": 5},
+                                   headers=self.headers)
+        assert response.status_code == 200
+
+        response = self.client.get('/api/productos/bajo-stock', headers=self.headers)
+        assert "Cargador" in [p["nombre"] for p in response.json["productos"]]
+
+        # El UPDATE masivo también emite el cruce y cambia la versión del catálogo
+        eventos = self.client.get('/api/admin/eventos-stock', headers=self.headers).json["eventos"]
+        assert [(e["id_producto"], e["tipo"], e["stock_nuevo"], e["umbral"]) for e in eventos] == [
+            (self.ids[0], "stock_bajo", 4, 5),
+        ]
+        assert self.client.get('/productos', headers={'If-None-Match': etag}).status_code == 200
+
+    def test_umbral_de_producto_validado_y_con_evento(self):
+        for umbral in ("abc", None, -1, True):
+            response = self.client.put(f'/productos/{self.ids[2]}', json={"umbral_reposicion": umbral},
+                                       headers=self.headers)
+            assert response.status_code == 400
+
+        # Bajar el umbral de Funda (stock 15) por debajo de su stock la repone
+        response = self.client.put(f'/productos/{self.ids[2]}', json={"umbral_reposicion": 10}, headers=self.headers)
+        assert response.status_code == 200
+        eventos = self.client.get('/api/admin/eventos-stock', headers=self.headers).json["eventos"]
+        assert [(e["id_producto"], e["tipo"], e["umbral"]) for e in eventos] == [(self.ids[2], "stock_repuesto", 10)]
+
+    def test_ajuste_que_repone_emite_evento(self):
+        response = self.client.post(f'/productos/{self.ids[1]}/ajuste-stock', json={"cantidad": 5},
+                                    headers=self.headers)
+        assert response.status_code == 200
+
+        # Otro ajuste que no cruza el umbral no emite nada
+        self.client.post(f'/productos/{self.ids[1]}/ajuste-stock', json={"cantidad": 1}, headers=self.headers)
+
+        response = self.client.get('/api/admin/eventos-stock', headers=self.headers)
+        eventos = response.json["eventos"]
+        assert [(e["id_producto"], e["tipo"], e["stock_anterior"], e["stock_nuevo"]) for e in eventos] == [
+            (self.ids[1], "stock_repuesto", 9, 14)
+        ]
+
+        siguiente = self.client.get(f'/api/admin/eventos-stock?despues_de={response.json["ultimo_id"]}',
+                                    headers=self.headers)
+        assert siguiente.json["eventos"] == []
+
+    def test_venta_que_cruza_umbral_emite_evento(self):
+        """Tanto el camino ORM de /pago como el UPDATE masivo de /checkout"""
+        with self.client.application.app_context():
+            usuario = Usuario.query.filter_by(correo="admin_stock@gmail.com").first()
+            db.session.query(Carrito).filter_by(id_usuario=usuario.id_usuario).delete()
+            carrito = Carrito(id_usuario=usuario.id_usuario, total=0)
+            db.session.add(carrito)
+            db.session.flush()
+            db.session.add(CarritoProducto(id_carrito=carrito.id_carrito, id_producto=self.ids[0], cantidad=2))
+            db.session.commit()
+
+        response = self.client.post('/pago', json={"metodo_pago": "paypal"}, headers=self.headers)
+        assert response.status_code == 201
+
+        with self.client.application.app_context():
+            usuario = Usuario.query.filter_by(correo="admin_stock@gmail.com").first()
+            carrito = Carrito.query.filter_by(id_usuario=usuario.id_usuario, procesado=False).first()
+            db.session.add(CarritoProducto(id_carrito=carrito.id_carrito, id_producto=self.ids[2], cantidad=1))
+            db.session.commit()
+
+        response = self.client.post('/checkout', headers=self.headers, json={
+            "metodo_pago": "paypal",
+            "pago": {"email_paypal": "a@b.co", "confirmacion_id": "123"},
+            "envio": {"direccion": "Calle 1", "ciudad": "Bogota", "departamento": "Cundinamarca",
+                      "codigo_postal": "110111", "pais": "Colombia"}
+        })
+        assert response.status_code == 201
+
+        eventos = self.client.get('/api/admin/eventos-stock', headers=self.headers).json["eventos"]
+        assert [(e["id_producto"], e["tipo"], e["stock_nuevo"], e["umbral"]) for e in eventos] == [
+            (self.ids[0], "stock_bajo", 2, 3),
+        ]
+
+    def test_difusor_reparte_ids_confirmados_fuera_de_orden(self):
+        """Un id menor que se confirma después de otro mayor también llega a los suscriptores"""
+        def evento(id_evento):
+            return EventoStock(id=id_evento, id_producto=self.ids[0], tipo='stock_bajo',
+                               stock_anterior=4, stock_nuevo=2, umbral=3)
+
+        with self.client.application.app_context():
+            base = db.session.query(db.func.max(EventoStock.id)).scalar() or 0
+            difusor_eventos_stock._ultimo_id = base
+            difusor_eventos_stock._huecos = {}
+            try:
+                with patch.object(difusor_eventos_stock, 'publicar') as publicar:
+                    # La transacción con id N+1 confirma antes que la de id N
+                    db.session.add(evento(base + 2))
+                    db.session.commit()
+                    difusor_eventos_stock._repartir_cambios([None])
+                    assert list(difusor_eventos_stock._huecos) == [base + 1]
+
+                    db.session.add(evento(base + 1))
+                    db.session.commit()
+                    difusor_eventos_stock._repartir_cambios([None])
+                    difusor_eventos_stock._repartir_cambios([None])
+
+                assert [c.args[1]['id'] for c in publicar.call_args_list] == [base + 2, base + 1]
+                assert difusor_eventos_stock._huecos == {}
+            finally:
+                difusor_eventos_stock._ultimo_id = None
+
+    def test_eventos_solo_para_admin(self):
+        with self.client.application.app_context():
+            token = create_access_token(identity="999999", additional_claims={"rol": 2})
+        response = self.client.get('/api/admin/eventos-stock', headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 403
+
+    def test_ajuste_masivo_json(self):
+        response = self.client.post('/productos/ajuste-stock', headers=self.headers, json={"ajustes": [
+            {"id_producto": self.ids[0], "cantidad": 6, "motivo": "Pedido 12"},
+            {"id_producto": self.ids[1], "cantidad": 2},
+            {"id_producto": self.ids[0], "cantidad": 4, "motivo": "Pedido 13"},
+        ]})
+        assert response.status_code == 200
+        assert response.json["productos_actualizados"] == 2
+        assert response.json["unidades"] == 12
+
+        with self.client.application.app_context():
+            assert Producto.query.get(self.ids[0]).producto_stock == 14
+            assert Producto.query.get(self.ids[1]).producto_stock == 11
+            registro = HistorialStock.query.filter_by(id_producto=self.ids[0]).one()
+            assert (registro.stock_anterior, registro.cantidad_ajuste, registro.nuevo_stock) == (4, 10, 14)
+            assert registro.motivo == "Pedido 12; Pedido 13"
+
+        eventos = self.client.get('/api/admin/eventos-stock', headers=self.headers).json["eventos"]
+        assert [(e["id_producto"], e["tipo"]) for e in eventos] == [(self.ids[1], "stock_repuesto")]
+
+    def test_ajuste_masivo_csv(self):
+        contenido = f"id_producto,cantidad,motivo\n{self.ids[2]},5,Muelle 3\n{self.ids[1]},1,\n".encode('utf-8')
+        response = self.client.post('/productos/ajuste-stock', headers=self.headers,
+                                    data={"archivo": (io.BytesIO(contenido), "entrada.csv")},
+                                    content_type='multipart/form-data')
+        assert response.status_code == 200
+
+        response = self.client.post('/productos/ajuste-stock', headers=self.headers,
+                                    data=f"id_producto,cantidad\n{self.ids[2]},1\n", content_type='text/csv')
+        assert response.status_code == 200
+
+        with self.client.application.app_context():
+            assert Producto.query.get(self.ids[2]).producto_stock == 21
+            assert HistorialStock.query.filter_by(id_producto=self.ids[2]).count() == 2
+
+    def test_ajuste_masivo_es_todo_o_nada(self):
+        response = self.client.post('/productos/ajuste-stock', headers=self.headers, json=[
+            {"id_producto": self.ids[0], "cantidad": 5},
+            {"id_producto": 987654, "cantidad": 5},
+        ])
+        assert response.status_code == 404
+        assert response.json["productos"] == [987654]
+
+        response = self.client.post('/productos/ajuste-stock', headers=self.headers, json=[
+            {"id_producto": self.ids[0], "cantidad": 5},
+            {"id_producto": self.ids[1], "cantidad": -2},
+        ])
+        assert response.status_code == 400
+        assert "Ajuste 2" in response.json["message"]
+
+        with self.client.application.app_context():
+            assert Producto.query.get(self.ids[0]).producto_stock == 4
+            assert HistorialStock.query.count() == 0
+
+    def test_historial_paginado_y_archivado(self):
+        with self.client.application.app_context():
+            ahora = datetime.utcnow()
+            db.session.add_all([
+                HistorialStock(id_producto=self.ids[0], stock_anterior=i, cantidad_ajuste=1, nuevo_stock=i + 1,
+                               fecha_ajuste=ahora - timedelta(days=200 - i), motivo=f"Ajuste {i}")
+                for i in range(5)
+            ] + [
+                HistorialStock(id_producto=self.ids[1], stock_anterior=9, cantidad_ajuste=1, nuevo_stock=10,
+                               fecha_ajuste=ahora, motivo="Reciente")
+            ])
+            db.session.commit()
+
+        url = f'/productos/{self.ids[0]}/historial-stock?limite=3'
+        pagina = self.client.get(url, headers=self.headers).json
+        assert [r["motivo"] for r in pagina["historial"]] == ["Ajuste 4", "Ajuste 3", "Ajuste 2"]
+        pagina = self.client.get(f'{url}&cursor={pagina["siguiente_cursor"]}', headers=self.headers).json
+        assert [r["motivo"] for r in pagina["historial"]] == ["Ajuste 1", "Ajuste 0"]
+        assert pagina["siguiente_cursor"] is None
+
+        hoy = datetime.utcnow().strftime('%Y-%m-%d')
+        response = self.client.get(f'/historial-stock?fecha_desde={hoy}', headers=self.headers)
+        assert [r["motivo"] for r in response.json["historial"]] == ["Reciente"]
+        assert self.client.get('/historial-stock?fecha_desde=ayer', headers=self.headers).status_code == 400
+
+        with self.client.application.app_context():
+            assert archivar_historial_stock(90, lote=2) == 5
+            assert HistorialStock.query.count() == 1
+
+        assert self.client.get(url, headers=self.headers).json["historial"] == []
+        archivados = self.client.get('/historial-stock?archivo=true', headers=self.headers).json["historial"]
+        assert [(r["motivo"], r["stock_anterior"], r["nuevo_stock"]) for r in archivados][0] == ("Ajuste 4", 4, 5)
+        assert len(archivados) == 5
+
+    def test_stock_en_fecha_pasada(self):
+        """Foto hace 10 días con stock 10; hace 9 días entran 15 y se venden 5; hoy entran 3 (stock actual 23)"""
+        ahora = datetime.utcnow()
+        with self.client.application.app_context():
+            producto = Producto.query.get(self.ids[0])
+            producto.producto_stock = 23
+            db.session.add(HistorialStock(id_producto=self.ids[0], stock_anterior=20, cantidad_ajuste=3,
+                                          nuevo_stock=23, fecha_ajuste=ahora))
+            db.session.add(FotoStock(fecha=ahora - timedelta(days=10), id_producto=self.ids[0], stock=10))
+            db.session.add(HistorialStock(id_producto=self.ids[0], stock_anterior=10, cantidad_ajuste=15,
+                                          nuevo_stock=25, fecha_ajuste=ahora - timedelta(days=9)))
+            usuario = Usuario.query.filter_by(correo="admin_stock@gmail.com").first()
+            carrito = Carrito(id_usuario=usuario.id_usuario, total=500, procesado=True)
+            db.session.add(carrito)
+            db.session.flush()
+            pago = Pago(id_carrito=carrito.id_carrito, monto=500, metodo_pago='paypal',
+                        fecha_pago=ahora - timedelta(days=9))
+            db.session.add(pago)
+            db.session.flush()
+            factura = Factura(id_pago=pago.id_pago, total=500)
+            db.session.add(factura)
+            db.session.flush()
+            db.session.add(DetalleFactura(id_factura=factura.id_factura, id_producto=self.ids[0], cantidad=5,
+                                          precio_unitario=100, monto_total=500))
+            db.session.commit()
+
+        def stock(dias):
+            fecha = (ahora - timedelta(days=dias)).strftime('%Y-%m-%d')
+            response = self.client.get(f'/stock-productos?fecha={fecha}', headers=self.headers)
+            assert response.status_code == 200
+            return response.json, {p["id_producto"]: p["producto_stock"] for p in response.json["productos"]}[self.ids[0]]
+
+        # Antes de la foto: se parte de la foto hacia atrás
+        respuesta, valor = stock(11)
+        assert valor == 10 and respuesta["foto"] is not None
+        # Después de los movimientos: se parte de la foto hacia delante
+        respuesta, valor = stock(8)
+        assert valor == 20 and respuesta["foto"] is not None
+        # Ayer: el stock actual está más cerca y se deshacen los movimientos posteriores
+        respuesta, valor = stock(1)
+        assert valor == 20 and respuesta["foto"] is None
+
+    def test_stock_en_fecha_con_pago_sin_factura(self):
+        """El /pago antiguo descuenta stock sin factura: la reconstrucción usa las líneas de su carrito"""
+        ahora = datetime.utcnow()
+        with self.client.application.app_context():
+            producto = Producto.query.get(self.ids[0])
+            producto.producto_stock = 6
+            usuario = Usuario.query.filter_by(correo="admin_stock@gmail.com").first()
+            carrito = Carrito(id_usuario=usuario.id_usuario, total=400, procesado=True)
+            db.session.add(carrito)
+            db.session.flush()
+            db.session.add(CarritoProducto(id_carrito=carrito.id_carrito, id_producto=self.ids[0], cantidad=4))
+            db.session.add(Pago(id_carrito=carrito.id_carrito, monto=400, metodo_pago='paypal',
+                                fecha_pago=ahora - timedelta(days=2)))
+            db.session.commit()
+
+            # Sin fecha explícita el pago y el ajuste se fechan en UTC, como el corte
+            assert Pago.query.filter_by(id_carrito=carrito.id_carrito).one().fecha_pago <= datetime.utcnow()
+            ajuste = HistorialStock(id_producto=self.ids[0], stock_anterior=6, cantidad_ajuste=0, nuevo_stock=6)
+            db.session.add(ajuste)
+            db.session.commit()
+            assert abs(ajuste.fecha_ajuste - datetime.utcnow()) < timedelta(minutes=1)
+
+        fecha = (ahora - timedelta(days=3)).strftime('%Y-%m-%d')
+        response = self.client.get(f'/stock-productos?fecha={fecha}', headers=self.headers)
+        assert {p["id_producto"]: p["producto_stock"] for p in response.json["productos"]}[self.ids[0]] == 10
+
+        assert self.client.get('/stock-productos?fecha=2024-13-01', headers=self.headers).status_code == 400
+
+        with self.client.application.app_context():
+            fecha = tomar_foto_stock()
+            assert FotoStock.query.filter_by(fecha=fecha).count() == len(self.ids)
+
+
+class TestBatch:
+    """POST /batch: subpeticiones en proceso con un status por cada una"""
+
+    PANTALLA_INICIO = ['/perfil', '/carrito/activo', '/categorias', '/productos/recomendados', '/api/mis-pedidos']
+
+    @pytest.fixture(autouse=True)
+    def setup_method(self, client):
+        self.client = client
+
+        with self.client.application.app_context():
+            db.session.rollback()
+            rol_cliente = Rol.query.filter_by(nombre_rol="Cliente Batch").first()
+            if not rol_cliente:
+                rol_cliente = Rol(nombre_rol="Cliente Batch")
+                db.session.add(rol_cliente)
+                db.session.commit()
+            usuario = Usuario.query.filter_by(correo="batch@gmail.com").first()
+            if not usuario:
+                usuario = Usuario(nombre="Cliente Batch", numerodoc=55701, correo="batch@gmail.com",
+                                  contrasena="cliente12345", rol_id=rol_cliente.rol_id)
+                db.session.add(usuario)
+                db.session.commit()
+            self.headers = {"Authorization": f"Bearer {create_access_token(identity=str(usuario.id_usuario))}"}
+
+    def test_pantalla_de_inicio_en_un_viaje(self):
+        """Cada resultado coincide con la petición individual, en orden y con su status"""
+        # /carrito/activo crea el carrito la primera vez (y /perfil lo lista)
+        self.client.get('/carrito/activo', headers=self.headers)
+        individuales = [self.client.get(ruta, headers=self.headers) for ruta in self.PANTALLA_INICIO]
+
+        for paralelo in (False, True):
+            response = self.client.post('/batch', headers=self.headers, json={
+                "paralelo": paralelo,
+                "peticiones": [{"id": ruta, "path": ruta} for ruta in self.PANTALLA_INICIO]
+            })
+
+            assert response.status_code == 200
+            resultados = response.json['resultados']
+            assert [r['id'] for r in resultados] == self.PANTALLA_INICIO
+            assert [r['status'] for r in resultados] == [r.status_code for r in individuales]
+            assert [r['body'] for r in resultados] == [r.json for r in individuales]
+        assert limitador.en_curso == 0
+
+    def test_status_por_subpeticion(self):
+        """Errores y 304 quedan en su resultado sin afectar al resto"""
+        etag = self.client.get('/categorias', headers=self.headers).headers['ETag']
+
+        response = self.client.post('/batch', headers=self.headers, json=[
+            {"path": "/categorias", "headers": {"If-None-Match": etag}},
+            {"path": "/no-existe"},
+            {"method": "DELETE", "path": "/categorias"},
+            {"path": "/productos?fields=producto_nombre"},
+        ])
+
+        assert response.status_code == 200
+        assert [r['status'] for r in response.json['resultados']] == [304, 404, 405, 200]
+        assert response.json['resultados'][0]['headers']['ETag'] == etag
+
+    def test_subrespuestas_sin_comprimir(self):
+        """Accept-Encoding de una subpetición no comprime su cuerpo dentro del JSON del lote"""
+        self.client.application.config['COMPRESION_TAMANO_MINIMO'], minimo = 0, \
+            self.client.application.config['COMPRESION_TAMANO_MINIMO']
+        try:
+            response = self.client.post('/batch', headers=self.headers, json=[
+                {"path": "/categorias", "headers": {"Accept-Encoding": "gzip, br", "Connection": "close"}},
+            ])
+        finally:
+            self.client.application.config['COMPRESION_TAMANO_MINIMO'] = minimo
+        assert response.status_code == 200
+        resultado = response.json['resultados'][0]
+        assert resultado['status'] == 200
+        assert resultado['body'] == self.client.get('/categorias', headers=self.headers).json
+
+    def test_lote_invalido(self):
+        assert self.client.post('/batch', headers=self.headers, json={"peticiones": []}).status_code == 400
+        assert self.client.post('/batch', headers=self.headers, json=[{"path": "sin-barra"}]).status_code == 400
+        response = self.client.post('/batch', headers=self.headers, json=[{"path": "/batch"}])
+        assert response.status_code == 400
+        maximo = self.client.application.config['BATCH_MAX_PETICIONES']
+        response = self.client.post('/batch', headers=self.headers, json=[{"path": "/productos"}] * (maximo + 1))
+        assert response.status_code == 400
+
+    def test_rutas_criticas_no_van_en_lotes(self):
+        """Pago y checkout se admiten siempre en el limitador: no pueden colarse dentro de un lote"""
+        for metodo, ruta in [("POST", "/checkout"), ("POST", "/pago"), ("GET", "/factura/1")]:
+            response = self.client.post('/batch', headers=self.headers,
+                                        json=[{"path": "/categorias"}, {"method": metodo, "path": ruta}])
+            assert response.status_code == 400, ruta
+
+    def test_subpeticiones_paralelas_cuentan_concurrencia(self):
+        config = self.client.application.config
+        anterior = config['LIMITE_CONCURRENCIA']
+        ranura = limitador._mi_ranura()
+        # El lote ocupa la última plaza libre: sus hilos ya no caben, en secuencia sí
+        config['LIMITE_CONCURRENCIA'] = 2
+        limitador._en_curso[ranura] = 1
+        try:
+            peticiones = [{"path": "/categorias"}] * 3
+            paralelo = self.client.post('/batch', headers=self.headers, json={"paralelo": True, "peticiones": peticiones})
+            secuencial = self.client.post('/batch', headers=self.headers, json={"peticiones": peticiones})
+        finally:
+            config['LIMITE_CONCURRENCIA'] = anterior
+            limitador._en_curso[ranura] = 0
+
+        assert [r['status'] for r in paralelo.json['resultados']] == [503] * 3
+        assert [r['status'] for r in secuencial.json['resultados']] == [200] * 3
+        assert limitador.en_curso == 0
+
+    def test_tope_de_hilos_por_worker(self):
+        config = self.client.application.config
+        # Sin cupo de hilos en el worker el lote paralelo corre en secuencia, con el mismo resultado
+        config['BATCH_HILOS_WORKER'] = 0
+        try:
+            with patch('flaskr.utilidades.lotes.ThreadPoolExecutor') as pool:
+                response = self.client.post('/batch', headers=self.headers, json={
+                    "paralelo": True, "peticiones": [{"path": "/categorias"}] * 3
+                })
+        finally:
+            config['BATCH_HILOS_WORKER'] = 8
+        assert not pool.called
+        assert [r['status'] for r in response.json['resultados']] == [200] * 3
+
+        # Los hilos de un lote se devuelven al terminar
+        assert cupo_hilos.tomar(8, 8) == 8
+        cupo_hilos.devolver(8)
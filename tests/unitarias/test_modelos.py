@@ -1,7 +1,10 @@
 import pytest
+from concurrent.futures import Future
+from unittest.mock import MagicMock
 from werkzeug.security import generate_password_hash, check_password_hash
-from flaskr.modelos import Usuario, Rol, Categoria, Producto, Carrito, CarritoProducto, Pago, TarjetaDetalle, TransferenciaDetalle, PaypalDetalle, db
+from flaskr.modelos import Usuario, Rol, Categoria, Producto, Carrito, CarritoProducto, Pago, TarjetaDetalle, TransferenciaDetalle, PaypalDetalle, db, tokenizador_tarjetas
 from sqlalchemy.exc import IntegrityError
+from flaskr.modelos.hashing import PoolHashing, HashingSaturado
 
 class TestUsuarioModel:
     """Pruebas unitarias para el modelo Usuario"""
@@ -84,6 +87,51 @@ class TestUsuarioModel:
             session.add(usuario)
             session.commit()
 
+class TestPoolHashing:
+    """Pruebas unitarias para el pool de hashing de contraseñas"""
+
+    def test_necesita_rehash_con_otras_iteraciones(self):
+        """Un hash con menos iteraciones que las configuradas debe rehashearse"""
+        pool = PoolHashing()
+        pool.configurar(metodo='pbkdf2:sha256:300000', procesos=0)
+
+        assert pool.necesita_rehash(generate_password_hash("clave123", method='pbkdf2:sha256:1000'))
+        assert not pool.necesita_rehash(pool.generar("clave123"))
+        assert pool.verificar(pool.generar("clave123"), "clave123")
+
+    def test_rechaza_si_hay_demasiadas_pendientes(self):
+        """Con la cola llena debe fallar al momento con 503"""
+        pool = PoolHashing()
+        pool.configurar(procesos=1, maximo_pendientes=1)
+        pool._pendientes = 1
+
+        with pytest.raises(HashingSaturado) as error:
+            pool.generar("clave123")
+        assert error.value.code == 503
+
+    def test_timeout_no_libera_la_plaza_hasta_que_termina(self):
+        """Tras un 503 por timeout el hash sigue ocupando el pool hasta acabar"""
+        pool = PoolHashing()
+        pool.configurar(procesos=1, maximo_pendientes=1, timeout=0.01)
+        futuro = Future()
+        pool._obtener_pool = lambda: MagicMock(submit=MagicMock(return_value=futuro))
+
+        with pytest.raises(HashingSaturado):
+            pool.generar("clave123")
+        assert pool._pendientes == 1
+        with pytest.raises(HashingSaturado):
+            pool.generar("clave123")
+
+        futuro.set_result("hash")
+        assert pool._pendientes == 0
+
+    def test_configurar_acepta_ceros(self):
+        pool = PoolHashing()
+        pool.configurar(maximo_pendientes=0, timeout=0)
+        assert pool.maximo_pendientes == 0
+        assert pool.timeout == 0
+
+
 class TestRolModel:
     """Pruebas unitarias para el modelo Rol"""
 
@@ -381,7 +429,7 @@ class TestPaypalDetalleModel:
 
     def test_creacion_paypal_valido(self, session):
         """Debe crear un detalle Paypal válido"""
-        carrito = Carrito(id_carrito=20, id_usuario=1, total=750)
+        carrito = Carrito(id_carrito=20, id_usuario=1, total=750, procesado=True)
         pago = Pago(
             id_carrito=carrito.id_carrito,
             monto=750,
@@ -405,7 +453,7 @@ class TestPaypalDetalleModel:
 
     def test_relacion_unica_con_pago(self, session):
         """Un pago solo debe tener un detalle Paypal"""
-        carrito = Carrito(id_carrito=21, id_usuario=1, total=800)
+        carrito = Carrito(id_carrito=21, id_usuario=1, total=800, procesado=True)
         pago = Pago(id_carrito=carrito.id_carrito, monto=800, metodo_pago='paypal')
         
         session.add_all([carrito, pago])
@@ -435,7 +483,7 @@ class TestTransferenciaDetalleModel:
 
     def test_creacion_transferencia_valida(self, session):
         """Debe crear un detalle de transferencia válido"""
-        carrito = Carrito(id_carrito= 23, id_usuario=1, total=1200)
+        carrito = Carrito(id_carrito= 23, id_usuario=1, total=1200, procesado=True)
         pago = Pago(
             id_carrito=carrito.id_carrito,
             monto=1200,
@@ -481,7 +529,7 @@ class TestTarjetaDetalleModel:
 
     def test_creacion_tarjeta_valida(self, session):
         """Debe crear un detalle de tarjeta válido"""
-        carrito = Carrito(id_carrito=24, id_usuario=1, total=1500)
+        carrito = Carrito(id_carrito=24, id_usuario=1, total=1500, procesado=True)
         pago = Pago(
             id_carrito=carrito.id_carrito,
             monto=1500,
@@ -552,4 +600,29 @@ class TestTarjetaDetalleModel:
 
         session.add(detalle2)
         with pytest.raises(IntegrityError):
-            session.commit()
\ No newline at end of file
+            session.commit()
+
+    def test_modo_token_con_rotacion_de_clave(self):
+        """Con claves configuradas guarda HMAC y últimos 4 dígitos, sin hash ni CVV"""
+        try:
+            tokenizador_tarjetas.configurar('1:clave-antigua')
+            antigua = TarjetaDetalle(id_pago=1, nombre_en_tarjeta="TEST USER", fecha_expiracion="01/30")
+            antigua.numero_tarjeta = "4111111111111111"
+            antigua.cvv = "123"
+
+            tokenizador_tarjetas.configurar('1:clave-antigua,2:clave-nueva')
+            nueva = TarjetaDetalle(id_pago=2, nombre_en_tarjeta="TEST USER", fecha_expiracion="01/30")
+            nueva.numero_tarjeta = "4111111111111111"
+
+            assert antigua.numero_tarjeta_hash is None and antigua.cvv_hash is None
+            assert antigua.ultimos_cuatro == "1111"
+            assert (antigua.token_version, nueva.token_version) == (1, 2)
+            assert antigua.numero_tarjeta_token != nueva.numero_tarjeta_token
+            assert antigua.verificar_numero_tarjeta("4111111111111111") is True
+            assert nueva.verificar_numero_tarjeta("4111111111111111") is True
+            assert nueva.verificar_numero_tarjeta("4111111111111112") is False
+            assert antigua.verificar_cvv("123") is False
+            assert set(tokenizador_tarjetas.tokens_posibles("4111111111111111")) == {
+                antigua.numero_tarjeta_token, nueva.numero_tarjeta_token}
+        finally:
+            tokenizador_tarjetas.configurar('')
\ No newline at end of file